@@ -21,8 +21,8 @@
 #
 ################################################################################
 
-import sys,socket,select,argparse,time,traceback,getpass,ssl
-from threading import Thread,Event
+import sys,socket,select,argparse,time,traceback,getpass,ssl,math
+from threading import Thread,Event,Lock
 from queue import Queue
 
 readline = None
@@ -55,6 +55,10 @@ def main():
   parser.add_argument('-s','--ssl',
       action='store_true',
       help='use ssl')
+  parser.add_argument('-u','--unix',
+      default=None,
+      help='connect to a unix domain socket instead of host',
+      metavar='PATH')
   parser.add_argument('-r','--noreadline',
       action='store_true',
       help="don't use GNU readline")
@@ -70,9 +74,23 @@ def main():
   parser.add_argument('-w','--timeout',
       default=15,type=int,
       help='timeout in sec (depends -d)')
+  parser.add_argument('-b','--batch',
+      default=None,const='-',nargs='?',
+      help='run cmds from a file (default stdin) and report latency',
+      metavar='FILE')
+  parser.add_argument('-c','--connections',
+      default=1,type=int,
+      help='number of connections to spread cmds over (depends -b)')
+  parser.add_argument('-a','--rate',
+      default=0,type=float,
+      help='cmds/sec across all connections; 0 waits for replies (depends -b)')
+  parser.add_argument('-q','--quiet',
+      action='store_true',
+      help="don't print replies (depends -b)")
   args = parser.parse_args()
 
-  if (not args.gui) and (not args.noreadline and (args.execute is None)):
+  if ((not args.gui) and (not args.noreadline)
+      and (args.execute is None) and (args.batch is None)):
     try:
       import readline as temp
       global readline
@@ -80,7 +98,9 @@ def main():
     except:
       pass
 
-  if args.execute is not None:
+  if args.batch is not None:
+    Batch(args).run()
+  elif args.execute is not None:
     Shell(args).run()
   elif args.gui:
     app = QtWidgets.QApplication(sys.argv)
@@ -162,6 +182,112 @@ class Shell(object):
     self.errors = True
     self.response.append((False,self.delim))
 
+################################################################################
+# Batch class
+################################################################################
+
+class Batch(object):
+
+  def __init__(self,args):
+
+    self.args = args
+    self.event_close = Event()
+    self.pword = self.args.password
+    self.lock = Lock()
+    self.errors = False
+
+  def run(self):
+
+    if self.args.batch=='-':
+      lines = sys.stdin.readlines()
+    else:
+      with open(self.args.batch,'r') as f:
+        lines = f.readlines()
+    cmds = [x.strip() for x in lines]
+    cmds = [x for x in cmds if x and not x.startswith('#')]
+
+    # deal cmds out to each connection and split the rate between them
+    n = max(1,min(self.args.connections,len(cmds)))
+    rate = float(self.args.rate)/n
+    threads = [LoadThread(self,cmds[i::n],rate) for i in range(0,n)]
+    for t in threads:
+      if not t.connect():
+        sys.exit(1)
+
+    start = time.time()
+    for t in threads:
+      t.start()
+    try:
+      while any(t.is_alive() for t in threads):
+        time.sleep(0.1)
+    except KeyboardInterrupt:
+      self.event_close.set()
+      for t in threads:
+        t.join()
+    elapsed = time.time()-start
+
+    latency = sorted(sum([t.latency for t in threads],[]))
+    lost = sum([t.lost for t in threads])
+    self.report(len(cmds),n,elapsed,latency,lost)
+
+    if self.errors or lost:
+      sys.exit(1)
+
+  # @param total (int) number of cmds we tried to send
+  # @param conns (int) number of connections used
+  # @param elapsed (float) seconds from the first send to the last reply
+  # @param latency (list of float) sorted round-trip times in seconds
+  # @param lost (int) number of cmds that never finished
+  def report(self,total,conns,elapsed,latency,lost):
+    """print throughput and latency percentiles to stderr"""
+
+    done = len(latency)
+    rate = done/elapsed if elapsed else 0
+    lines = ['%s/%s cmds finished on %s connection(s) in %.3f sec (%.1f/sec)'
+        % (done,total,conns,elapsed,rate)]
+    if lost:
+      lines.append('%s cmds timed out or were never sent' % lost)
+    if latency:
+      stats = [('min',latency[0])]
+      stats += [('p%s' % p,percentile(latency,p)) for p in (50,90,99)]
+      stats.append(('max',latency[-1]))
+      lines.append('latency (ms): '+' '.join(
+          ['%s=%.1f' % (name,1000*val) for (name,val) in stats]))
+
+    for line in lines:
+      sys.stderr.write('  --- '+line+'\n')
+    sys.stderr.flush()
+
+  def say(self,s):
+
+    if self.args.quiet:
+      return
+    with self.lock:
+      sys.stdout.write(s+'\n')
+      sys.stdout.flush()
+
+  def log(self,txt):
+
+    if self.args.debug:
+      with self.lock:
+        sys.stderr.write('  --- '+txt+'\n')
+        sys.stderr.flush()
+
+  def error(self,txt):
+
+    with self.lock:
+      sys.stderr.write('  ### '+txt+'\n')
+      sys.stderr.flush()
+    self.errors = True
+
+# @param vals (list) sorted values
+# @param p (int) the percentile to return e.g. 99
+# @return (object) the smallest value with at least p% of vals at or below it
+def percentile(vals,p):
+  """return the p-th percentile of a sorted list using nearest-rank"""
+
+  return vals[max(0,int(math.ceil(p*len(vals)/100.0))-1)]
+
 ################################################################################
 # CLI class
 ################################################################################
@@ -242,11 +368,17 @@ class SocketThread(Thread):
 
   MSG_AUTH = '0'
   MSG_TEXT = '1'
+  MSG_REQ = '2'
+  MSG_DONE = '3'
 
   AUTH_OKAY = 'OKAY'
   AUTH_FAILED = 'FAILED'
   AUTH_NONE = 'NONE'
 
+  # refuse to buffer frames larger than this many bytes
+  MAX_FRAME = 1048576
+  RECV_SIZE = 65536
+
   def __init__(self,chat):
     """create a new thread that reads from stdin and appends to a Queue"""
 
@@ -255,10 +387,14 @@ class SocketThread(Thread):
     self.auth_sent = False
 
     self.chat = chat
-    self.buffer = ''
+    self.buffer = bytearray()
+    self.chunk = bytearray(SocketThread.RECV_SIZE)
 
   def connect(self):
 
+    if self.chat.args.unix:
+      return self.connect_unix()
+
     success = False
 
     if self.chat.args.noverify and not self.chat.args.ssl:
@@ -307,6 +443,23 @@ class SocketThread(Thread):
 
     return success
 
+  def connect_unix(self):
+
+    if self.chat.args.ssl:
+      self.chat.log('Ignoring option --ssl (using a unix socket)')
+
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+      sock.connect(self.chat.args.unix)
+    except socket.error as e:
+      sock.close()
+      self.chat.error('Socket error: %s' % e.strerror)
+      return False
+
+    self.sock = sock
+    self.chat.log('Connected')
+    return True
+
   def run(self):
     """receive and send data on the socket"""
 
@@ -362,23 +515,46 @@ class SocketThread(Thread):
 
     return msgs
 
+  def recv(self):
+    """read whatever the socket has into our buffer"""
+
+    n = self.sock.recv_into(self.chunk)
+    if not n:
+      self.die('Remote closed connection')
+      return False
+    self.buffer += memoryview(self.chunk)[:n]
+    return True
+
   def get_msg(self):
 
-    msg = self.buffer
-    while ' ' not in msg:
-      s = self.sock.recv(4096).decode('utf8')
-      if not s:
-        self.die('Remote closed connection')
+    header = len(str(SocketThread.MAX_FRAME))+1
+    space = self.buffer.find(b' ',0,header)
+    while space==-1:
+      if len(self.buffer)>=header:
+        self.die('Invalid msg header; closing connection')
+        return (None,None)
+      if not self.recv():
         return (None,None)
-      msg += s
+      space = self.buffer.find(b' ',0,header)
 
-    length_str = msg.split(' ')[0]
-    target = len(length_str)+1+int(length_str)
-    while len(msg)<target:
-      msg += self.sock.recv(min(target-len(msg),4096)).decode('utf8')
+    try:
+      length = int(self.buffer[:space])
+    except ValueError:
+      length = -1
+    if length<0:
+      self.die('Invalid msg header; closing connection')
+      return (None,None)
+    if length>SocketThread.MAX_FRAME:
+      self.die('Msg of %s bytes is too large; closing connection' % length)
+      return (None,None)
+
+    target = space+1+length
+    while len(self.buffer)<target:
+      if not self.recv():
+        return (None,None)
 
-    (msg,self.buffer) = (msg[:target],msg[target:])
-    msg = msg[msg.find(' ')+1:]
+    msg = bytes(self.buffer[space+1:target]).decode('utf8')
+    del self.buffer[:target]
     return (msg[0],msg[2:])
 
   def do_auth(self):
@@ -404,14 +580,106 @@ class SocketThread(Thread):
   def send_msg(self,msg,typ=None):
 
     typ = SocketThread.MSG_TEXT if typ is None else typ
-    msg = typ+' '+msg
-    length_str = str(len(msg))
-    msg = str(length_str+' '+msg).encode('utf8')
-    target = len(msg)
-
-    sent = 0
-    while sent<target:
-      sent += self.sock.send(msg[sent:])
+    msg = (typ+' '+msg).encode('utf8')
+    self.sock.sendall(str(len(msg)).encode('utf8')+b' '+msg)
+
+################################################################################
+# LoadThread class
+################################################################################
+
+class LoadThread(SocketThread):
+
+  # @param chat (Batch) the owner of this thread
+  # @param cmds (list of str) the cmds to send on this connection
+  # @param rate (float) cmds/sec to send, or 0 to wait for each reply
+  def __init__(self,chat,cmds,rate):
+    """create a new thread that pipelines cmds and times their replies"""
+
+    super(LoadThread,self).__init__(chat)
+    self.cmds = cmds
+    self.rate = rate
+
+    self.pending = {}
+    self.latency = []
+    self.lost = 0
+
+  def run(self):
+    """send cmds tagged with request ids and wait for each to finish"""
+
+    if self.chat.pword:
+      self.do_auth()
+
+    i = 0
+    start = time.time()
+    while (not self.chat.event_close.is_set()
+        and (i<len(self.cmds) or self.pending)):
+
+      # with no rate only keep one cmd in flight, otherwise stick to schedule
+      now = time.time()
+      if i<len(self.cmds):
+        due = (start+i/self.rate) if self.rate else None
+        if (due is None and not self.pending) or (due is not None and now>=due):
+          self.pending[str(i)] = now
+          self.send_msg('%s %s' % (i,self.cmds[i]),SocketThread.MSG_REQ)
+          i += 1
+          continue
+
+      # sleep until the next cmd is due or something arrives
+      wait = self.chat.args.timeout
+      if i<len(self.cmds) and self.rate:
+        wait = max(0,start+i/self.rate-now)
+      if self.pending:
+        oldest = min(self.pending.values())
+        wait = min(wait,max(0,oldest+self.chat.args.timeout-now))
+
+      (read,write,err) = select.select([self.sock],[],[],wait)
+      if read:
+        try:
+          self.get_msgs()
+        except:
+          self.chat.error('EXCEPTION\n\n'+traceback.format_exc())
+          break
+      self.expire()
+
+    self.lost += len(self.pending)+len(self.cmds)-i
+    try:
+      self.sock.shutdown(socket.SHUT_RDWR)
+    except:
+      pass
+    self.sock.close()
+
+  def expire(self):
+    """give up on cmds that have waited longer than the timeout"""
+
+    cutoff = time.time()-self.chat.args.timeout
+    for (req,sent) in list(self.pending.items()):
+      if sent<cutoff:
+        del self.pending[req]
+        self.lost += 1
+        self.chat.error('Timed out waiting for "%s"' % self.cmds[int(req)])
+
+  def get_msgs(self):
+    """read frames until the buffer is empty, handling request ids"""
+
+    while True:
+      (typ,msg) = self.get_msg()
+      if typ is None:
+        return
+      elif typ==SocketThread.MSG_AUTH:
+        self.check_auth(msg)
+      elif typ==SocketThread.MSG_TEXT:
+        self.chat.say(msg)
+      elif typ==SocketThread.MSG_REQ:
+        self.chat.say(msg.split(' ',1)[-1])
+      elif typ==SocketThread.MSG_DONE:
+        sent = self.pending.pop(msg,None)
+        if sent is not None:
+          self.latency.append(time.time()-sent)
+      else:
+        self.die('Unsupported msg type "%s"; closing connection' % typ)
+        return
+      if not self.buffer:
+        return
 
 ################################################################################
 # BufferThread class
@@ -318,7 +318,7 @@ def config(bot,mess,args):
         % (opt,bot.conf_diff[opt][0],bot.opt[opt]))
 
   # some options don't make sense to edit in chat
-  if opt in ('protocols','disable','enable','rename','cmd_dir','rooms'):
+  if opt in bot.conf.STATIC:
     return 'You may not edit that option via chat'
 
   # revert to original config
@@ -21,6 +21,8 @@
 ################################################################################
 
 import os,sys,pickle,time,traceback,threading,Queue,multiprocessing
+import select,errno,struct,ctypes,ctypes.util
+from collections import OrderedDict
 
 # we import smbc in init(), find(), and rsamba() if needed
 
@@ -58,6 +60,18 @@ def conf(bot):
       'default' : {},
       'parse'   : parse_remote,
       'valid'   : valid_remote
+    },
+    { 'name'    : 'watch',
+      'default' : False,
+      'parse'   : bot.conf.parse_bool
+    },
+    { 'name'    : 'rescan',
+      'default' : 60,
+      'parse'   : bot.conf.parse_int
+    },
+    { 'name'    : 'threads',
+      'default' : 8,
+      'parse'   : bot.conf.parse_int
     }
   ]
 
@@ -144,10 +158,12 @@ def init(bot):
   bot.add_var('lib_audio_file')
   bot.add_var('lib_video_dir')
   bot.add_var('lib_video_file')
+  bot.add_var('lib_cache',{})
 
   bot.add_var('lib_lock',threading.Lock())
   bot.add_var('lib_last_op')
   bot.add_var('lib_pending_send',Queue.Queue())
+  bot.add_var('lib_watcher')
 
   if os.path.isfile(bot.opt('library.file')):
     Library(bot,None,['load']).run()
@@ -173,6 +189,15 @@ def init(bot):
   else:
     log.warning("Can't find module smbc; network shares will be disabled")
 
+  # a plugin reload hands us the old watcher back, so never run two at once
+  if bot.lib_watcher:
+    bot.lib_watcher.stop()
+    bot.lib_watcher = None
+
+  if bot.opt('library.watch'):
+    bot.lib_watcher = Watcher(bot)
+    bot.lib_watcher.start()
+
   # check for filename unicode support
   enc = sys.getfilesystemencoding()
   if enc!='UTF-8':
@@ -194,9 +219,39 @@ def library_translate(bot,path):
 
   return path
 
+@botidle(freq=60,thread=True)
+def _library_watch(bot):
+  """save changes from the watcher and rescan paths it can't watch"""
+
+  watcher = bot.lib_watcher
+  if not watcher:
+    return
+
+  # saving pickles the whole library, so only do it once in a while
+  if watcher.dirty:
+    watcher.dirty = False
+    Library(bot,None,['save']).run()
+
+  rescan = bot.opt('library.rescan')*60
+  if (watcher.unwatched and rescan
+      and time.time()-bot.lib_last_rebuilt>=rescan):
+    log.debug('Rescanning unwatched paths: %s' % watcher.unwatched)
+    Library(bot,None,['rebuild']).run()
+    watcher.watch_all()
+
+@botdown
+def _library_stop(bot):
+  """stop the watcher and save any changes it made"""
+
+  watcher = bot.lib_watcher
+  if watcher:
+    watcher.stop()
+    if watcher.dirty:
+      Library(bot,None,['save']).run()
+
 @botcmd(thread=True)
 def library(bot,mess,args):
-  """control media library - library (info|load|rebuild|save|reload)"""
+  """control media library - library (info|load|rebuild [full]|save|reload)"""
 
   # before botcmd had the threading option, I implemented library as a subclass
   # of threading.Thread and ran it; now that I'm using botcmd(thread=True),
@@ -230,7 +285,11 @@ def search(bot,mess,args):
 
   return 'Found '+str(len(matches))+' match: '+str(matches[0])
 
-def find(bot,dirs):
+# @param dirs (list) local paths and samba share dicts to traverse
+# @param cache (dict) [None] {path:cache} from util.rlistdirs() for local
+#   paths, updated in place; if None every local path is traversed in full
+# @return tuple(list,list,list) (dirs,files,errors) for all paths
+def find(bot,dirs,cache=None):
   """helper function for library()"""
 
   paths = []
@@ -247,16 +306,26 @@ def find(bot,dirs):
   files = []
   errors = []
 
-  # find all matching directories or files depending on fd parameter
+  # traverse all local paths at once since they're often on different disks
+  roots = {path:unicode(path) for path in paths}
+  old = (cache or {})
+  scans = util.rlistdirs(roots.values(),
+      {roots[path]:old.get(path) for path in paths},
+      threads=bot.opt('library.threads'))
+
   for path in paths:
-    try:
-      (temp_dirs,temp_files) = util.rlistdir(unicode(path))
-      dirs.extend(temp_dirs)
-      files.extend(temp_files)
-    except Exception as e:
-      msg = ('Unable to traverse "%s": %s' %
-          (path,traceback.format_exc(e).split('\n')[-2]))
+    result = scans[roots[path]]
+    if isinstance(result,Exception):
+      msg = ('Unable to traverse "%s": %s: %s' %
+          (path,result.__class__.__name__,result))
       errors.append((path,msg))
+      continue
+
+    (temp_dirs,temp_files,listing) = result
+    dirs.extend(temp_dirs)
+    files.extend(temp_files)
+    if cache is not None:
+      cache[path] = listing
 
   if smbpaths:
     import smbc
@@ -431,6 +500,9 @@ class Library(object):
     for name in names:
       setattr(self.bot,name,d[name])
 
+    # libraries saved by older versions don't have a cache
+    self.bot.lib_cache = d.get('lib_cache',{})
+
     n = len(self.bot.lib_audio_file)+len(self.bot.lib_video_file)
     s = ('Library loaded from "%s" with %s files in %f sec' %
         (self.bot.opt('library.file'),n,stop-start))
@@ -442,7 +514,8 @@ class Library(object):
     """save sibyl's library to a pickle"""
 
     names = ['lib_last_rebuilt','lib_last_elapsed',
-        'lib_video_dir','lib_video_file','lib_audio_dir','lib_audio_file']
+        'lib_video_dir','lib_video_file','lib_audio_dir','lib_audio_file',
+        'lib_cache']
     d = {name:getattr(self.bot,name) for name in names}
 
     with open(self.bot.opt('library.file'),'wb') as f:
@@ -463,10 +536,20 @@ class Library(object):
     start = time.time()
     self.bot.lib_last_rebuilt = time.time()
 
+    # only re-read local directories that changed since the last rebuild
+    # unless the user asked for a full rebuild; samba shares are always full
+    full = (self.args[1:2]==['full'])
+    old = ({} if full else self.bot.lib_cache)
+    cache = {}
+
     # update library vars and log errors
     errors = []
     for lib in ('audio','video'):
-      (dirs,files,errs) = find(self.bot,self.bot.opt('library.%s_dirs' % lib))
+      paths = self.bot.opt('library.%s_dirs' % lib)
+      for path in paths:
+        if not isinstance(path,dict) and path in old:
+          cache[path] = old[path]
+      (dirs,files,errs) = find(self.bot,paths,cache)
       setattr(self.bot,'lib_%s_dir' % lib,dirs)
       setattr(self.bot,'lib_%s_file' % lib,files)
       for e in errs:
@@ -474,6 +557,7 @@ class Library(object):
           log.error(e[1])
           errors.append(e)
 
+    self.bot.lib_cache = cache
     self.bot.lib_last_elapsed = int(time.time()-start)
     result = self.save()
 
@@ -506,3 +590,332 @@ class Library(object):
       self.send(result)
 
     return 'NOTE: run "library rebuild" to index new directories'
+
+################################################################################
+# Watcher class
+################################################################################
+
+# @return (CDLL) libc if it supports inotify, else None
+def inotify():
+  """load inotify from libc with ctypes"""
+
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    (libc.inotify_init1,libc.inotify_add_watch,libc.inotify_rm_watch)
+  except (OSError,AttributeError):
+    return None
+  return libc
+
+class Watcher(threading.Thread):
+
+  # from <sys/inotify.h>
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ONLYDIR = 0x1000000
+  IN_ISDIR = 0x40000000
+  IN_NONBLOCK = 0x800
+  IN_CLOEXEC = 0x80000
+
+  MASK = IN_CREATE|IN_DELETE|IN_MOVED_FROM|IN_MOVED_TO|IN_ONLYDIR
+
+  # collect events for this many seconds before applying them, since things
+  # like downloads and extracting archives tend to come in bursts
+  DELAY = 1
+
+  # give up waiting for the thread at shutdown after this many seconds, since
+  # it might be stuck behind (or running) a rebuild
+  TIMEOUT = 5
+
+  def __init__(self,bot):
+
+    super(Watcher,self).__init__()
+    self.daemon = True
+
+    self.bot = bot
+    self.enc = (sys.getfilesystemencoding() or 'utf8')
+    self.running = True
+    self.dirty = False
+
+    # inotify watches are per directory, and events only give us the name of
+    # the entry that changed, so we need to remember the path for each watch
+    self.lock = threading.Lock()
+    self.wds = {}
+    self.roots = {}
+    self.unwatched = []
+
+    # {name:(list,pos,children)} for each library list so update() only
+    # touches what changed; pos is {entry:index} and children is {dir:entries}
+    self.index = {}
+
+    self.libc = inotify()
+    self.fd = -1
+    if self.libc:
+      self.fd = self.libc.inotify_init1(self.IN_NONBLOCK|self.IN_CLOEXEC)
+    if self.fd<0:
+      log.warning("Can't use inotify; library paths will be rescanned")
+
+  def stop(self):
+    self.running = False
+    self.join(self.TIMEOUT)
+
+    # the thread is a daemon, so just leave it behind if it's still busy
+    if self.is_alive():
+      log.warning('Library watcher did not stop in %s sec' % self.TIMEOUT)
+    elif self.fd>=0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def run(self):
+
+    self.watch_all()
+    while self.running and self.fd>=0:
+      (r,w,x) = select.select([self.fd],[],[],1)
+      if not r:
+        continue
+
+      time.sleep(self.DELAY)
+      try:
+        self.apply(self.read())
+      except Exception as ex:
+        full = traceback.format_exc(ex)
+        log.error('Error in library watcher: %s' % full.split('\n')[-2])
+        log.debug(full)
+
+  def watch_all(self):
+    """watch every directory in every local path"""
+
+    roots = {}
+    paths = {}
+    unwatched = []
+    for lib in ('audio','video'):
+      for path in self.bot.opt('library.%s_dirs' % lib):
+        if isinstance(path,dict):
+          unwatched.append('smb://%s/%s' % (path['server'],path['share']))
+        else:
+          root = unicode(path).rstrip(os.path.sep)
+          roots.setdefault(root,set()).add(lib)
+          paths[root] = path
+
+    # the cache from the last rebuild saves us from walking the whole tree
+    for root in roots:
+      dirs = self.bot.lib_cache.get(paths[root])
+      if dirs is None:
+        dirs = (cur for (cur,ds,fs) in os.walk(root,followlinks=True))
+      if self.fd<0 or not self.watch(dirs):
+        unwatched.append(root)
+
+    (self.roots,self.unwatched) = (roots,unwatched)
+
+  # @param dirs (iterable) directories to watch
+  # @return (bool) False if we hit the limit on the number of watches
+  def watch(self,dirs):
+    """add inotify watches"""
+
+    with self.lock:
+      for path in dirs:
+        path = path.rstrip(os.path.sep)
+        name = (path.encode(self.enc) if isinstance(path,unicode) else path)
+        wd = self.libc.inotify_add_watch(self.fd,name,self.MASK)
+        if wd>=0:
+          self.wds[wd] = path
+          continue
+
+        # directories can vanish between listing and watching, so only
+        # running out of watches is a real problem
+        err = ctypes.get_errno()
+        if err==errno.ENOSPC:
+          log.warning('Out of inotify watches (see fs.inotify.'
+              'max_user_watches); falling back to rescans')
+          return False
+    return True
+
+  # @param path (unicode) a directory that moved away
+  def unwatch(self,path):
+    """remove watches for a directory tree"""
+
+    prefix = path+os.path.sep
+    with self.lock:
+      for (wd,p) in self.wds.items():
+        if p==path or p.startswith(prefix):
+          self.libc.inotify_rm_watch(self.fd,wd)
+          del self.wds[wd]
+
+  # @return (list of tuple) (wd,mask,name) for every pending event
+  def read(self):
+    """read everything from the inotify fd"""
+
+    data = ''
+    while True:
+      try:
+        data += os.read(self.fd,65536)
+      except OSError as e:
+        if e.errno==errno.EAGAIN:
+          break
+        raise
+
+    # struct inotify_event {int wd; uint32 mask,cookie,len; char name[];}
+    events = []
+    i = 0
+    while i+16<=len(data):
+      (wd,mask,cookie,n) = struct.unpack_from('iIII',data,i)
+      events.append((wd,mask,data[i+16:i+16+n].rstrip('\0')))
+      i += 16+n
+    return events
+
+  # @param path (unicode) a path in the library
+  # @return (list of str) the libs ('audio','video') the path belongs to
+  def libs(self,path):
+    """find which libraries the path is in"""
+
+    libs = set()
+    for (root,l) in self.roots.items():
+      if path.startswith(root+os.path.sep):
+        libs.update(l)
+    return libs
+
+  # @param events (list of tuple) from read()
+  def apply(self,events):
+    """update the library with a batch of events"""
+
+    # entries are only ever added or removed, so collapse events into a list
+    # of each; dirs end with a separator just like in the library itself
+    adds = OrderedDict()
+    dels = set()
+    rescan = False
+
+    for (wd,mask,name) in events:
+      if mask & self.IN_Q_OVERFLOW:
+        rescan = True
+        continue
+      if mask & self.IN_IGNORED:
+        with self.lock:
+          self.wds.pop(wd,None)
+        continue
+
+      with self.lock:
+        parent = self.wds.get(wd)
+      if parent is None or not name:
+        continue
+      try:
+        path = os.path.join(parent,name.decode(self.enc))
+      except UnicodeDecodeError:
+        log.debug('Ignoring undecodable name in "%s"' % parent)
+        continue
+      is_dir = (mask & self.IN_ISDIR)
+      key = (path+os.path.sep if is_dir else path)
+
+      # new dirs need watches before we list them or we might miss something
+      if mask & (self.IN_CREATE|self.IN_MOVED_TO):
+        dels.discard(key)
+        adds[key] = True
+        if is_dir:
+          self.watch(cur for (cur,ds,fs) in os.walk(path,followlinks=True))
+          (dirs,files) = util.rlistdir(path)
+          for entry in dirs+files:
+            dels.discard(entry)
+            adds[entry] = True
+
+      else:
+        for entry in adds.keys():
+          if entry==key or (is_dir and entry.startswith(key)):
+            del adds[entry]
+        dels.add(key)
+        if is_dir and mask & self.IN_MOVED_FROM:
+          self.unwatch(path)
+
+    if adds or dels:
+      self.update(adds.keys(),dels)
+
+    # the kernel dropped events, so we have no idea what changed
+    if rescan:
+      log.warning('Missed inotify events; rebuilding library')
+      Library(self.bot,None,['rebuild']).run()
+      self.watch_all()
+
+  # @param path (unicode) a library entry
+  # @return (unicode) the directory containing it, ending with a separator
+  def parent(self,path):
+    """return the parent directory of a library entry"""
+
+    return os.path.dirname(path.rstrip(os.path.sep))+os.path.sep
+
+  # @param name (str) the bot var of a library list e.g. 'lib_audio_file'
+  # @return (tuple) (list,pos,children) see self.index
+  def get_index(self,name):
+    """return the index for a list, rebuilding it if the list was replaced"""
+
+    lst = getattr(self.bot,name)
+    index = self.index.get(name)
+    if index and index[0] is lst:
+      return index
+
+    # rebuild and load replace the lists, so this happens once after each
+    (pos,children) = ({},{})
+    for (i,p) in enumerate(lst):
+      pos[p] = i
+      children.setdefault(self.parent(p),set()).add(p)
+    index = self.index[name] = (lst,pos,children)
+    return index
+
+  # @param adds (list of unicode) paths to add
+  # @param dels (set of unicode) paths to remove (including dir contents)
+  def update(self,adds,dels):
+    """apply changes to the library"""
+
+    # a rebuild holds the lock until it's done, so don't wait on it if we're
+    # being stopped; the rebuild will see these changes anyway
+    while not self.bot.lib_lock.acquire(False):
+      if not self.running:
+        return
+      time.sleep(0.1)
+
+    (added,removed) = (0,0)
+    try:
+      for lib in ('audio','video'):
+        (dirs,files) = [self.get_index('lib_%s_%s' % (lib,typ))
+            for typ in ('dir','file')]
+
+        # collect dir contents from the index instead of the whole list
+        gone = set()
+        todo = list(dels)
+        while todo:
+          p = todo.pop()
+          if p in gone:
+            continue
+          gone.add(p)
+          if p.endswith(os.path.sep):
+            todo.extend(dirs[2].get(p,()))
+            todo.extend(files[2].get(p,()))
+
+        # swap each removed entry with the last one so removal is O(1)
+        for p in gone:
+          (lst,pos,children) = (dirs if p.endswith(os.path.sep) else files)
+          i = pos.pop(p,None)
+          if i is None:
+            continue
+          last = lst.pop()
+          if i<len(lst):
+            lst[i] = last
+            pos[last] = i
+          children.get(self.parent(p),set()).discard(p)
+          children.pop(p,None)
+          removed += 1
+
+        # a rebuild might have already found some of these
+        for p in adds:
+          (lst,pos,children) = (dirs if p.endswith(os.path.sep) else files)
+          if p not in pos and lib in self.libs(p):
+            pos[p] = len(lst)
+            lst.append(p)
+            children.setdefault(self.parent(p),set()).add(p)
+            added += 1
+    finally:
+      self.bot.lib_lock.release()
+
+    log.debug('Library watcher added %s and removed %s entries'
+        % (added,removed))
+    self.dirty = True
@@ -20,7 +20,7 @@
 #
 ################################################################################
 
-import time,os,socket,copy,logging,inspect,traceback
+import time,os,socket,copy,logging,inspect,traceback,tempfile,shutil
 from collections import OrderedDict as odict
 import ConfigParser as cp
 
@@ -54,6 +54,9 @@ class Config(object):
   ERRORS = 2
   DUPLICATES = 3
 
+  # opts that can't take effect without restarting the bot
+  STATIC = ('protocols','disable','enable','rename','cmd_dir','rooms')
+
   def __init__(self,conf_file):
     """create a new config parser tied to the given bot"""
 
@@ -97,7 +100,9 @@ class Config(object):
 ('defer_total', (100,                 False,  self.parse_int,       None,               None,             None,     None)),
 ('defer_proto', (100,                 False,  self.parse_int,       None,               None,             None,     None)),
 ('defer_room',  (10,                  False,  self.parse_int,       None,               None,             None,     None)),
-('defer_priv',  (10,                  False,  self.parse_int,       None,               None,             None,     None))
+('defer_priv',  (10,                  False,  self.parse_int,       None,               None,             None,     None)),
+('proc_budget', (1000,                False,  self.parse_int,       None,               None,             None,     None)),
+('conf_watch',  (False,               False,  self.parse_bool,      None,               None,             None,     None))
 
     ])
 
@@ -112,6 +117,10 @@ class Config(object):
     self.real_time = False
     self.__log = logging.getLogger('config')
 
+    # cache the parsed file so rereading an unchanged file is just a stat()
+    self.__cache = (None,{},[])
+    self.__seen = {}
+
     # raise an exception if we can't write to conf_file
     util.can_write_file(self.conf_file,delete=True)
 
@@ -175,6 +184,20 @@ class Config(object):
     )
     self.NS[name] = ns
 
+  # @param ns (str) the namespace (e.g. filename) of the options to remove
+  # @return (list of str) the names of the options that were removed
+  def del_opts(self,ns):
+    """remove every option added by the given namespace"""
+
+    names = [opt for (opt,space) in self.NS.items() if space==ns]
+    for opt in names:
+      del self.OPTS[opt]
+      del self.NS[opt]
+      if self.opts is not None:
+        self.opts.pop(opt,None)
+
+    return names
+
   # @param opt (str) the option to set
   # @param val (str) the value to set (will be parsed into a Python object)
   # @return (bool) True if the option was actually changed
@@ -237,8 +260,29 @@ class Config(object):
       s += (' ('+msg+')')
     if val is not None:
       s += ('\n'+opt+' = '+val+'\n')
-    with open(self.conf_file,'r') as f:
-      lines = f.readlines()
+
+    # if someone else edits the file while we work, start over with their copy
+    for attempt in range(3):
+      stat = self.__stat()
+      with open(self.conf_file,'r') as f:
+        lines = self.__edit_lines(f.readlines(),opt,val,s)
+      if self.__write(lines,stat):
+        break
+    else:
+      self.log('warning','Config file kept changing; overwrote it anyway')
+      self.__write(lines)
+
+    # we already applied this opt via set_opt() so don't let watch() redo it
+    self.__seen_update([opt])
+    return True
+
+  # @param lines (list of str) the lines of the config file
+  # @param opt (str) the option to edit
+  # @param val (str,None) the new value, or None to delete the opt
+  # @param s (str) the text to insert for the opt
+  # @return (list of str) the edited lines
+  def __edit_lines(self,lines,opt,val,s):
+    """replace or append the given opt in the lines of a config file"""
 
     # search the config file for the specified opt to replace
     start = -1
@@ -253,7 +297,7 @@ class Config(object):
       lines.append(s)
 
     # if the opt existed in the file
-    else:
+    elif start!=-1:
 
       # delete all non-comments until reaching next opt (account for multiline)
       del lines[start]
@@ -275,8 +319,35 @@ class Config(object):
       if start>0 and lines[start-1].startswith('### MODIFIED: '):
         del lines[start-1]
 
-    with open(self.conf_file,'w') as f:
-      f.writelines(lines)
+    return lines
+
+  # @param lines (list of str) the lines to write to the config file
+  # @param stat (tuple) [None] abort if the file no longer matches this stat
+  # @return (bool) True if the file was written
+  def __write(self,lines,stat=None):
+    """atomically replace the config file via a temp file and rename"""
+
+    d = os.path.dirname(os.path.abspath(self.conf_file))
+    (fd,tmp) = tempfile.mkstemp(prefix='.sibyl-',suffix='.conf',dir=d)
+    try:
+      with os.fdopen(fd,'w') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+      shutil.copymode(self.conf_file,tmp)
+      if stat is not None and self.__stat()!=stat:
+        os.remove(tmp)
+        return False
+
+      # windows won't rename over an existing file
+      if os.name=='nt':
+        os.remove(self.conf_file)
+      os.rename(tmp,self.conf_file)
+    except:
+      if os.path.isfile(tmp):
+        os.remove(tmp)
+      raise
+
     return True
 
   # @param opt (str) the name of the opt to reload
@@ -321,7 +392,7 @@ class Config(object):
       return True
     return set_char<com_char
 
-  # @param opt (None,str) [None] if specified, only reload the named opt
+  # @param opt (None,str,list) [None] if specified, only reload the named opts
   # @param log (bool) [True] whether to log messages during the reload
   # @return (int) the result of the reload
   #   SUCCESS - no errors or warnings of any kind
@@ -364,9 +435,13 @@ class Config(object):
     else:
       return self.SUCCESS
 
+  # @param opt (None,str,list of str) [None] if specified, only update these
   def __update(self,opt=None):
     """update self.opts from config file"""
 
+    if isinstance(opt,basestring):
+      opt = [opt]
+
     # start with the defaults
     if not opt:
       self.opts = self.get_default()
@@ -374,10 +449,8 @@ class Config(object):
     # get the values in the config file
     opts = self.__read()
     if opt:
-      if opt in opts:
-        opts = {opt:opts[opt]}
-      else:
-        opts = {}
+      opts = {x:opts[x] for x in opt if x in opts}
+    self.__seen_update(opt)
 
     self.__exists(opts)
     self.__bwfilter(opts)
@@ -388,10 +461,26 @@ class Config(object):
     # update self.opts with parsed and valid values
     self.opts.update(opts)
 
+  # @return (tuple) identifies the current version of the config file
+  def __stat(self):
+    """return (mtime,size,inode) of the config file or None if missing"""
+
+    try:
+      s = os.stat(self.conf_file)
+    except OSError:
+      return None
+    return (s.st_mtime,s.st_size,s.st_ino)
+
   # @return (dict) the values of all config options read from the file
   def __read(self):
     """return a dict representing config file in the form {opt:value}"""
 
+    # skip parsing if the file hasn't changed since last time
+    stat = self.__stat()
+    if stat is not None and stat==self.__cache[0]:
+      self.__log_sections(self.__cache[2])
+      return dict(self.__cache[1])
+
     # use a SafeConfigParser to read options from the config file
     config = cp.SafeConfigParser()
     try:
@@ -404,15 +493,74 @@ class Config(object):
       self.log('debug',full)
       return {}
 
-    # Sibyl config does not use sections; options in sections will be ignored
-    secs = config.sections()
-    for sec in secs:
-      if sec!=DUMMY:
-        self.log('error','Ignoring section "%s" in config file' % sec)
+    secs = [x for x in config.sections() if x!=DUMMY]
+    self.__log_sections(secs)
 
     # return a dictionary of all opts read from the config file
-    items = config.items(DUMMY)
-    return {x:y for (x,y) in items}
+    items = {x:y for (x,y) in config.items(DUMMY)}
+    self.__cache = (stat,items,secs)
+    return dict(items)
+
+  # @param secs (list of str) sections found in the config file
+  def __log_sections(self,secs):
+    """Sibyl config does not use sections; options in them will be ignored"""
+
+    for sec in secs:
+      self.log('error','Ignoring section "%s" in config file' % sec)
+
+  # @param opts (None,list of str) [None] opts that were just applied
+  def __seen_update(self,opts=None):
+    """remember the raw file values that self.opts now reflects"""
+
+    if self.__stat()!=self.__cache[0]:
+      self.__read()
+    items = self.__cache[1]
+
+    if not opts:
+      self.__seen = dict(items)
+      return
+    for opt in opts:
+      if opt in items:
+        self.__seen[opt] = items[opt]
+      else:
+        self.__seen.pop(opt,None)
+
+  # @return (list of str) opts whose raw value in the file changed
+  def changed_opts(self):
+    """compare the config file to what we last applied (cheap if unchanged)"""
+
+    if self.__stat()==self.__cache[0]:
+      return []
+
+    items = self.__read()
+    names = set(items.keys()+self.__seen.keys())
+    return [x for x in names if x in self.OPTS
+        and items.get(x)!=self.__seen.get(x)]
+
+  # @return (list of str) opts that were reloaded from the file
+  def watch(self):
+    """apply external edits to the config file one opt at a time"""
+
+    changed = self.changed_opts()
+    if not changed:
+      return []
+
+    static = [x for x in changed if x in self.STATIC]
+    for opt in static:
+      self.log('warning','Opt "%s" changed but requires a reboot' % opt)
+    self.__seen_update(static)
+
+    changed = [x for x in changed if x not in self.STATIC]
+    if not changed:
+      return []
+
+    # opts deleted from the file go back to their defaults
+    for opt in changed:
+      if opt not in self.__cache[1]:
+        self.opts[opt] = self.OPTS[opt][self.DEF]
+
+    self.reload(changed)
+    return changed
 
   # @param opts (dict) potential opt:value paris to check for existence
   def __exists(self,opts):
@@ -481,14 +629,19 @@ class Config(object):
   def __post(self,opts):
     """allow opts to run code to check the values of other opts"""
 
+    # let post funcs see current values of opts we aren't reloading
+    view = self.opts.copy()
+    view.update(opts)
+
     for opt in opts.keys():
       func = self.OPTS[opt][self.POST]
       if func:
         try:
-          opts[opt] = func(self,opts,opt,opts[opt])
+          opts[opt] = view[opt] = func(self,view,opt,opts[opt])
         except Exception as e:
           self.log('error','Error running post for "%s"; using default=%s' %
               (opt,self.opts[opt]))
+          view[opt] = self.opts[opt]
           del opts[opt]
 
   def write_default_conf(self):
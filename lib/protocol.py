@@ -32,7 +32,7 @@
 ################################################################################
 
 from abc import ABCMeta,abstractmethod
-import os,sys,inspect
+import os,sys,inspect,weakref,threading
 
 ################################################################################
 # Custom exceptions
@@ -53,6 +53,63 @@ class AuthFailure(ProtocolError):
 class ServerShutdown(ProtocolError):
   pass
 
+################################################################################
+# Pickling helpers
+################################################################################
+
+# @param obj (User,Room,Message) the object to pickle
+# @return (dict) all attributes of obj, including those in __slots__
+def get_state(obj):
+  """return obj's attributes for pickling, replacing protocol with its name"""
+
+  # subclasses in third-party protocols might not define __slots__
+  state = dict(getattr(obj,'__dict__',{}))
+  for cls in type(obj).__mro__:
+    slots = cls.__dict__.get('__slots__',())
+    if isinstance(slots,basestring):
+      slots = (slots,)
+    for name in slots:
+      if name not in ('__dict__','__weakref__') and hasattr(obj,name):
+        state[name] = getattr(obj,name)
+
+  # don't pickle the protocol; sibylbot will fix it in its persistence code
+  state['protocol'] = obj.protocol.get_name()
+  return state
+
+# @param obj (User,Room,Message) the object being unpickled
+# @param state (dict) the attributes returned by get_state()
+def set_state(obj,state):
+  """restore obj's attributes after unpickling"""
+
+  for (name,val) in state.items():
+    setattr(obj,name,val)
+
+# protocols create Users and Rooms from their own threads, so guard both the
+# intern tables and __init__ to never hand out a half-parsed object
+INTERN_LOCK = threading.RLock()
+
+# @param cls (type) the User or Room subclass being created
+# @param proto (Protocol) the associated protocol
+# @param key (tuple) the arguments identifying the new object
+# @return (User,Room) an existing object with the same key or a new one
+def get_interned(cls,proto,key):
+  """return the live instance of cls for key if one exists"""
+
+  # unpickling calls __new__ without args; also allow unhashable identifiers
+  table = getattr(proto,'_interned',None)
+  if table is None:
+    return object.__new__(cls)
+  key = (cls,)+key
+  with INTERN_LOCK:
+    try:
+      obj = table.get(key)
+    except TypeError:
+      return object.__new__(cls)
+
+    if obj is None:
+      obj = table[key] = object.__new__(cls)
+    return obj
+
 ################################################################################
 # User abstract class
 ################################################################################
@@ -60,6 +117,9 @@ class ServerShutdown(ProtocolError):
 class User(object):
   __metaclass__ = ABCMeta
 
+  # subclasses should list any attributes they set in parse() in __slots__
+  __slots__ = ('protocol','typ','real','__weakref__')
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = (Protocol) name of this User's protocol as a str
   #   self.typ = (int) either Message.PRIVATE or Message.GROUP
@@ -93,15 +153,39 @@ class User(object):
   def __repr__(self):
     return '<%s %s>' % (self.__class__.__name__,str(self))
 
+  # identical users share one instance per protocol (see Protocol._interned)
+  # @param proto (Protocol) the associated protocol
+  # @param user (object) a user id to parse
+  # @param typ (int) [Message.PRIVATE] either Message.GROUP or Message.PRIVATE
+  # @param real (User) [None] the "real" user behind this user
+  def __new__(cls,proto=None,user=None,typ=None,real=None):
+    typ = (Message.PRIVATE if typ is None else typ)
+    return get_interned(cls,proto,(user,typ))
+
   # @param proto (Protocol) the associated protocol
   # @param user (object) a user id to parse
   # @param typ (int) [Message.PRIVATE] either Message.GROUP or Message.PRIVATE
   # @param real (User) [self] the "real" user behind this user
   def __init__(self,proto,user,typ=None,real=None):
-    self.protocol = proto
-    self.typ = (Message.PRIVATE if typ is None else typ)
-    self.real = (real or self)
-    self.parse(user)
+
+    with INTERN_LOCK:
+
+      # already parsed; the "real" User isn't part of the key, so never keep
+      # one from an earlier call (e.g. the last person to use a MUC nick)
+      if hasattr(self,'protocol'):
+        self.real = (real or self)
+        return
+
+      self.protocol = proto
+      self.typ = (Message.PRIVATE if typ is None else typ)
+      self.real = (real or self)
+
+      # don't leave a half-built object in the intern table
+      try:
+        self.parse(user)
+      except:
+        del self.protocol
+        raise
 
   # @return (int) the type of this User (Message class type enum)
   def get_type(self):
@@ -145,9 +229,10 @@ class User(object):
 
   # don't pickle the protocol; sibylbot will fix it in its persistence code
   def __getstate__(self):
-    odict = self.__dict__.copy()
-    odict['protocol'] = self.protocol.get_name()
-    return odict
+    return get_state(self)
+
+  def __setstate__(self,state):
+    set_state(self,state)
 
 ################################################################################
 # Room class
@@ -156,6 +241,9 @@ class User(object):
 class Room(object):
   __metaclass__ = ABCMeta
 
+  # subclasses should list any attributes they set in parse() in __slots__
+  __slots__ = ('protocol','nick','pword','__weakref__')
+
   # get_room flags
   FLAG_CONF = 0
   FLAG_RUNTIME = 1
@@ -189,15 +277,36 @@ class Room(object):
   def __eq__(self,other):
     pass
 
+  # identical rooms share one instance per protocol (see Protocol._interned)
+  # @param proto (Protocol) the associated protocol
+  # @param name (object) the identifier for this Room
+  # @param nick (str) [None] the nick name to use in this Room
+  # @param pword (str) [None] the password for joining this Room
+  def __new__(cls,proto=None,name=None,nick=None,pword=None):
+    return get_interned(cls,proto,(name,nick,pword))
+
   # @param proto (Protocol) the associated protocol
   # @param name (object) the identifier for this Room
   # @param nick (str) [None] the nick name to use in this Room
   # @param pword (str) [None] the password for joining this Room
   def __init__(self,proto,name,nick=None,pword=None):
-    self.protocol = proto
-    self.nick = nick
-    self.pword = pword
-    self.parse(name)
+
+    with INTERN_LOCK:
+
+      # already parsed
+      if hasattr(self,'protocol'):
+        return
+
+      self.protocol = proto
+      self.nick = nick
+      self.pword = pword
+
+      # don't leave a half-built object in the intern table
+      try:
+        self.parse(name)
+      except:
+        del self.protocol
+        raise
 
   # @return (Protocol) the protocol associated with this Room
   def get_protocol(self):
@@ -245,9 +354,10 @@ class Room(object):
 
   # don't pickle the protocol; sibylbot will fix it in its persistence code
   def __getstate__(self):
-    odict = self.__dict__.copy()
-    odict['protocol'] = self.protocol.get_name()
-    return odict
+    return get_state(self)
+
+  def __setstate__(self,state):
+    set_state(self,state)
 
 ################################################################################
 # Message class
@@ -255,6 +365,10 @@ class Room(object):
 
 class Message(object):
 
+  # there can be a lot of these queued up, so avoid a __dict__ per instance
+  __slots__ = ('protocol','typ','status','txt','user','msg','room','to',
+      'broadcast','users','hook','emote')
+
   # Type enums
   STATUS = 0
   PRIVATE = 1
@@ -394,9 +508,10 @@ class Message(object):
 
   # don't pickle the protocol; sibylbot will fix it in its persistence code
   def __getstate__(self):
-    odict = self.__dict__.copy()
-    odict['protocol'] = self.protocol.get_name()
-    return odict
+    return get_state(self)
+
+  def __setstate__(self,state):
+    set_state(self,state)
 
 ################################################################################
 # Protocol abstract class
@@ -466,6 +581,7 @@ class Protocol(object):
 
   # helper function for get_rooms() for protocol-specific flags
   # only needs to handle: FLAG_PARTED, FLAG_PENDING, FLAG_IN, FLAG_ALL
+  # results are cached, so call self._rooms_changed() when they might change
   # @param flag (int) one of Room.FLAG_* enums
   # @return (list of Room) rooms matching the flag
   @abstractmethod
@@ -526,6 +642,10 @@ class Protocol(object):
     self.bot = bot
     self.log = log
     self.status = Protocol.INIT
+    self.__rooms = None
+
+    # Users and Rooms with identical args share an instance while it's alive
+    self._interned = weakref.WeakValueDictionary()
 
     self.ProtocolError = type(
         'ProtocolError',
@@ -567,10 +687,25 @@ class Protocol(object):
   def get_name(self):
     return self.__module__.split('_')[1]
 
+  # send several messages in order; override this if the protocol can batch
+  # before raising, remove msgs that were definitely sent from the front of the
+  # list; sibyl will defer and resend whatever is left
+  # @param msgs (list of Message) messages to be sent (never broadcasts)
+  # @raise (ConnectFailure) if failed to send messages
+  def send_many(self,msgs):
+    """send each message with send()"""
+
+    for (i,msg) in enumerate(msgs):
+      try:
+        self.send(msg)
+      except:
+        del msgs[:i]
+        raise
+
   # @param room (Room) the room to check
   # @return (bool) whether we are currently connected and in the room
   def in_room(self,room):
-    return room in self.get_rooms()
+    return room in self.__lookup([Room.FLAG_IN])
 
   # @param flags (int, list of int) Room.FLAG_* enum(s)
   # @return (list of Room) the Rooms matching all given flags (i.e. AND)
@@ -581,14 +716,43 @@ class Protocol(object):
       flags = [Room.FLAG_IN]
     elif not isinstance(flags,list):
       flags = [flags]
+
+    return list(self.__lookup(flags))
+
+  # must be called by the protocol whenever the rooms returned by _get_rooms()
+  # might have changed, e.g. after a join, part, kick, or disconnect
+  def _rooms_changed(self):
+    """invalidate the room membership index"""
+
+    self.__rooms = None
+
+  # @param flags (list of int) Room.FLAG_* enums
+  # @return (frozenset of Room) the Rooms matching all given flags
+  def __lookup(self,flags):
+    """return rooms from the membership index, building it if needed"""
+
+    # keep a local reference in case a protocol thread invalidates the index
+    index = self.__rooms
+    if index is None:
+      index = self.__rooms = {}
+
+    key = tuple(flags)
+    if key not in index:
+      index[key] = frozenset(self.__get_rooms(flags))
+    return index[key]
+
+  # @param flags (list of int) Room.FLAG_* enums
+  # @return (set of Room) the Rooms matching all given flags
+  def __get_rooms(self,flags):
+    """query the protocol for rooms matching all flags"""
+
     rooms = set(self._get_rooms(Room.FLAG_ALL))
 
     for flag in flags:
 
       if flag in (Room.FLAG_CONF,Room.FLAG_RUNTIME):
-        pname = self.get_name()
-        conf = [Room(room['room'],proto=pname) for room in
-          self.opt('rooms').get(pname,[])]
+        conf = [self.new_room(room['room']) for room in
+          self.opt('rooms').get(self.get_name(),[])]
         if flag==Room.FLAG_CONF:
           rooms.intersection_update(conf)
         elif flag==Room.FLAG_RUNTIME:
@@ -601,7 +765,7 @@ class Protocol(object):
       else:
         rooms.intersection_update(self._get_rooms(flag))
 
-    return list(rooms)
+    return rooms
 
   # @param rooms (set) set to add rooms to
   # @param flags (list of int) list of Room.FLAG_* enums
@@ -43,7 +43,7 @@ from sibyl.lib.config import Config
 from sibyl.lib.protocol import Protocol,Message,Room,User
 from sibyl.lib.protocol import (ProtocolError,PingTimeout,ConnectFailure,
     AuthFailure,ServerShutdown)
-from sibyl.lib.decorators import botcmd,botrooms,botcon
+from sibyl.lib.decorators import botcmd,botrooms,botcon,botidle
 import sibyl.lib.util as util
 from sibyl.lib.thread import SmartThread
 
@@ -95,6 +95,10 @@ class SibylBot(object):
     self.ns_func = {}
     self.ns_cmd = {}
 
+    # keep track of where plugins live so they can be reloaded at runtime
+    self.__plugin_dirs = {}
+    self.__carry = {}
+
     # load config to get cmd_dir and protocols
     self.conf_file = conf_file
     (result,dup_plugins,duplicates) = self.__init_config()
@@ -297,6 +301,7 @@ class SibylBot(object):
           continue
 
         mods[f] = mod
+        self.__plugin_dirs[f] = d
         success = (self.__load_funcs(mod,f) and success)
       else:
         self.log.debug('Skipping plugin "%s" (disabled in config)' % f)
@@ -422,6 +427,42 @@ class SibylBot(object):
           self.log.error('Error unpickling persistence; unknown protocol "%s"'
               % obj.protocol)
 
+  # @param name (str) name of the plugin to unload
+  # @param down (bool) [True] run the plugin's @botdown hooks first
+  def __unload_plugin(self,name,down=True):
+    """remove all hooks, funcs, vars, and config opts added by a plugin"""
+
+    # let the plugin clean up (e.g. stop its threads) before we drop its hooks
+    if down:
+      self.__run_plugin_hooks(name,'down')
+
+    # chat cmds registered at runtime may use a sub-namespace (room.trigger)
+    owned = (lambda ns: ns==name or ns.startswith(name+'.'))
+
+    for (hook,dic) in self.hooks.items():
+      for fname in dic.keys():
+        if hook=='chat':
+          if owned(self.ns_cmd.get(fname,'')):
+            del dic[fname]
+            del self.ns_cmd[fname]
+        elif fname.startswith(name+'.'):
+          del dic[fname]
+          self.__idle_last.pop(fname,None)
+          self.__idle_count.pop(fname,None)
+
+    for fname in [f for (f,ns) in self.ns_func.items() if ns==name]:
+      delattr(self,fname)
+      del self.ns_func[fname]
+
+    # add_var() hands these back to the plugin when its @botinit runs again
+    for var in [v for (v,ns) in self.ns_opt.items() if ns==name]:
+      self.__carry[var] = getattr(self,var)
+      delattr(self,var)
+      del self.ns_opt[var]
+
+    self.conf.del_opts(name)
+    self.log.debug('  Unloaded plugin "%s"' % name)
+
   def __run_hooks(self,hook,*args):
     """run and log the specified hooks passing args; don't use for idle hooks"""
 
@@ -441,6 +482,24 @@ class SibylBot(object):
 
     return errors
 
+  def __run_plugin_hooks(self,plugin,hook,*args):
+    """run and log the specified hooks but only from the given plugin"""
+
+    errors = {}
+
+    for (name,func) in self.hooks[hook].items():
+      if not name.startswith(plugin+'.'):
+        continue
+      self.log.debug('Running %s hook: %s' % (hook,name))
+
+      try:
+        func(self,*args)
+      except Exception as e:
+        self.log_ex(e,'Exception running %s hook %s:' % (hook,name))
+        errors[name] = e
+
+    return errors
+
   def __run_idle(self):
     """run all idle hooks"""
 
@@ -626,6 +685,7 @@ class SibylBot(object):
     """execute callbacks on successfull MUC join"""
 
     self.log.info('Success joining room "%s"' % room)
+    room.get_protocol()._rooms_changed()
     self.__run_hooks('rooms',room)
 
   # @param room (str) the room we failed to join
@@ -634,6 +694,7 @@ class SibylBot(object):
     """execute callbacks on successfull MUC join"""
 
     self.log.error('Error joining room "%s" (%s)' % (room,error))
+    room.get_protocol()._rooms_changed()
     self.__run_hooks('roomf',room,error)
 
 ################################################################################
@@ -938,6 +999,24 @@ class SibylBot(object):
       return 'No matching errors'
     return util.list2str(matches, fmt=(lambda x:'[%s] %s' % x))
 
+  @staticmethod
+  @botcmd(name='plugin',ctrl=True)
+  def __plugin(self,mess,args):
+    """list or reload plugins - plugin [list|reload name]"""
+
+    if not args or args[0]=='list':
+      return 'Plugins: %s' % ', '.join(self.plugins)
+
+    if args[0]!='reload':
+      return 'Unknown option "%s"' % args[0]
+    if len(args)<2:
+      return 'You must specify a plugin to reload'
+
+    error = self.reload_plugin(args[1])
+    if error:
+      return 'Failed to reload plugin "%s" (%s)' % (args[1],error)
+    return 'Reloaded plugin "%s"' % args[1]
+
   @staticmethod
   @botcmd(name='stats')
   def __stats_cmd(self,mess,args):
@@ -1050,6 +1129,16 @@ class SibylBot(object):
     if not self.__tell_rooms:
       self.del_hook(self.__tell_errors)
 
+  @staticmethod
+  @botidle
+  def __watch_conf(self):
+    """apply edits to the config file without rebooting"""
+
+    if self.opt('conf_watch'):
+      changed = self.conf.watch()
+      if changed:
+        self.log.info('Reloaded opts from config file: %s' % ','.join(changed))
+
   def __serve(self):
     """process loop - connect and process messages"""
 
@@ -1177,27 +1266,83 @@ class SibylBot(object):
               del self.ns_cmd[name]
 
   def __idle_send(self):
-    """send queued messages synchronously"""
+    """send queued messages synchronously, batching them per protocol"""
+
+    batches = collections.OrderedDict()
+    errors = []
 
     while not self.__pending_send.empty():
+      msg = self.__pending_send.get()
+      proto = msg.get_protocol()
+      to = msg.get_to()
       try:
-        msg = self.__pending_send.get()
-        proto = msg.get_protocol()
-        to = msg.get_to()
         if (proto.is_connected() and
             (isinstance(to,User) or proto.in_room(to))):
-          self.__send(msg)
-        else:
-          if isinstance(to,User) or to in proto.get_rooms(Room.FLAG_ACTIVE):
-            self.__defer(msg)
+
+          # broadcasts aren't batched, so flush first to keep msgs in order
+          if msg.get_broadcast():
+            errors.append(self.__send_batch(proto,batches.pop(proto,[])))
+            self.__send(msg)
           else:
-            self.log.warning('Attempted to send to inactive Room "%s"' % to)
+            batches.setdefault(proto,[]).append(msg)
+
+        elif isinstance(to,User) or to in proto.get_rooms(Room.FLAG_ACTIVE):
+          self.__defer(msg)
+        else:
+          self.log.warning('Attempted to send to inactive Room "%s"' % to)
       except ProtocolError as e:
         self.__defer(msg)
-        if msg.get_protocol().is_connected():
-          raise e
+        if proto.is_connected():
+          errors.append(e)
       except Exception as e:
-        self.log_ex(e,'Error sending %s msg' % msg.get_protocol().get_name())
+        self.log_ex(e,'Error sending %s msg' % proto.get_name())
+
+    for (proto,msgs) in batches.items():
+      errors.append(self.__send_batch(proto,msgs))
+
+    # let __run_forever() handle disconnects after every batch was attempted
+    for e in errors:
+      if e:
+        raise e
+
+  # @param proto (Protocol) the protocol to send with
+  # @param msgs (list of Message) the msgs to send (not broadcasts)
+  # @return (ProtocolError,None) an error to raise if still connected
+  def __send_batch(self,proto,msgs):
+    """send a batch of messages with send_many() and run @botsend hooks"""
+
+    if not msgs:
+      return None
+
+    sent = []
+    error = None
+    while msgs:
+
+      # send_many() leaves only unsent msgs in batch
+      batch = msgs[:]
+      try:
+        proto.send_many(batch)
+        batch = []
+      except ProtocolError as e:
+        for msg in batch:
+          self.__defer(msg)
+        if proto.is_connected():
+          error = e
+
+      # drop the msg that failed and send the rest right away to keep order
+      except Exception as e:
+        self.log_ex(e,'Error sending %s msg' % proto.get_name())
+        sent.extend(msgs[:len(msgs)-len(batch)])
+        msgs = batch[1:]
+        continue
+
+      sent.extend(msgs[:len(msgs)-len(batch)])
+      break
+
+    for msg in sent:
+      if msg.get_hook() and msg.get_text():
+        self.__run_hooks('send',msg)
+    return error
 
   @staticmethod
   @botcon
@@ -1249,7 +1394,8 @@ class SibylBot(object):
     if self.opt('persistence'):
       d = {}
       for name in self.__persist:
-        d[name] = getattr(self,name)
+        if hasattr(self,name):
+          d[name] = getattr(self,name)
       with open(self.opt('state_file'),'wb') as f:
         pickle.dump(d,f,-1)
 
@@ -1346,13 +1492,96 @@ class SibylBot(object):
           % (caller,name,space))
       raise DuplicateVarError
 
-    if self.opt('persistence') and persist:
+    # plugins being reloaded get their old values back instead of defaults
+    if name in self.__carry:
+      val = self.__carry.pop(name)
+    elif self.opt('persistence') and persist:
       val = self.__state.get(name,val)
+
+    if self.opt('persistence') and persist and name not in self.__persist:
       self.__persist.append(name)
 
     setattr(self,name,val)
     self.ns_opt[name] = caller
 
+  # must be called from the main thread (e.g. a non-threaded chat cmd)
+  # @param name (str) name of the plugin to reload (e.g. "library")
+  # @return (str,None) error message if there was one
+  def reload_plugin(self,name):
+    """re-import a plugin and re-register its hooks without disconnecting"""
+
+    if name not in self.__plugin_dirs:
+      return 'no such plugin'
+
+    self.log.info('Reloading plugin "%s"' % name)
+
+    # import a fresh module instead of re-executing the old one in place, so
+    # the old version (and its functions' globals) are intact if we need it
+    old = sys.modules.pop(name,None)
+
+    self.__unload_plugin(name)
+    if name in self.plugins:
+      self.plugins.remove(name)
+
+    try:
+      mod = util.load_module(name,self.__plugin_dirs[name])
+    except Exception as e:
+      self.log_ex(e,'Error loading plugin "%s"' % name)
+      error = 'import failed'
+    else:
+      error = self.__register_plugin(name,mod)
+
+    # put the old version back so the plugin (and its vars) aren't lost;
+    # the new version never ran @botinit so don't run its @botdown either
+    if error:
+      self.__unload_plugin(name,down=False)
+      if old is not None:
+        self.log.warning('Restoring previous version of plugin "%s"' % name)
+        sys.modules[name] = old
+        self.__register_plugin(name,old)
+
+    self.plugins = sorted(self.plugins+[name])
+    errors = self.__run_plugin_hooks(name,'init')
+
+    # anything the new version didn't ask for again is gone for good
+    self.__carry = {}
+
+    if error:
+      return error
+    if errors:
+      return 'exception in @botinit'
+    return None
+
+  # @param name (str) name of the plugin
+  # @param mod (module) the plugin's module
+  # @return (str,None) error message if there was one
+  def __register_plugin(self,name,mod):
+    """register a plugin's config opts and hooks for reload_plugin()"""
+
+    for dep in getattr(mod,'__depends__',[]):
+      if dep not in self.plugins:
+        self.log.error('Missing dependency "%s" from plugin "%s"' % (dep,name))
+        return 'missing dependency "%s"' % dep
+
+    # register config opts and read their values from the config file
+    if not self.__load_conf(mod,name):
+      return 'duplicate config opts'
+    for (opt,ns) in self.conf.NS.items():
+      if ns==name:
+        self.conf.opts[opt] = self.conf.OPTS[opt][Config.DEF]
+        for (lvl,msg) in self.conf.reload_opt(opt):
+          self.log.warning('  %s' % msg)
+
+    if not self.__load_funcs(mod,name):
+      return 'duplicate @botcmd or @botfunc'
+
+    for (old,new) in self.opt('rename').items():
+      if self.ns_cmd.get(old)==name:
+        self.hooks['chat'][new] = self.hooks['chat'].pop(old)
+        self.ns_cmd[new] = self.ns_cmd.pop(old)
+
+    return None
+
   # @param cmd (str) name of chat cmd to run
   # @param args (list) [None] arguments to pass to the command
   # @param mess (Message) [None] message to pass to the command
@@ -20,7 +20,13 @@
 #
 ################################################################################
 
-import os,requests,json,imp,inspect
+import os,time,threading,Queue,requests,json,imp,inspect
+
+# the scandir module is the Python 2 backport of os.scandir()
+try:
+  from scandir import scandir
+except ImportError:
+  scandir = None
 
 # @param s (str) the string to split
 # @param sep (str) [' '] the string on which to split
@@ -234,6 +240,164 @@ def rlistdir(path,symlinks=True):
       files.append(os.path.join(cur_path,filename))
   return (dirs,files)
 
+# @param path (str,unicode) a local directory
+# @param cache (dict) [None] the cache returned by a previous call for path
+# @param symlinks (bool) [True] descend into symlinked directories
+# @param threads (int) [1] number of directories to list at once
+# @return tuple(list,list,dict) all (dirs,files) in given directory (recursive)
+#   and a cache of {dir:(mtime,dirnames,filenames)} to pass in next time
+# @raise (Exception) if there was an error other than OSError while listing
+def rlistdir_cached(path,cache=None,symlinks=True,threads=1):
+  """list folders recursively, only re-reading changed directories"""
+
+  result = rlistdirs([path],{path:cache},symlinks,threads)[path]
+  if isinstance(result,Exception):
+    raise result
+  return result
+
+# @param paths (list of str,unicode) local directories
+# @param caches (dict) [None] {path:cache} from previous calls for each path
+# @param symlinks (bool) [True] descend into symlinked directories
+# @param threads (int) [8] number of directories to list at once
+# @return (dict) {path:(dirs,files,cache)} like rlistdir_cached() for each path
+#   or {path:Exception} if there was an error other than OSError while listing
+def rlistdirs(paths,caches=None,symlinks=True,threads=8):
+  """list several folders recursively using a thread pool"""
+
+  # listing is mostly waiting on the disk (or network) and releases the GIL,
+  # so workers list directories from every path at once and stream them back
+  caches = (caches or {})
+  work = Queue.Queue()
+  done = Queue.Queue()
+  workers = []
+  for i in range(max(threads,1)):
+    t = threading.Thread(target=_rlistdirs_worker,args=(work,done,symlinks))
+    t.daemon = True
+    t.start()
+    workers.append(t)
+
+  listings = {}
+  for path in paths:
+    listings[path] = {}
+    work.put((path,path,caches.get(path) or {}))
+  pending = len(paths)
+
+  try:
+    while pending:
+      (path,cur_path,listing) = done.get()
+      pending -= 1
+      if isinstance(listing,Exception):
+        listings[path] = listing
+      if listing is None or isinstance(listings[path],Exception):
+        continue
+
+      (mtime,dirnames,filenames,descend) = listing
+      listings[path][cur_path] = (mtime,dirnames,filenames)
+      for dirname in descend:
+        work.put((path,os.path.join(cur_path,dirname),caches.get(path) or {}))
+        pending += 1
+  finally:
+    for t in workers:
+      work.put(None)
+    for t in workers:
+      t.join()
+
+  # put everything back in the same order as os.walk(topdown=True)
+  result = {}
+  for (path,listing) in listings.items():
+    if isinstance(listing,Exception):
+      result[path] = listing
+      continue
+
+    dirs = []
+    files = []
+    stack = [path]
+    while stack:
+      cur_path = stack.pop()
+      if cur_path not in listing:
+        continue
+      (mtime,dirnames,filenames) = listing[cur_path]
+
+      # same as os.path.join() but a lot faster for a million files
+      prefix = (cur_path if cur_path.endswith(os.path.sep)
+          else cur_path+os.path.sep)
+      dirs.extend([prefix+d+os.path.sep for d in dirnames])
+      files.extend([prefix+f for f in filenames])
+      stack.extend([prefix+d for d in reversed(dirnames)])
+    result[path] = (dirs,files,listing)
+
+  return result
+
+# @param work (Queue) (path,cur_path,cache) to list or None to exit
+# @param done (Queue) (path,cur_path,listing) where listing is None on OSError
+def _rlistdirs_worker(work,done,symlinks):
+  """list directories for rlistdirs()"""
+
+  while True:
+    item = work.get()
+    if item is None:
+      return
+    (path,cur_path,cache) = item
+    try:
+      done.put((path,cur_path,_rlistdir_one(cur_path,cache,symlinks)))
+    except Exception as e:
+      done.put((path,cur_path,e))
+
+# @param cur_path (str,unicode) a local directory
+# @param cache (dict) the cache for the path cur_path is in
+# @param symlinks (bool) descend into symlinked directories
+# @return (tuple) (mtime,dirnames,filenames,descend) or None on OSError
+def _rlistdir_one(cur_path,cache,symlinks):
+  """list a single directory, reusing the cache if it hasn't changed"""
+
+  # a directory's mtime changes when entries are added, removed, or renamed,
+  # so if it hasn't changed we can reuse its old listing instead of checking
+  # every entry to see if it's a directory; subdirectories still need a stat
+  # since changes deeper in the tree don't touch their parents' mtimes
+  try:
+    mtime = os.stat(cur_path).st_mtime
+    old = cache.get(cur_path)
+    if old and old[0] is not None and old[0]==mtime:
+      (dirnames,filenames) = old[1:]
+    else:
+      (dirnames,filenames) = listdir(cur_path)
+  except OSError:
+    return None
+
+  # coarse mtimes (e.g. 2 sec on FAT) can hide a change made right after we
+  # listed the directory, so recently modified ones get re-read next time
+  if time.time()-mtime<2:
+    mtime = None
+
+  descend = dirnames
+  if not symlinks:
+    descend = [d for d in dirnames
+        if not os.path.islink(os.path.join(cur_path,d))]
+  return (mtime,dirnames,filenames,descend)
+
+# @param path (str,unicode) a local directory
+# @return tuple(list,list) the (dirnames,filenames) in path like os.walk()
+# @raise (OSError) if the directory can't be listed
+def listdir(path):
+  """list a directory, using scandir to avoid a stat per entry if available"""
+
+  dirnames = []
+  filenames = []
+
+  # scandir gets the type from the directory itself (d_type) on most systems
+  if scandir:
+    for entry in scandir(path):
+      (dirnames if entry.is_dir() else filenames).append(entry.name)
+    return (dirnames,filenames)
+
+  prefix = (path if path.endswith(os.path.sep) else path+os.path.sep)
+  for name in os.listdir(path):
+    if os.path.isdir(prefix+name):
+      dirnames.append(name)
+    else:
+      filenames.append(name)
+  return (dirnames,filenames)
+
 # @param l (list of str) list of search terms
 # @param s (str) the string to test against each search term
 # @return (bool) True if every string in l matches s
@@ -22,7 +22,7 @@
 
 import sys
 from threading import Thread,Event
-from Queue import Queue
+from Queue import Queue,Empty
 
 from sibyl.lib.protocol import User,Room,Message,Protocol
 
@@ -61,12 +61,20 @@ class BufferThread(Thread):
   def run(self):
     """read from stdin, add to the queue, set the event_data Event"""
 
+    # only wait for each line to be processed if a human is typing
+    tty = sys.stdin.isatty()
+
     while True:
-      self.event_proc.wait()
+      if tty:
+        self.event_proc.wait()
       if self.event_close.is_set():
         break
-      sys.__stdout__.write(USER+': ')
-      s = raw_input()
+      if tty:
+        sys.__stdout__.write(USER+': ')
+      try:
+        s = raw_input()
+      except EOFError:
+        break
       self.event_proc.clear()
       self.queue.put(s)
       self.event_data.set()
@@ -77,6 +85,8 @@ class BufferThread(Thread):
 
 class Admin(User):
 
+  __slots__ = ('user',)
+
   def parse(self,user):
     self.user = user
 
@@ -103,6 +113,8 @@ class Admin(User):
 
 class FakeRoom(Room):
 
+  __slots__ = ('name',)
+
   def parse(self,name):
     self.name = name
 
@@ -139,21 +151,32 @@ class CLI(Protocol):
     self.thread.start()
 
   def process(self):
+    """process queued lines up to proc_budget"""
 
     if not self.event_data.is_set():
       return
 
+    # clear first so a line queued while we're working sets it again
+    self.event_data.clear()
+    budget = self.opt('proc_budget')
     usr = Admin(self,USER)
-    text = self.queue.get()
 
-    if self.special_cmds(text):
-      return
+    n = 0
+    while budget<1 or n<budget:
+      try:
+        text = self.queue.get_nowait()
+      except Empty:
+        break
+      n += 1
 
-    msg = Message(usr,text)
-    self.bot._cb_message(msg)
+      if self.special_cmds(text):
+        continue
 
-    if self.queue.empty():
-      self.event_data.clear()
+      self.bot._cb_message(Message(usr,text))
+
+    # we ran out of budget, so make sure we come back next time
+    if 0<budget<=n:
+      self.event_data.set()
 
     if self.bot._SibylBot__finished:
       self.event_close.set()
@@ -20,12 +20,13 @@
 #
 ################################################################################
 
-import time,smtplib,imaplib,email
+import time,smtplib,imaplib,email,re,socket,traceback
 from email.mime.text import MIMEText
-from threading import Thread
+from threading import Thread,Condition,Lock
 from Queue import Queue
+from collections import deque
 
-from sibyl.lib.protocol import User,Room,Message,Protocol
+from sibyl.lib.protocol import User,Room,Message,Protocol,ProtocolError
 
 from sibyl.lib.decorators import botconf
 
@@ -39,8 +40,11 @@ def conf(bot):
     {'name':'username','req':True},
     {'name':'password','req':True},
     {'name':'delete','default':True,'parse':bot.conf.parse_bool},
+    {'name':'expunge','default':1,'parse':bot.conf.parse_int},
+    {'name':'fetch_bytes','default':4096,'parse':bot.conf.parse_int},
     {'name':'imap'},
     {'name':'smtp'},
+    {'name':'smtp_idle','default':60,'parse':bot.conf.parse_int},
     {'name':'key','parse':bot.conf.parse_pass}
   ]
 
@@ -50,6 +54,8 @@ def conf(bot):
 
 class MailUser(User):
 
+  __slots__ = ('user',)
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = (Protocol) name of this User's protocol as a str
   #   self.typ = (int) either Message.PRIVATE or Message.GROUP
@@ -83,6 +89,8 @@ class MailUser(User):
 
 class MailRoom(Room):
 
+  __slots__ = ('name',)
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = name of this Room's protocol as a str
   #   self.nick = the nick name to use in the room (defaults to None)
@@ -117,6 +125,9 @@ class MailProtocol(Protocol):
     self.thread = IMAPThread(self)
     self.thread.start()
 
+    self.sender = SMTPThread(self)
+    self.sender.start()
+
   # @raise (ConnectFailure) if can't connect to server
   # @raise (AuthFailure) if failed to authenticate to server
   def connect(self):
@@ -157,8 +168,9 @@ class MailProtocol(Protocol):
       body = mail.get_payload()
       if isinstance(body,list):
         for b in body:
-          if b.get_content_type()=='plain':
-            body = b.replace('\r','').strip()
+          if b.get_content_type()=='text/plain':
+            body = b.get_payload().replace('\r','').strip()
+            break
       if isinstance(body,list):
         self.log.warning('Ignoring multi-part from "%s"; no plaintext' % frm)
         self._send('Unable to process multi-part message; no plaintext',user)
@@ -182,7 +194,7 @@ class MailProtocol(Protocol):
   # called when the bot is exiting for whatever reason
   # NOTE: sibylbot will already call part_room() on every room in get_rooms()
   def shutdown(self):
-    pass
+    self.sender.stop()
 
   # send a message to a user
   # @param mess (Message) message to be sent
@@ -190,23 +202,14 @@ class MailProtocol(Protocol):
   # Check: get_emote()
   # REF: http://stackoverflow.com/a/14678470
   def send(self,mess):
+    self.send_many([mess])
 
-    (text,to) = (mess.get_text(),mess.get_to())
+  # queue several messages for the SMTPThread, which never blocks on the network
+  # @param msgs (list of Message) messages to be sent
+  def send_many(self,msgs):
 
-    # SMTP connections are short-lived, so we might need to reconnect
-    try:
-      status = self.smtp.noop()[0]
-    except:
-      status = -1
-    if status!=250:
-      self._connect_smtp()
-
-    msg = MIMEText(text)
-    msg['Subject'] = 'Sibyl reply'
-    msg['From'] = self.opt('email.username')
-    msg['To'] = str(to)
-
-    self.smtp.sendmail(msg['From'],msg['To'],msg.as_string())
+    for mess in msgs:
+      self.sender.put(str(mess.get_to()),mess.get_text())
 
   # send a message with text to every user in a room
   # optionally note that the broadcast was requested by a specific User
@@ -279,20 +282,7 @@ class MailProtocol(Protocol):
 
   # convenience function for connecting to the SMTP server
   def _connect_smtp(self):
-
-    # all major email providers support SSL, so use it
-    try:
-      self.smtp = smtplib.SMTP(self._get_smtp(),port=587)
-      self.smtp.starttls()
-      self.smtp.ehlo()
-    except:
-      raise self.ConnectFailure('SMTP')
-
-    # if the protocol raises AuthFailure, SibylBot will never try to reconnect
-    try:
-      self.smtp.login(self.opt('email.username'),self.opt('email.password'))
-    except:
-      raise self.AuthFailure('SMTP')
+    self.sender.connect()
 
   # convenience wrapper for sending stuff
   def _send(self,text,to):
@@ -312,6 +302,45 @@ class MailProtocol(Protocol):
     server = self.opt('email.username').split('@')[-1]
     return (self.opt('email.smtp') or ('smtp.'+server))
 
+################################################################################
+# IMAP FETCH parsing
+################################################################################
+
+FETCH_START = re.compile(r'^\d+ \(')
+FETCH_UID = re.compile(r'UID (\d+)')
+FETCH_FLAGS = re.compile(r'FLAGS \(([^)]*)\)')
+FETCH_LITERAL = re.compile(r'(BODY\[[^\]]*\](?:<\d+>)?) \{\d+\}$')
+
+# imaplib returns each message as a mix of (text,literal) tuples and strings
+# e.g. [('1 (UID 7 BODY[HEADER] {342}','...'),(' BODY[TEXT]<0> {99}','...'),')']
+# @param data (list) the data imaplib returned for a FETCH command
+# @return (list of tuple) (uid,flags,sections) for every message where
+#   sections is a dict like {'BODY[HEADER]':'...'}
+def parse_fetch(data):
+
+  msgs = []
+  for item in data:
+    (text,literal) = (item if isinstance(item,tuple) else (item,None))
+    if FETCH_START.match(text):
+      msgs.append(['',{}])
+    if not msgs:
+      continue
+
+    msgs[-1][0] += text
+    if literal is not None:
+      match = FETCH_LITERAL.search(text)
+      if match:
+        msgs[-1][1][match.group(1)] = literal
+
+  result = []
+  for (text,sections) in msgs:
+    uid = FETCH_UID.search(text)
+    flags = FETCH_FLAGS.search(text)
+    if uid:
+      result.append((int(uid.group(1)),
+          (flags.group(1).split() if flags else []),sections))
+  return result
+
 ################################################################################
 # IMAPThread class
 ################################################################################
@@ -327,6 +356,12 @@ class IMAPThread(Thread):
     self.imap = None
     self.msgs = Queue()
 
+    # UIDs let us ask for just the messages we haven't seen yet, but they're
+    # only valid as long as the mailbox's UIDVALIDITY stays the same
+    self.uid_validity = None
+    self.last_uid = None
+    self.deleted = 0
+
   # this method is called when doing IMAPThread().start()
   # we will be using IMAP IDLE push notifications as described at:
   #   https://tools.ietf.org/html/rfc2177
@@ -379,6 +414,9 @@ class IMAPThread(Thread):
 
     # we have to specify which Inbox to use, and then enter the IDLE state
     self.imap.select()
+    validity = self.imap.response('UIDVALIDITY')[1][0]
+    if validity!=self.uid_validity:
+      (self.uid_validity,self.last_uid) = (validity,None)
     self.cmd('IDLE')
 
   # @param s (str) the SMTP command to send
@@ -387,17 +425,237 @@ class IMAPThread(Thread):
 
   def get_mail(self):
 
-    # only look at messages that don't have the "\\Seen" flag
-    (status,nums) = self.imap.search('utf8','UNSEEN')
+    # the first time we only know to look for messages that don't have the
+    # "\\Seen" flag, but after that every new message has a higher UID
+    if self.last_uid is None:
+      uids = self.imap.uid('search',None,'UNSEEN')[1][0].split()
+      if not uids:
+        return
+      uids = ','.join(uids)
+    else:
+      uids = '%s:*' % (self.last_uid+1)
+
+    # get every new message with one command, but only the headers and the
+    # start of the body since process() only uses the first line of text
+    query = ('(UID FLAGS BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.%s>)'
+        % self.proto.opt('email.fetch_bytes'))
+    data = self.imap.uid('fetch',uids,query)[1]
+
+    # "n:*" always includes the newest message even if it's older than n
+    new = []
+    for (uid,flags,sections) in parse_fetch(data):
+      if (self.last_uid is not None and uid<=self.last_uid
+          or '\\Seen' in flags):
+        continue
+      mail = (sections.get('BODY[HEADER]','')
+          +sections.get('BODY[TEXT]<0>',''))
+      self.msgs.put(email.message_from_string(mail))
+      new.append(uid)
+
+    if not new:
+      return
+    self.last_uid = max([self.last_uid]+new)
+
+    # PEEK doesn't set "\\Seen" so do it ourselves, and flag messages for
+    # deletion if configured to do so
+    flags = '(\\Seen)'
+    if self.proto.opt('email.delete'):
+      flags = '(\\Seen \\Deleted)'
+      self.deleted += len(new)
+    self.imap.uid('store',','.join([str(x) for x in new]),'+FLAGS',flags)
+
+    # this tells the server to actually delete all flagged messages
+    if self.deleted and self.deleted>=self.proto.opt('email.expunge'):
+      self.imap.expunge()
+      self.deleted = 0
+
+################################################################################
+# SMTPThread class
+################################################################################
+
+class SMTPThread(Thread):
 
-    # get new messages and add them to our Queue
-    for n in nums[0].split(' '):
-      msg = self.imap.fetch(n,'(RFC822)')[1][0][1]
-      self.msgs.put(email.message_from_string(msg))
+  def __init__(self,proto):
 
-      # flag messages for deletion if configured to do so
-      if self.proto.opt('email.delete'):
-        self.imap.store(n,'+FLAGS','\\Deleted')
+    super(SMTPThread,self).__init__()
+    self.daemon = True
 
-    # this tells the server to actually delete all flagged messages
-    self.imap.expunge()
+    self.proto = proto
+    self.log = proto.log
+
+    # the session is shared with connect() on the main thread, so it gets its
+    # own lock; the queue lock is never held during network calls
+    self.smtp = None
+    self.smtp_lock = Lock()
+    self.last = 0
+
+    self.msgs = deque()
+    self.cond = Condition()
+    self.running = True
+    self.failed = False
+
+  # called from the main thread; never blocks on the network
+  # @param to (str) the e-mail address to send to
+  # @param text (str) the body of the e-mail
+  def put(self,to,text):
+    with self.cond:
+      self.msgs.append((to,text))
+      self.cond.notify()
+
+  # wait for queued messages to be sent and then close the session
+  # @param timeout (float) [5] max seconds to wait
+  def stop(self,timeout=5):
+    end = time.time()+timeout
+    with self.cond:
+      while self.msgs and not self.failed and time.time()<end:
+        self.cond.wait(0.1)
+      self.running = False
+      self.cond.notify()
+    self.join(timeout)
+    self.close()
+
+  # also called by MailProtocol.connect() so bad logins are raised right away
+  # @raise (ConnectFailure) if can't connect to server
+  # @raise (AuthFailure) if failed to authenticate to server
+  def connect(self):
+
+    with self.smtp_lock:
+      self.close()
+      self.login()
+
+    with self.cond:
+      self.failed = False
+      self.cond.notify()
+
+  # start a new session; the caller must hold smtp_lock
+  # @raise (ConnectFailure) if can't connect to server
+  # @raise (AuthFailure) if failed to authenticate to server
+  def login(self):
+
+    smtp = self.open()
+
+    # if the protocol raises AuthFailure, SibylBot will never try to reconnect
+    try:
+      smtp.login(self.proto.opt('email.username'),
+          self.proto.opt('email.password'))
+    except:
+      raise self.proto.AuthFailure('SMTP')
+
+    (self.smtp,self.last) = (smtp,time.time())
+
+  # @return (smtplib.SMTP) a new session that still needs to login
+  # @raise (ConnectFailure) if can't connect to server
+  def open(self):
+
+    # all major email providers support SSL, so use it
+    try:
+      smtp = smtplib.SMTP(self.proto._get_smtp(),port=587)
+      smtp.starttls()
+      smtp.ehlo()
+    except:
+      raise self.proto.ConnectFailure('SMTP')
+    return smtp
+
+  # end the current session, if any, without raising
+  def close(self):
+
+    (smtp,self.smtp) = (self.smtp,None)
+    if smtp:
+      try:
+        smtp.quit()
+      except (smtplib.SMTPException,socket.error):
+        smtp.close()
+
+  def run(self):
+
+    while self.running:
+
+      # take everything that's queued so it all goes out over one session
+      with self.cond:
+        if self.msgs and not self.failed:
+          batch = list(self.msgs)
+          self.msgs.clear()
+        else:
+          batch = None
+          self.cond.wait(max(self.last+self.idle()-time.time(),0)
+              if self.smtp else None)
+
+      # servers drop idle sessions anyway, so we might as well say goodbye
+      if batch is None:
+        with self.smtp_lock:
+          if self.smtp and time.time()-self.last>=self.idle():
+            self.log.debug('Closing idle SMTP session')
+            self.close()
+        continue
+
+      # send() handles errors for each message, but the thread must never die
+      try:
+        sent = self.send(batch)
+      except Exception as e:
+        self.log.error('Error in SMTP thread: %s' % e.__class__.__name__)
+        self.log.debug(traceback.format_exc(e))
+        continue
+      if sent<len(batch):
+        with self.cond:
+          self.msgs.extendleft(reversed(batch[sent:]))
+
+  # only read once we have a session, since config opts may not be ready yet
+  # @return (int) seconds to keep an unused session open
+  def idle(self):
+    return self.proto.opt('email.smtp_idle')
+
+  # send messages over the current session, reconnecting lazily
+  # @param batch (list of tuple) the (to,text) messages to send
+  # @return (int) the number of messages sent or dropped from the front
+  def send(self,batch):
+
+    with self.smtp_lock:
+      for (i,(to,text)) in enumerate(batch):
+
+        try:
+          if isinstance(text,unicode):
+            text = text.encode('utf8')
+          msg = MIMEText(text,'plain','utf-8')
+          msg['Subject'] = 'Sibyl reply'
+          msg['From'] = self.proto.opt('email.username')
+          msg['To'] = to
+        except Exception as e:
+          self.log.error('Dropping mail to "%s" (%s)' % (to,e))
+          continue
+
+        # only a dropped session gets a second chance; a server that refuses
+        # the message itself would refuse it again
+        for retry in (True,False):
+          try:
+            if not self.smtp:
+              self.login()
+            self.smtp.sendmail(msg['From'],msg['To'],msg.as_string())
+            break
+          except (smtplib.SMTPServerDisconnected,socket.error):
+            self.close()
+            if not retry:
+              return self.fail(i,self.proto.ConnectFailure('SMTP'))
+          except smtplib.SMTPException as e:
+            self.log.warning('Dropping mail to "%s" (%s)' % (to,e))
+            break
+          except ProtocolError as e:
+            return self.fail(i,e)
+          except Exception as e:
+            self.log.error('Dropping mail to "%s" (%s)' % (to,e))
+            self.log.debug(traceback.format_exc(e))
+            break
+
+        self.last = time.time()
+    return len(batch)
+
+  # stop sending until the bot reconnects us, and tell it why via process()
+  # @param sent (int) the number of messages sent before failing
+  # @param e (ProtocolError) the error to raise in the main thread
+  # @return (int) sent
+  def fail(self,sent,e):
+
+    self.log.error('Unable to send mail (%s)' % e.__class__.__name__)
+    with self.cond:
+      self.failed = True
+    self.proto.thread.msgs.put(e)
+    return sent
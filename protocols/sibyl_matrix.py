@@ -23,17 +23,22 @@
 
 from Queue import Queue
 from urlparse import urlparse
-import traceback, datetime, pytz
+from urllib import quote
+from threading import Thread, Condition
+from collections import OrderedDict, deque
+import traceback, datetime, pytz, json, time, itertools
 
 from sibyl.lib.protocol import User,Room,Message,Protocol
 
 from sibyl.lib.decorators import botconf
 
 from matrix_client.client import MatrixClient
-from matrix_client.api import MatrixError, MatrixRequestError, MatrixHttpApi
+from matrix_client.api import (MatrixError, MatrixRequestError, MatrixHttpApi,
+    MATRIX_V2_API_PATH)
 from matrix_client.errors import MatrixHttpLibError
 import matrix_client.user as mxUser
 import matrix_client.room as mxRoom
+from requests import Session, RequestException
 
 ################################################################################
 # Config options
@@ -50,7 +55,9 @@ def conf(bot):
     # reject: Don't accept any invites received
     # accept: Join any room when receiving an invite
     # domain: Only join rooms on invite if the inviter is on the same HS
-    {"name": "join_on_invite", "req": False, "default": "reject"}
+    {"name": "join_on_invite", "req": False, "default": "reject"},
+    {"name": "sync_limit", "req": False, "default": 20,
+     "parse": bot.conf.parse_int}
   ]
 
 ################################################################################
@@ -59,6 +66,8 @@ def conf(bot):
 
 class MatrixUser(User):
 
+  __slots__ = ('user',)
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = (Protocol) name of this User's protocol as a str
   #   self.typ = (int) either Message.PRIVATE or Message.GROUP
@@ -97,6 +106,8 @@ class MatrixUser(User):
 
 class MatrixRoom(Room):
 
+  __slots__ = ('room',)
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = name of this Room's protocol as a str
   #   self.nick = the nick name to use in the room (defaults to None)
@@ -104,9 +115,11 @@ class MatrixRoom(Room):
   # @param name (object) a full roomid
   def parse(self,name):
     if(isinstance(name,mxRoom.Room)):
-      self.room = room
+      self.room = name
     elif(isinstance(name,basestring)):
-      self.room = mxRoom.Room(self.protocol.client,name) # [TODO] Assumes a room ID for now
+      # [TODO] Assumes a room ID for now
+      self.room = (self.protocol.client.rooms.get(name)
+          or mxRoom.Room(self.protocol.client,name))
     else:
       raise TypeError("User parameter to parse must be a string")
 
@@ -123,26 +136,179 @@ class MatrixRoom(Room):
     else:
       return False
 
+################################################################################
+# Sender thread
+################################################################################
+
+class SenderThread(Thread):
+
+  # give up on a message after this many failures (rate limits don't count)
+  MAX_TRIES = 5
+
+  # @param proto (MatrixProtocol) the protocol we're sending for
+  def __init__(self, proto):
+    super(SenderThread, self).__init__()
+    self.daemon = True
+
+    self.proto = proto
+    self.log = proto.log
+
+    # keep-alive connection pool separate from the sync thread's
+    self.session = Session()
+
+    # each room gets its own queue so one rate-limited room can't hold up the
+    # rest, and messages within a room are still sent in order
+    self.queues = OrderedDict()
+    self.retry = {}
+    self.tries = {}
+    self.cond = Condition()
+    self.running = True
+
+    # transaction ids only need to be unique for our access token, and
+    # reusing one on retry stops the server from posting a message twice
+    self.txn_prefix = 'sibyl%d.' % (time.time()*1000)
+    self.txn_ids = itertools.count()
+
+  # called from the main thread; never blocks on the network
+  # @param room_id (str) the room to send to
+  # @param content (dict) the m.room.message content
+  def put(self, room_id, content):
+    txn = self.txn_prefix+str(next(self.txn_ids))
+    with self.cond:
+      self.queues.setdefault(room_id, deque()).append((txn, content))
+      self.cond.notify()
+
+  # wait for queued messages to be sent
+  # @param timeout (float) max seconds to wait
+  def stop(self, timeout=5):
+    end = time.time()+timeout
+    with self.cond:
+      while(self.queues and time.time() < end):
+        self.cond.wait(0.1)
+      self.running = False
+      self.cond.notify()
+
+  def run(self):
+    while(self.running):
+      with self.cond:
+        ready = self._ready()
+        if(not ready):
+          now = time.time()
+          wait = [t-now for (r, t) in self.retry.items() if r in self.queues]
+          self.cond.wait(max(min(wait), 0) if wait else None)
+          continue
+
+      # send the oldest message from every room that's ready
+      for room_id in ready:
+        with self.cond:
+          (txn, content) = self.queues[room_id][0]
+        if(self._send(room_id, txn, content)):
+          self._done(room_id)
+
+  # @return (list of str) rooms with messages we're allowed to send right now
+  def _ready(self):
+    now = time.time()
+    return [r for r in self.queues if self.retry.get(r, 0) <= now]
+
+  # @param room_id (str) the room we just finished with the oldest message of
+  def _done(self, room_id):
+    self.tries.pop(room_id, None)
+    self.retry.pop(room_id, None)
+    with self.cond:
+      self.queues[room_id].popleft()
+      if(not self.queues[room_id]):
+        del self.queues[room_id]
+      self.cond.notify_all()
+
+  # @param room_id (str) the room to send to
+  # @param txn (str) the transaction id for this message
+  # @param content (dict) the m.room.message content
+  # @return (bool) True if we're done with this message
+  def _send(self, room_id, txn, content):
+    api = self.proto.client.api
+    url = (api.base_url + MATRIX_V2_API_PATH
+        + '/rooms/%s/send/m.room.message/%s' % (quote(room_id), quote(txn)))
+
+    try:
+      response = self.session.put(url, data=json.dumps(content),
+          params={'access_token': api.token},
+          headers={'Content-Type': 'application/json'},
+          verify=api.validate_cert)
+    except RequestException as e:
+      return self._failed(room_id, str(e))
+
+    if(200 <= response.status_code < 300):
+      return True
+
+    # the server tells us how long to back off; that isn't a failure
+    if(response.status_code == 429):
+      try:
+        delay = response.json()['retry_after_ms']/1000.0
+      except (ValueError, KeyError, TypeError):
+        delay = api.default_429_wait_ms/1000.0
+      self.log.debug("Rate limited in %s for %.3f sec" % (room_id, delay))
+      self.retry[room_id] = time.time()+delay
+      return False
+
+    # retrying won't fix anything else in the 4xx range
+    if(response.status_code < 500):
+      self.log.error("Unable to send to %s: %s %s"
+          % (room_id, response.status_code, response.text))
+      return True
+    return self._failed(room_id, "%s %s"
+        % (response.status_code, response.text))
+
+  # @param room_id (str) the room we failed to send to
+  # @param error (str) what went wrong
+  # @return (bool) True if we gave up on the message
+  def _failed(self, room_id, error):
+    tries = self.tries[room_id] = self.tries.get(room_id, 0)+1
+    if(tries >= self.MAX_TRIES):
+      self.log.error("Giving up sending to %s after %s tries: %s"
+          % (room_id, tries, error))
+      return True
+
+    delay = 2**tries
+    self.log.warning("Failed to send to %s (%s); retrying in %s sec"
+        % (room_id, error, delay))
+    self.retry[room_id] = time.time()+delay
+    return False
+
 ################################################################################
 # Protocol sub-class
 ################################################################################
 
 class MatrixProtocol(Protocol):
 
-  # List of occupants in each room
-  # Used to avoid having to re-request the list of members each time
-  room_occupants = {}
   # Keep track of when we joined rooms this session
   # Used to filter out historical messages after accepting room invites
   join_timestamps = {}
 
+  # Timeline events we actually handle in messageHandler; the server leaves
+  # everything else out of our syncs
+  SYNC_TYPES = ['m.room.message', 'm.room.member']
+
+  # Seconds to wait before retrying a room whose members failed to load
+  STALE_RETRY = 30
+
   # called on bot init; the following are already created by __init__:
   #   self.bot = SibylBot instance
   #   self.log = the logger you should use
   def setup(self):
-    self.rooms = {}
+
+    # Joined members of every room we're in as {room_id: {user_id: User}}
+    # Loaded once when we join and then kept up to date by m.room.member events
+    # from the sync stream, so this is also our list of rooms
+    self.members = {}
+
+    # rooms whose member list failed to load as {room_id: next retry time}
+    self.stale = {}
     self.bot.add_var("credentials",persist=True)
 
+    # (user, next_batch, room_ids) from our last sync so we can pick up where
+    # we left off instead of downloading every room again
+    self.bot.add_var("matrix_sync",persist=True)
+
     # Incoming message queue - messageHandler puts messages in here and
     # process() looks here periodically to send them to sibyl
     self.msg_queue = Queue()
@@ -152,6 +318,9 @@ class MatrixProtocol(Protocol):
     homeserver = self.opt('matrix.server')
     self.client = MatrixClient(homeserver)
 
+    # send() only queues messages for this thread so we never block on HTTP
+    self.sender = None
+
   # @raise (ConnectFailure) if can't connect to server
   # @raise (AuthFailure) if failed to authenticate to server
   def connect(self):
@@ -165,25 +334,41 @@ class MatrixProtocol(Protocol):
       self.log.debug("Logging in as %s" % user)
 
       # Log in with the existing access token if we already have a token
+      # Passing the token to MatrixClient() would do a full sync right away,
+      # so set it the same way login() does and sync ourselves below
       if(self.bot.credentials and self.bot.credentials[0] == user):
-        self.client = MatrixClient(homeserver, user_id=user, token=self.bot.credentials[1])
+        self.client = MatrixClient(homeserver)
+        self.client.user_id = user
+        self.client.token = self.client.api.token = self.bot.credentials[1]
       # Otherwise, log in with the configured username and password
       else:
-        token = self.client.login_with_password(user,pw)
+        token = self.client.login(user, pw, sync=False)
         self.bot.credentials = (user, token)
 
-      self.rooms = self.client.get_rooms()
-      self.log.debug("Already in rooms: %s" % self.rooms)
+      self._initial_sync(user)
+
+      self.members = {}
+      self.stale = {}
+      for room_id in self.client.rooms:
+        self._try_load_members(room_id)
+      self.log.debug("Already in rooms: %s" % self.members.keys())
+      self._rooms_changed()
 
       self._sync_display_name(self.bot.opt('nick_name'))
 
       # Connect to Sibyl's message callback
       self.client.add_listener(self.messageHandler)
       self.client.add_invite_listener(self.inviteHandler)
+      self.client.add_leave_listener(self.leaveHandler)
 
       self.log.debug("Starting Matrix listener thread")
       self.client.start_listener_thread(exception_handler=self._matrix_exception_handler)
 
+      # the sender keeps its queues across reconnects
+      if(not self.sender):
+        self.sender = SenderThread(self)
+        self.sender.start()
+
     except MatrixRequestError as e:
       if(e.code in [401, 403]):
         self.log.debug("Credentials incorrect! Maybe your access token is outdated?")
@@ -209,14 +394,24 @@ class MatrixProtocol(Protocol):
   # @raise (ConnectFailure) if disconnected
   # @raise (ServerShutdown) if server shutdown
   def process(self):
+    now = time.time()
+    for (room_id, retry) in list(self.stale.items()):
+      if(retry <= now):
+        self._try_load_members(room_id)
+
     while(not self.msg_queue.empty()):
       next = self.msg_queue.get()
       if(isinstance(next, Message)):
         self.log.debug("Placing message into queue: " + next.get_text())
         self.bot._cb_message(next)
+      elif(isinstance(next, dict)):
+        self._member_event(next)
+      elif(isinstance(next, MatrixRoom)):
+        self.join_room(next)
       elif(isinstance(next, MatrixHttpLibError)):
         self.log.debug("Received error from Matrix SDK, stopping listener thread: " + str(next))
         self.client.stop_listener_thread()
+        self._save_sync()
         raise self.ConnectFailure("Connection error returned by requests library: " + str(next))
 
 
@@ -273,11 +468,9 @@ class MatrixProtocol(Protocol):
         else:
           self.log.debug('Not handling message, unknown msgtype')
 
-      elif('membership' in msg):
-        if(msg['membership'] == 'join'):
-          self.room_occupants[r].add(self.new_user(msg['state_key'], Message.GROUP))
-        elif(msg['membership'] == 'leave'):
-          self.room_occupants[r].remove(self.new_user(msg['state_key'], Message.GROUP))
+      # process() updates self.members so we never touch it in this thread
+      elif(msg['type'] == 'm.room.member'):
+        self.msg_queue.put(msg)
 
     except KeyError as e:
       self.log.debug("Incoming message did not have all required fields: " + e.message)
@@ -298,7 +491,7 @@ class MatrixProtocol(Protocol):
 
     if(join_on_invite == 'accept' or (join_on_invite == 'domain' and inviter_domain == my_domain)):
       self.log.debug('Joining {} on invite from {}'.format(room_id, inviter))
-      self.join_room(MatrixRoom(self, room_id))
+      self.msg_queue.put(MatrixRoom(self, room_id))
 
     elif(join_on_invite == 'domain' and inviter_domain != my_domain):
       self.log.debug("Received invite for {} but inviter {} is on a different homeserver").format(room_id, inviter)
@@ -307,24 +500,26 @@ class MatrixProtocol(Protocol):
       self.log.debug("Received invite for {} from {} but join_on_invite is disabled".format(room_id, inviter))
 
 
+  # the SDK doesn't pass our leave event to other listeners, so fake one
+  def leaveHandler(self, room_id, room):
+    self.msg_queue.put({'type': 'm.room.member', 'room_id': room_id,
+        'state_key': str(self.get_user()), 'content': {'membership': 'leave'}})
+
   # called when the bot is exiting for whatever reason
   # NOTE: sibylbot will already call part_room() on every room in get_rooms()
   def shutdown(self):
-    pass
+    self._save_sync()
+    if(self.sender):
+      self.sender.stop()
 
   # send a message to a user
+  # the SenderThread actually sends it, retrying if we're rate limited
   # @param mess (Message) message to be sent
-  # @raise (ConnectFailure) if failed to send message
   # Check: get_emote()
   def send(self,mess):
     (text,to) = (mess.get_text(),mess.get_to())
-    try:
-      if(mess.get_emote()):
-        to.room.send_emote(text)
-      else:
-        to.room.send_text(text)
-    except MatrixError as e:
-      raise self.ConnectFailure
+    msgtype = ('m.emote' if mess.get_emote() else 'm.text')
+    self.sender.put(to.room.room_id, {'msgtype': msgtype, 'body': text})
 
   # send a message with text to every user in a room
   # optionally note that the broadcast was requested by a specific User
@@ -357,6 +552,8 @@ class MatrixProtocol(Protocol):
   def join_room(self,room):
     try:
       res = self.client.join_room(room.room.room_id)
+      self._try_load_members(res.room_id)
+      self._rooms_changed()
       self.bot._cb_join_room_success(room)
       self.join_timestamps[room] = datetime.datetime.now(pytz.utc)
     except MatrixError as e:
@@ -372,23 +569,15 @@ class MatrixProtocol(Protocol):
   # @param flag (int) one of Room.FLAG_* enums
   # @return (list of Room) rooms matching the flag
   def _get_rooms(self,flag):
-    mxrooms = self.client.get_rooms()
-    return [self.new_room(mxroom) for mxroom in mxrooms]
+    if(flag in (Room.FLAG_IN, Room.FLAG_ALL)):
+      return [self.new_room(room_id) for room_id in self.members]
+    return []
 
 
   # @param room (Room) the room to query
   # @return (list of User) the Users in the specified room
   def get_occupants(self,room):
-    if(room in self.room_occupants):
-      return list(self.room_occupants[room])
-    else:
-      try:
-        memberdict = room.room.get_joined_members()
-        users = [ self.new_user(x) for x in memberdict ]
-        self.room_occupants[room] = set(users)
-        return users
-      except MatrixError as e:
-        raise self.ConnectFailure
+    return list(self.members.get(room.get_name(), {}).values())
 
   # @param room (Room) the room to query
   # @return (str) the nick name we are using in the specified room
@@ -419,6 +608,114 @@ class MatrixProtocol(Protocol):
   def new_room(self,room_id_or_alias,nick=None,pword=None):
     return MatrixRoom(self,room_id_or_alias,nick,pword)
 
+  # Sync once before adding our listeners so nothing from before we connected
+  # gets treated as a new message. If we have a next_batch token from last
+  # time this only returns what happened since then, otherwise it's a full sync
+  # @param user (str) the user we're logged in as
+  def _initial_sync(self, user):
+    self.client.sync_filter = self._sync_filter()
+
+    state = self.bot.matrix_sync
+    if(state and state[0] == user):
+      self.client.sync_token = state[1]
+      for room_id in state[2]:
+        self.client.rooms[room_id] = mxRoom.Room(self.client, room_id)
+
+      # the server tells us about any rooms we joined or left while we were gone
+      try:
+        self.client.listen_for_events(timeout_ms=0)
+        self.log.debug("Resumed sync from token %s" % state[1])
+        return
+      except MatrixRequestError as e:
+        if(e.code in [401, 403]):
+          raise
+        self.log.info("Unable to resume sync from saved token, doing full sync")
+        self.client.sync_token = None
+        self.client.rooms.clear()
+
+    self.client.listen_for_events(timeout_ms=0)
+
+  # @return (str) JSON filter limiting what the server sends in each sync
+  def _sync_filter(self):
+    none = {"types": []}
+    return json.dumps({
+      "presence": none,
+      "account_data": none,
+      "room": {
+        "timeline": {"limit": self.opt('matrix.sync_limit'),
+                     "types": self.SYNC_TYPES},
+        "state": {"types": ['m.room.member']},
+        "ephemeral": none,
+        "account_data": none
+      }
+    })
+
+  # fetch the joined members of a room we just joined or found at connect
+  # @param room_id (str) the room to load
+  def _load_members(self, room_id):
+    members = self.members[room_id] = {}
+    for event in self.client.api.get_room_members(room_id)['chunk']:
+      if(event['content'].get('membership') == 'join'):
+        self._add_member(members, event)
+    self.stale.pop(room_id, None)
+
+  # like _load_members() but mark the room stale instead of raising
+  # @param room_id (str) the room to load
+  # @return (bool) True if the members were loaded
+  def _try_load_members(self, room_id):
+    try:
+      self._load_members(room_id)
+      return True
+    except MatrixError as e:
+      self.log.error("Unable to load members of %s: %s" % (room_id, e))
+      self.stale[room_id] = time.time()+self.STALE_RETRY
+      return False
+
+  # apply an m.room.member event from the sync stream to self.members
+  # @param event (dict) the membership event
+  def _member_event(self, event):
+    (room_id, user_id) = (event['room_id'], event['state_key'])
+    membership = event['content'].get('membership')
+
+    # our own membership changes which rooms we're in
+    if(user_id == str(self.get_user())):
+      if(membership == 'join' and room_id not in self.members):
+        self._try_load_members(room_id)
+        self._rooms_changed()
+        return
+      elif(membership != 'join' and room_id in self.members):
+        del self.members[room_id]
+        self.stale.pop(room_id, None)
+        self._rooms_changed()
+        return
+
+    # process() will do a full load, which already includes this event
+    if(room_id in self.stale):
+      return
+
+    members = self.members.get(room_id)
+    if(members is None):
+      return
+    if(membership == 'join'):
+      self._add_member(members, event)
+    else:
+      members.pop(user_id, None)
+
+  # @param members (dict) the members of one room from self.members
+  # @param event (dict) an m.room.member join event
+  def _add_member(self, members, event):
+    user = self.new_user(event['state_key'], Message.GROUP)
+    name = event['content'].get('displayname')
+    if(name):
+      user.user.displayname = name
+    members[event['state_key']] = user
+
+  # remember our next_batch token and rooms for _initial_sync()
+  def _save_sync(self):
+    if(self.client.sync_token):
+      self.bot.matrix_sync = (self.opt('matrix.username'),
+          self.client.sync_token, list(self.client.rooms.keys()))
+
   # Update Matrix user's display name only if currently configured
   # display name is different
   def _sync_display_name(self, nick):
@@ -20,13 +20,32 @@
 #
 ################################################################################
 
-import socket,select,errno,time,traceback
+import os,stat,struct
+import socket,select,errno,time,traceback,string,collections
 from threading import Thread,Event
-from Queue import Queue
+from Queue import Queue,Empty
+
+try:
+  import ssl
+except ImportError:
+  ssl = None
+
+try:
+  import pwd
+except ImportError:
+  pwd = None
 
 from sibyl.lib.protocol import User,Room,Message,Protocol
 
 from sibyl.lib.decorators import botconf
+import sibyl.lib.util as util
+
+# the value differs between architectures, so don't guess if python doesn't
+# know it; unix_users can't be enforced without it
+SO_PEERCRED = getattr(socket,'SO_PEERCRED',None)
+
+class FrameError(Exception):
+  pass
 
 ################################################################################
 # Config options
@@ -41,17 +60,55 @@ def conf(bot):
     {'name':'privkey','valid':bot.conf.valid_rfile},
     {'name':'key_password'},
     {'name':'internet','default':False,'parse':bot.conf.parse_bool},
-    {'name':'debug','default':False,'parse':bot.conf.parse_bool}
+    {'name':'debug','default':False,'parse':bot.conf.parse_bool},
+    {'name':'max_frame','default':1048576,'parse':bot.conf.parse_int,
+        'valid':bot.conf.valid_nump},
+    {'name':'unix_path','valid':valid_unix},
+    {'name':'unix_perms','default':0600,'parse':parse_perms},
+    {'name':'unix_users','default':[],'parse':parse_users}
   ]
 
+def valid_unix(conf,path):
+  """return True if we can create the socket file"""
+
+  path = os.path.abspath(path)
+  if os.path.exists(path) and not stat.S_ISSOCK(os.stat(path).st_mode):
+    conf.log('warning','"%s" exists and is not a socket' % path)
+    return False
+  return os.access(os.path.dirname(path),os.W_OK)
+
+def parse_perms(conf,opt,val):
+  """parse an octal file mode e.g. 0660"""
+
+  return int(val,8)
+
+def parse_users(conf,opt,val):
+  """parse a comma-separated list of user names or uids into uids"""
+
+  if SO_PEERCRED is None:
+    conf.log('warning','Ignoring unix_users (no socket.SO_PEERCRED); '
+        'only unix_perms will limit who can connect')
+    raise ValueError('SO_PEERCRED not available')
+
+  uids = []
+  for user in util.split_strip(val,','):
+    if user.isdigit():
+      uids.append(int(user))
+    elif pwd:
+      uids.append(pwd.getpwnam(user).pw_uid)
+    else:
+      raise ValueError('Can only use uids on this platform')
+  return uids
+
 ################################################################################
 # ServerThread class
 ################################################################################
 
 class ServerThread(Thread):
 
-  def __init__(self,log,q,d,c,pword=None,debug=False,ssl=None):
-    """create a new thread that handles socket connections"""
+  def __init__(self,log,q,d,c,pword=None,debug=False,ssl=None,
+      max_frame=1048576):
+    """create a new thread that handles every socket connection"""
 
     super(ServerThread,self).__init__()
     self.daemon = True
@@ -63,193 +120,490 @@ class ServerThread(Thread):
     self.password = pword
     self.debug = debug
     self.context = ssl
+    self.max_frame = max_frame
 
-    self.dead = Queue()
     self.clients = {}
+    self.socks = {}
+    self.outbox = Queue()
     self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
     self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
 
+    # optional local listener that trusts the OS instead of passwords and TLS
+    self.unix = None
+    self.unix_path = None
+    self.unix_uids = []
+    self.unix_count = 0
+
+    # lets other threads interrupt select() when they have data for us
+    (self.wake_r,self.wake_w) = socketpair()
+
   def bind(self,hostname,port):
     """bind our server socket"""
 
     self.socket.bind((hostname,port))
-    self.socket.listen(5)
+    self.socket.listen(128)
+    self.socket.setblocking(0)
+
+  # @param path (str) where to create the socket file
+  # @param perms (int) file mode for the socket e.g. 0600
+  # @param uids (list of int) [None] only accept these users (SO_PEERCRED)
+  def bind_unix(self,path,perms,uids=None):
+    """bind a unix domain socket that skips password auth and TLS"""
+
+    # a previous instance might have left its socket file behind
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+      os.remove(path)
+
+    # create the file with the right mode so nobody sneaks in before chmod
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    umask = os.umask(0777 & ~perms)
+    try:
+      sock.bind(path)
+    finally:
+      os.umask(umask)
+    os.chmod(path,perms)
+    sock.listen(128)
+    sock.setblocking(0)
 
-  def run(self):
-    """accept incoming connections and spawn clients"""
+    self.unix = sock
+    self.unix_path = path
+    self.unix_uids = uids or []
 
+  def run(self):
+    """multiplex every connection in a single select() loop"""
+
+    while not self.event_close.is_set():
+
+      # only ask for write readiness when a connection has output pending
+      conns = self.socks.values()
+      read = [self.socket,self.wake_r]+[c.socket for c in conns if c.want_read()]
+      if self.unix:
+        read.append(self.unix)
+      write = [c.socket for c in conns if c.want_write()]
+      (read,write,err) = select.select(read,write,[],1)
+
+      for sock in read:
+        if sock is self.socket or sock is self.unix:
+          self.accept(sock)
+        elif sock is self.wake_r:
+          self.wake_read()
+        elif sock in self.socks:
+          self.handle(self.socks[sock],Connection.on_read)
+
+      for sock in write:
+        if sock in self.socks:
+          self.handle(self.socks[sock],Connection.on_write)
+
+    for conn in self.socks.values():
+      conn.close()
+    self.socket.close()
+    self.wake_r.close()
+    self.wake_w.close()
+    if self.unix:
+      self.unix.close()
+      try:
+        os.remove(self.unix_path)
+      except OSError:
+        pass
+
+  # @param listener (socket) the listening socket that's ready
+  def accept(self,listener):
+    """accept every pending connection without blocking"""
+
+    local = (listener is self.unix)
     while True:
+      try:
+        (sock,address) = listener.accept()
+      except socket.error as e:
+        if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+          return
+        raise
+
+      # unix clients don't have an address, so number them instead
+      if local:
+        self.unix_count += 1
+        address = ('unix',self.unix_count)
+
+      try:
+        sock.setblocking(0)
+        if local:
+          self.check_peer(sock,address)
+        else:
+          sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+          if self.context:
+            sock = self.context.wrap_socket(sock,server_side=True,
+                do_handshake_on_connect=False)
+        conn = Connection(self,sock,address,local)
+        self.clients[address] = conn
+        self.socks[sock] = conn
+        self.log.info('Got new connection from %s:%s' % address)
+      except Exception as e:
+        self.log.warning('New connection %s:%s failed (%s)' %
+            (address+(e.__class__.__name__,)))
+        try:
+          sock.shutdown(socket.SHUT_RDWR)
+        except:
+          pass
+        sock.close()
 
-      if self.event_close.is_set():
-        break
-      (read,write,err) = select.select([self.socket],[],[],1)
+  # @param sock (socket) a newly accepted unix domain socket
+  # @param address (tuple) the address we gave it
+  # @raises (socket.error) if the peer isn't one of unix_uids
+  def check_peer(self,sock,address):
+    """check the uid of the process on the other end using SO_PEERCRED"""
 
-      if self.socket in read:
-        (conn,address) = self.socket.accept()
+    if not self.unix_uids:
+      return
 
-        try:
-          if self.context:
-            conn = self.context.wrap_socket(conn,server_side=True)
-          self.log.info('Got new connection from %s:%s' % address)
-          q = Queue()
-          self.clients[address] = q
-          ipc = {'rq':self.queue,'sq':q,
-                  'ed':self.event_data,'ec':self.event_close}
-          ClientThread(self,conn,address,ipc).start()
-        except Exception as e:
-          self.log.warning('New connection %s:%s failed (%s)' %
-              (address+(e.__class__.__name__,)))
-          try:
-            conn.shutdown(socket.SHUT_RDWR)
-          except:
-            pass
-          conn.close()
+    fmt = '3i'
+    creds = sock.getsockopt(socket.SOL_SOCKET,SO_PEERCRED,struct.calcsize(fmt))
+    (pid,uid,gid) = struct.unpack(fmt,creds)
+    if uid not in self.unix_uids:
+      self.log.warning('Rejected %s:%s from uid %s' % (address+(uid,)))
+      raise socket.error(errno.EACCES,'uid %s not in unix_users' % uid)
+
+  def handle(self,conn,func):
+    """run a Connection event handler and drop the client if it fails"""
 
-      while not self.dead.empty():
-        client = self.dead.get()
-        del self.clients[client]
-        self.log.info('Connection closed %s:%s@socket' % client)
+    try:
+      func(conn)
+    except FrameError as e:
+      self.log.warning('Closing %s:%s (%s)' % (conn.address+(e,)))
+      conn.close()
+    except Exception as e:
+      if self.debug:
+        self.log.debug('Closing %s:%s (%s)' %
+            (conn.address+(e.__class__.__name__,)))
+      conn.close()
 
-      time.sleep(0.1)
+  def remove(self,conn):
+    """forget about a closed Connection"""
 
-    self.socket.close()
+    self.clients.pop(conn.address,None)
+    self.socks.pop(conn.socket,None)
+    self.log.info('Connection closed %s:%s@socket' % conn.address)
 
-  def send(self,text,address):
-    """queue a message to be sent"""
+  def wake(self):
+    """interrupt select() from another thread"""
 
     try:
-      self.clients[address].put(text)
-    except KeyError:
-      self.log.warning('Attempted to send a message to a disconnected client')
+      self.wake_w.send('x')
+    except socket.error:
+      pass
+
+  def wake_read(self):
+    """hand queued messages from other threads to their Connections"""
+
+    try:
+      self.wake_r.recv(4096)
+    except socket.error:
+      pass
+
+    while not self.outbox.empty():
+      (frames,address) = self.outbox.get()
+      conn = self.clients.get(address)
+      if conn:
+        for (typ,text) in frames:
+          conn.queue_msgs([text],typ)
+      else:
+        self.log.warning('Attempted to send a message to a disconnected client')
+
+  # @param frames (list of tuple) (typ,text) pairs to send in order
+  # @param address (tuple) the (host,port) of the client
+  def send(self,frames,address):
+    """queue a list of messages to be sent (this function is thread-safe)"""
+
+    self.outbox.put((frames,address))
+    self.wake()
 
 ################################################################################
-# ClientThread class
+# Connection class
 ################################################################################
 
-class ClientThread(Thread):
+# Every frame is "<len> <typ> <text>" where len counts the bytes after the
+# first space. Clients that want to pipeline commands send MSG_REQ frames whose
+# text is "<id> <cmd>"; every reply to that command is a MSG_REQ frame with the
+# same id, and once the command has run the server sends a MSG_DONE frame whose
+# text is just the id. Replies from commands that run in their own thread may
+# still arrive after MSG_DONE. Plain MSG_TEXT frames work exactly as before.
+
+class Connection(object):
 
   MSG_AUTH = '0'
   MSG_TEXT = '1'
+  MSG_REQ = '2'
+  MSG_DONE = '3'
+
+  # request ids are short tokens chosen by the client
+  MAX_REQ = 64
+  REQ_CHARS = frozenset(string.ascii_letters+string.digits+'-_.:')
 
   AUTH_OKAY = 'OKAY'
   AUTH_FAILED = 'FAILED'
   AUTH_NONE = 'NONE'
 
-  def __init__(self,srv,conn,addr,ipc):
+  # max bytes to read from the socket at once
+  RECV_SIZE = 65536
 
-    """cretae a new thread that handles client connections"""
+  # TLS handshake states
+  HS_DONE = 0
+  HS_READ = 1
+  HS_WRITE = 2
 
-    super(ClientThread,self).__init__()
-    self.daemon = True
-    self.authed = (srv.password is None)
+  # @param srv (ServerThread) the server that accepted this connection
+  # @param sock (socket) the client socket
+  # @param addr (tuple) the client address
+  # @param local (bool) [False] unix socket clients skip password auth and TLS
+  def __init__(self,srv,sock,addr,local=False):
+    """create a new non-blocking client connection owned by srv"""
+
+    self.authed = (local or srv.password is None)
+    self.tls = (not local and srv.context is not None)
+    self.handshake = (self.HS_READ if self.tls else self.HS_DONE)
+    self.closing = False
+    self.closed = False
 
     self.server = srv
-    self.socket = conn
+    self.socket = sock
     self.address = addr
-    self.ipc = ipc
 
     self.log = srv.log
-    self.buffer = ''
 
-  def run(self):
-    """receive and send data on the socket"""
+    # read and write buffers with offsets so we only compact once per event
+    self.chunk = bytearray(Connection.RECV_SIZE)
+    self.rbuf = bytearray()
+    self.rpos = 0
+    self.wbuf = bytearray()
+    self.wpos = 0
 
-    while not self.ipc['ec'].is_set():
-      (read,write,err) = select.select([self.socket],[self.socket],[],1)
+  def want_read(self):
+    """return True if select() should watch us for reading"""
 
-      if self.socket in read:
-        try:
-          msgs = self.get_msgs()
-        except:
-          break
-        if msgs:
-          self.ipc['ed'].set()
-        for msg in msgs:
-          if msg:
-            self.ipc['rq'].put((self.address,msg))
+    return not self.closing and self.handshake!=self.HS_WRITE
 
-      if self.socket in write:
-        while not self.ipc['sq'].empty():
-          self.send_msg(self.ipc['sq'].get())
+  def want_write(self):
+    """return True if select() should watch us for writing"""
 
-      time.sleep(0.1)
+    return self.wpos<len(self.wbuf) or self.handshake==self.HS_WRITE
 
-    self.server.dead.put(self.address)
-    self.socket.close()
+  def do_handshake(self):
+    """advance the TLS handshake as far as possible without blocking"""
+
+    try:
+      self.socket.do_handshake()
+      self.handshake = self.HS_DONE
+      self.log.debug('TLS handshake done for %s:%s' % self.address)
+    except ssl.SSLWantReadError:
+      self.handshake = self.HS_READ
+    except ssl.SSLWantWriteError:
+      self.handshake = self.HS_WRITE
+
+  def on_read(self):
+    """read whatever is available and queue complete msgs for the bot"""
+
+    if self.handshake:
+      self.do_handshake()
+      if self.handshake:
+        return
+
+    while True:
+      try:
+        n = self.socket.recv_into(self.chunk)
+      except socket.error as e:
+        if not would_block(e):
+          raise
+        break
+      if self.server.debug:
+        self.log.debug('recv "%s"' % self.chunk[:n])
+      if not n:
+        self.log.debug('Received EOS from %s:%s' % self.address)
+        raise RuntimeError
+      self.rbuf += memoryview(self.chunk)[:n]
+
+      # SSL might have decrypted data buffered that select() can't see
+      if not (self.tls and self.socket.pending()):
+        break
+
+    msgs = self.get_msgs()
+    if msgs:
+      for (req,msg) in msgs:
+        self.server.queue.put((self.address,req,msg))
+      self.server.event_data.set()
+
+  def on_write(self):
+    """write as much pending output as the socket will take"""
+
+    if self.handshake:
+      self.do_handshake()
+      if self.handshake:
+        return
+
+    try:
+      sent = self.socket.send(memoryview(self.wbuf)[self.wpos:])
+      if self.server.debug:
+        self.log.debug('send "%s"' % self.wbuf[self.wpos:self.wpos+sent])
+      self.wpos += sent
+    except socket.error as e:
+      if not would_block(e):
+        raise
+
+    # everything was sent, so start over with an empty buffer
+    if self.wpos==len(self.wbuf):
+      self.wbuf = bytearray()
+      self.wpos = 0
+      if self.closing:
+        self.close()
+
+    # don't let a slow reader make us hold on to everything we've sent
+    elif self.wpos>len(self.wbuf)/2:
+      del self.wbuf[:self.wpos]
+      self.wpos = 0
 
   def get_msgs(self):
+    """parse every complete frame in our read buffer"""
 
     msgs = []
-    while self.buffer or not msgs:
-      (typ,msg) = self.get_msg()
+    while not self.closing:
+      frame = self.get_msg()
+      if frame is None:
+        break
+
+      (typ,msg) = frame
       if self.server.debug:
         self.log.debug('act typ=%s "%s"' % (typ,msg))
-      if typ==ClientThread.MSG_AUTH:
+      if typ==Connection.MSG_AUTH:
         self.do_auth(msg)
-        msg = None
-      elif typ==ClientThread.MSG_TEXT or typ is None:
+      elif typ in (Connection.MSG_TEXT,Connection.MSG_REQ):
         if not self.authed:
           self.log.warning('Remote %s:%s did not attempt Auth' % self.address)
-          self.send_msg(ClientThread.AUTH_FAILED,ClientThread.MSG_AUTH)
-          raise RuntimeError
-        msgs.append(msg)
+          self.queue_msgs([Connection.AUTH_FAILED],Connection.MSG_AUTH)
+          self.closing = True
+        elif typ==Connection.MSG_REQ:
+          (req,_,msg) = msg.partition(' ')
+          if not self.valid_req(req):
+            self.log.error('Invalid request id from %s:%s' % self.address)
+            self.queue_msgs(['Invalid request id; closing connection'])
+            self.closing = True
+          else:
+            msgs.append((req,msg))
+        elif msg:
+          msgs.append((None,msg))
       else:
         self.log.error('Unsupported msg type "%s"' % typ)
-        self.send_msg('Unsupported msg type "%s"; closing connection' % typ)
-        raise RuntimeError
+        self.queue_msgs(['Unsupported msg type "%s"; closing connection' % typ])
+        self.closing = True
 
+    # drop the frames we parsed
+    del self.rbuf[:self.rpos]
+    self.rpos = 0
     return msgs
 
   def get_msg(self):
+    """return (typ,text) for the next frame or None if it's incomplete"""
 
-    msg = self.buffer
-    while ' ' not in msg:
-      s = self.socket.recv(4096)
-      if self.server.debug:
-        self.log.debug('recv "%s"' % s)
-      if not s:
-        self.log.debug('Received EOS from %s:%s' % self.address)
-        raise RuntimeError
-      msg += s
-
-    length_str = msg.split(' ')[0]
-    target = len(length_str)+1+int(length_str)
-    while len(msg)<target:
-      msg += self.socket.recv(min(target-len(msg),4096))
+    # the length header can't be longer than the max frame size allows
+    max_frame = self.server.max_frame
+    header = len(str(max_frame))+1
+    space = self.rbuf.find(' ',self.rpos,self.rpos+header)
+    if space==-1:
+      if len(self.rbuf)-self.rpos>=header:
+        raise FrameError('Missing frame length header')
+      return None
 
-    (msg,self.buffer) = (msg[:target],msg[target:])
-    msg = msg[msg.find(' ')+1:]
-    return (msg[0],msg[2:])
+    try:
+      length = int(self.rbuf[self.rpos:space])
+    except ValueError:
+      raise FrameError('Invalid frame length header')
+    if length<0:
+      raise FrameError('Invalid frame length header')
+    if length>max_frame:
+      raise FrameError('Frame of %s bytes exceeds max_frame' % length)
+
+    target = space+1+length
+    if len(self.rbuf)<target:
+      return None
+
+    msg = bytes(self.rbuf[space+1:target])
+    self.rpos = target
+    return (msg[:1],msg[2:])
+
+  # @param req (str) a request id sent by the client
+  # @return (bool) True if we can safely echo it back
+  def valid_req(self,req):
+    """check that a request id is a short token"""
+
+    return (0<len(req)<=Connection.MAX_REQ
+        and Connection.REQ_CHARS.issuperset(req))
 
   def do_auth(self,msg):
+    """check the password sent by the client"""
 
     if self.authed:
-      self.send_msg(ClientThread.AUTH_NONE,ClientThread.MSG_AUTH)
+      self.queue_msgs([Connection.AUTH_NONE],Connection.MSG_AUTH)
       return
 
     if self.server.password==msg:
       self.authed = True
-      self.send_msg(ClientThread.AUTH_OKAY,ClientThread.MSG_AUTH)
+      self.queue_msgs([Connection.AUTH_OKAY],Connection.MSG_AUTH)
       self.log.debug('Successful auth from %s:%s' % self.address)
     else:
-      self.send_msg(ClientThread.AUTH_FAILED,ClientThread.MSG_AUTH)
+      self.queue_msgs([Connection.AUTH_FAILED],Connection.MSG_AUTH)
       self.log.warning('Invalid password from %s:%s' % self.address)
-      raise RuntimeError
+      self.closing = True
 
-  def send_msg(self,msg,typ=None):
+  def queue_msgs(self,msgs,typ=None):
+    """frame several messages and add them to our write buffer"""
 
-    typ = typ or ClientThread.MSG_TEXT
-    msg = typ+' '+msg
-    length_str = str(len(msg))
-    msg = (length_str+' '+msg)
-    target = len(msg)
+    typ = typ or Connection.MSG_TEXT
+    for msg in msgs:
+      if isinstance(msg,unicode):
+        msg = msg.encode('utf8')
+      msg = typ+' '+msg
+      self.wbuf += str(len(msg))
+      self.wbuf += ' '
+      self.wbuf += msg
 
-    if self.server.debug:
-      self.log.debug('send "%s"' % msg)
+  def close(self):
+    """close the socket and remove ourself from the server"""
 
-    sent = 0
-    while sent<target:
-      sent += self.socket.send(msg[sent:])
+    if self.closed:
+      return
+    self.closed = True
+    try:
+      self.socket.shutdown(socket.SHUT_RDWR)
+    except:
+      pass
+    self.socket.close()
+    self.server.remove(self)
+
+################################################################################
+# Helper functions
+################################################################################
+
+def socketpair():
+  """return a connected pair of non-blocking sockets"""
+
+  # socket.socketpair() doesn't exist on Windows in Python 2
+  if hasattr(socket,'socketpair'):
+    (a,b) = socket.socketpair()
+  else:
+    srv = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    srv.bind(('localhost',0))
+    srv.listen(1)
+    a = socket.create_connection(srv.getsockname())
+    (b,addr) = srv.accept()
+    srv.close()
+
+  a.setblocking(0)
+  b.setblocking(0)
+  return (a,b)
+
+def would_block(e):
+  """return True if the socket.error e just means try again later"""
+
+  if ssl and isinstance(e,(ssl.SSLWantReadError,ssl.SSLWantWriteError)):
+    return True
+  return e.errno in (errno.EAGAIN,errno.EWOULDBLOCK)
 
 ################################################################################
 # User sub-class
@@ -257,9 +611,14 @@ class ClientThread(Thread):
 
 class Client(User):
 
+  __slots__ = ('address','user','req')
+
+  # @param info (tuple) (host,port) or (host,port,req) where req is the id of a
+  #   pipelined request that replies should be tagged with
   def parse(self,info):
-    self.address = info
-    self.user = '%s:%s@socket' % info
+    self.address = info[:2]
+    self.req = (info[2] if len(info)>2 else None)
+    self.user = '%s:%s@socket' % self.address
 
   def get_name(self):
     return self.user
@@ -284,6 +643,8 @@ class Client(User):
 
 class FakeRoom(Room):
 
+  __slots__ = ('name',)
+
   def parse(self,name):
     self.name = name
 
@@ -304,6 +665,7 @@ class SocketServer(Protocol):
   def setup(self):
 
     self.thread = None
+    self.done = collections.OrderedDict()
 
   def connect(self):
 
@@ -327,8 +689,9 @@ class SocketServer(Protocol):
       if not (key and crt):
         missing = [x for (x,y) in {'pubkey':crt,'privkey':key}.items() if not y]
         self.log.error('Missing %s; not using SSL' % missing[0])
+      elif not ssl:
+        self.log.error('Python was built without ssl; not using SSL')
       else:
-        import ssl
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.verify_mode = ssl.CERT_NONE
         try:
@@ -340,7 +703,8 @@ class SocketServer(Protocol):
 
     self.thread = ServerThread(self.log,
         self.queue,self.event_data,self.event_close,
-        self.opt('socket.password'),self.opt('socket.debug'),context)
+        self.opt('socket.password'),self.opt('socket.debug'),context,
+        self.opt('socket.max_frame'))
 
     self.log.info('Attempting to bind to %s:%s' % (hostname,port))
     try:
@@ -354,34 +718,87 @@ class SocketServer(Protocol):
         self.log.error('Unhandled error %s = %s' % (n,errno.errorcode[n]))
         raise self.AuthFailure
 
+    path = self.opt('socket.unix_path')
+    if path:
+      uids = self.opt('socket.unix_users')
+      if not hasattr(socket,'AF_UNIX'):
+        self.log.error('Unix sockets are not supported on this platform')
+        raise self.AuthFailure
+      if uids and SO_PEERCRED is None:
+        self.log.error('Opt unix_users requires socket.SO_PEERCRED')
+        raise self.AuthFailure
+
+      self.log.info('Attempting to bind to %s' % path)
+      try:
+        self.thread.bind_unix(path,self.opt('socket.unix_perms'),uids)
+      except Exception as e:
+        self.log.error('Unable to bind to %s (%s)' % (path,e))
+        raise self.AuthFailure
+
     self.thread.start()
 
   def process(self):
+    """process queued msgs up to proc_budget"""
+
+    # replies to requests from last time have been sent, so mark them done
+    if self.done:
+      for (address,reqs) in self.done.items():
+        self.thread.send([(Connection.MSG_DONE,r) for r in reqs],address)
+      self.done.clear()
 
     if not self.event_data.is_set():
       return
 
-    (address,text) = self.queue.get()
-    usr = Client(self,address)
+    # clear first so a msg queued while we're working sets it again
+    self.event_data.clear()
+    budget = self.opt('proc_budget')
 
-    if self.special_cmds(text):
-      return
+    n = 0
+    while budget<1 or n<budget:
+      try:
+        (address,req,text) = self.queue.get_nowait()
+      except Empty:
+        break
+      n += 1
 
-    msg = Message(usr,text)
-    self.bot._cb_message(msg)
+      if self.special_cmds(text):
+        continue
 
-    if self.queue.empty():
-      self.event_data.clear()
+      # replies go to a Client that remembers the request id
+      if req is None:
+        usr = Client(self,address)
+      else:
+        usr = Client(self,address+(req,))
+        self.done.setdefault(address,[]).append(req)
+      self.bot._cb_message(Message(usr,text))
+
+    # we ran out of budget, so make sure we come back next time
+    if 0<budget<=n:
+      self.event_data.set()
 
   def shutdown(self):
     if hasattr(self,'event_close'):
       self.event_close.set()
     if self.thread:
+      self.thread.wake()
       self.thread.join()
 
   def send(self,mess):
-    (text,to) = (mess.get_text(),mess.get_to())
-    self.thread.send(text,to.address)
+    self.send_many([mess])
+
+  def send_many(self,msgs):
+    """hand each client all of its messages at once"""
+
+    frames = collections.OrderedDict()
+    for mess in msgs:
+      to = mess.get_to()
+      if to.req is None:
+        frame = (Connection.MSG_TEXT,mess.get_text())
+      else:
+        frame = (Connection.MSG_REQ,u'%s %s' % (to.req,mess.get_text()))
+      frames.setdefault(to.address,[]).append(frame)
+    for (address,frame) in frames.items():
+      self.thread.send(frame,address)
 
   def broadcast(self,mess):
     pass
@@ -24,7 +24,7 @@
 #
 ################################################################################
 
-import logging,time,re,traceback,socket
+import logging,time,re,traceback,collections
 
 import xmpp
 from xmpp.protocol import SystemShutdown,StreamError
@@ -46,23 +46,20 @@ def conf(bot):
     {'name':'port','default':5222,'parse':bot.conf.parse_int},
     {'name':'ping_freq','default':60,'parse':bot.conf.parse_int},
     {'name':'ping_timeout','default':3,'parse':bot.conf.parse_int},
+    {'name':'join_timeout','default':25,'parse':bot.conf.parse_int},
+    {'name':'stream_mgmt','default':True,'parse':bot.conf.parse_bool},
     {'name':'debug','default':False,'parse':bot.conf.parse_bool},
     {'name':'priv_domain','default':True,'parse':bot.conf.parse_bool}
   ]
 
-################################################################################
-# Custom Exceptions
-################################################################################
-
-class MUCJoinFailure(Exception):
-  pass
-
 ################################################################################
 # JID(User) class
 ################################################################################
 
 class JID(User):
 
+  __slots__ = ('jid',)
+
   def parse(self,jid):
     """accept either xmpp.JID for internal use, or str for external use"""
 
@@ -109,6 +106,8 @@ class JID(User):
 
 class MUC(Room):
 
+  __slots__ = ('name',)
+
   def parse(self,name):
     self.name = name
 
@@ -141,6 +140,10 @@ class XMPP(Protocol):
   MUC_MEMBERS = 322
   MUC_SHUTDOWN = 332
 
+  # XEP-0198 Stream Management
+  NS_SM = 'urn:xmpp:sm:3'
+  SM_STANZAS = ('message','presence','iq')
+
   # human-readable MUC errors
   MUC_JOIN_ERROR = {'not-authorized'          : 'invalid password',
                     'forbidden'               : 'banned',
@@ -185,12 +188,27 @@ class XMPP(Protocol):
     self.seen = {}
 
     self.mucs = {}
-    self.__muc_pending = []
-    self.real_jids = {}
+    self.__muc_pending = collections.OrderedDict()
+
+    # occupants of each MUC as {room:{nick:{'real','show','status'}}}
+    self.rosters = {}
+    self.__real_users = collections.Counter()
 
     self.last_muc = None
     self.last_ping = time.time()
     self.last_join = self.last_ping
+    self.last_recv = self.last_ping
+
+    # serialized stanzas waiting for __flush()
+    self.__outbuf = []
+
+    # id of the ping we're waiting on a response to
+    self.__ping_id = None
+
+    # XEP-0198 state, which survives disconnects so we can resume
+    self.__sm_unacked = collections.deque()
+    self.__sm_reply = None
+    self.__sm_reset()
 
   def connect(self):
     """try to connect if we aren't connected"""
@@ -213,21 +231,41 @@ class XMPP(Protocol):
       self.log.warning('unable to establish secure connection '\
       '- TLS failed!')
 
-    # authentication attempt
-    authres = conn.auth(self.jid.getNode(),
-        self.opt('xmpp.password'),self.opt('xmpp.resource'))
-    if not authres:
-      raise self.AuthFailure
-    if authres != 'sasl':
-      self.log.warning("unable to perform SASL auth on %s. "\
-      "Old authentication method used!" % self.jid.getDomain())
+    # resuming our old session keeps our MUCs and replays lost stanzas
+    resumed = False
+    if self.__sm_resumable():
+      self.__sasl(conn)
+      self.__sm_plugin(conn)
+      resumed = self.__sm_resume(conn)
+      if not resumed:
+        self.__bind(conn)
 
-    # Modify blocking for "connected" tests later
-    conn.Connection._sock.setblocking(False)
+    # authentication attempt
+    else:
+      authres = conn.auth(self.jid.getNode(),
+          self.opt('xmpp.password'),self.opt('xmpp.resource'))
+      if not authres:
+        raise self.AuthFailure
+      if authres != 'sasl':
+        self.log.warning("unable to perform SASL auth on %s. "\
+        "Old authentication method used!" % self.jid.getDomain())
+      self.__sm_plugin(conn)
 
     # Register handlers
     conn.RegisterHandler('message',self.callback_message)
     conn.RegisterHandler('presence',self.callback_presence)
+    conn.RegisterHandler('iq',self.callback_iq)
+
+    if resumed:
+      self.roster = conn.getRoster()
+      self.conn = conn
+      self.last_recv = time.time()
+      return
+
+    # we couldn't resume, so start over like it was a normal disconnect
+    if self.__sm_lost is not None:
+      self.__forget_session()
+    self.__sm_enable(conn)
 
     # Send initial presence stanza
     conn.sendInitPresence()
@@ -241,68 +279,136 @@ class XMPP(Protocol):
 
     # Connection established - save connection
     self.conn = conn
+    self.last_recv = time.time()
 
   def disconnected(self,ex):
-    """erase self.conn and set all MUCS to parted"""
+    """erase self.conn and set all MUCS to parted unless we can resume"""
 
     self.conn = None
+    self.__ping_id = None
+    self.__sm_asked = False
+    del self.__outbuf[:]
+
+    # the server keeps a resumable session (and our MUCs) around for a while,
+    # and anything in __outbuf is still in __sm_unacked so it gets replayed
+    if self.__sm_id:
+      self.__sm_lost = time.time()
+    else:
+      self.__forget_session()
+    raise ex
+
+  def __forget_session(self):
+    """set all MUCs to parted and forget everything about our old session"""
+
+    if self.__sm_unacked:
+      self.log.warning('Discarding %i stanzas the server never acked'
+          % len(self.__sm_unacked))
+    self.__sm_reset()
+
     for muc in self.__get_current_mucs():
       self.mucs[muc]['status'] = self.MUC_PARTED
+    for muc in self.rosters.keys():
+      self.__roster_clear(muc)
+
+    # joins we already sent need to be sent again after we reconnect
+    for muc in self.__muc_pending:
+      self.__muc_pending[muc] = None
+    self._rooms_changed()
     self.seen = {}
-    raise ex
 
   def process(self):
     """process messages and __idle_proc"""
 
     try:
-      self.conn.Process()
+      res = self.conn.Process()
     except SystemShutdown:
       self.disconnected(self.ServerShutdown)
     except StreamError as e:
       self.log.error(traceback.format_exception_only(type(e),e)[:-1])
       self.disconnected(self.ConnectFailure)
 
+    # Process() returns the length of data received, '0' if there wasn't any,
+    # and None or 0 if the socket was closed
+    if not res:
+      self.disconnected(self.ConnectFailure)
+    if res!='0':
+      self.last_recv = time.time()
+
     self.__idle_proc()
+    self.__flush()
 
   def shutdown(self):
     """leave all our rooms cleanly"""
 
     for room in self.get_rooms():
       self.part_room(room)
+    self.__flush()
 
   def send(self,mess):
     """send a message to the specified recipient"""
 
-    (text,to) = (mess.get_text(),mess.get_to())
+    self.send_many([mess])
 
-    if mess.get_emote():
-      text = '/me '+mess.get_text()
+  def send_many(self,msgs):
+    """send several messages with a single socket write"""
 
-    mess = self.__build_message(text)
-    mess.setType('chat')
-    if isinstance(to,Room):
-      mess.setType('groupchat')
-      to = to.get_name()
-    mess.setTo(xmpp.JID(str(to)))
+    for mess in msgs:
+      self.__write(self.__build_stanza(mess))
 
-    # outer try block catches disconnected from _sock.recv() and conn.send()
+    # if we can resume, these are in __sm_unacked and will be replayed, so
+    # don't let SibylBot defer and resend them as well
     try:
+      self.__flush()
+    except self.ConnectFailure:
+      if self.__sm_id:
+        del msgs[:]
+      raise
+
+  def __write(self,stanza):
+    """serialize a stanza into our buffer and return its id"""
+
+    # xmpppy writes each stanza separately, so catch the data instead
+    sock = self.conn.Connection
+    (write,sock._send) = (sock._send,self.__outbuf.append)
+    try:
+      return self.conn.send(stanza)
+    finally:
+      sock._send = write
 
-      # check if the socket is dead (send doesn't do that, so we'll recv)
-      # if recv() raises an exception it timed out and everything is fine
-      # if it returns an empty string the socket is dead
-      try:
-        if not self.conn.Connection._sock.recv(1,socket.MSG_PEEK):
-          raise IOError
-      except socket.error as e:
-        pass
+  def __flush(self):
+    """send every buffered stanza with a single socket write"""
+
+    if not (self.conn and self.__outbuf):
+      return
 
-      # actually try to send the message
-      self.conn.send(mess)
+    # ask the server to ack what we sent so we can forget it
+    if self.__sm_id and not self.__sm_asked:
+      self.__sm_asked = True
+      self.__outbuf.append("<r xmlns='%s'/>" % self.NS_SM)
 
+    data = ''.join(self.__outbuf)
+    del self.__outbuf[:]
+    try:
+      self.conn.Connection._send(data)
     except IOError:
       self.disconnected(self.ConnectFailure)
 
+  def __build_stanza(self,mess):
+    """return an xmpp.Message stanza for the given Message"""
+
+    (text,to) = (mess.get_text(),mess.get_to())
+
+    if mess.get_emote():
+      text = '/me '+mess.get_text()
+
+    stanza = self.__build_message(text)
+    stanza.setType('chat')
+    if isinstance(to,Room):
+      stanza.setType('groupchat')
+      to = to.get_name()
+    stanza.setTo(xmpp.JID(str(to)))
+    return stanza
+
   def broadcast(self,mess):
     """send a message to every user in a room"""
 
@@ -328,16 +434,17 @@ class XMPP(Protocol):
     nick = room.get_nick() or self.opt('nick_name')
     pword = room.get_password()
 
-    # do nothing if we're already trying to join that room
-    for x in self.__muc_pending:
-      if x[1]==name:
-        return
+    # do nothing if we're already in or trying to join that room
+    if name in self.__muc_pending:
+      return
+    if self.__muc_in(name) and self.mucs[name]['nick']==nick:
+      return
 
-    # we'll receive a reply stanza with matching id telling us if we succeeded,
-    # but due to the way xmpppy processes stanzas, we can't easily wait for the
-    # given stanza inside a callback without blocking or race conditions
+    # the join is sent during the next process() and callback_presence() will
+    # catch the response, so we never block waiting for the server
     self.mucs[name] = {'pass':pword,'nick':nick,'status':self.MUC_PENDING}
-    self.__muc_pending.append((name,nick,pword))
+    self._rooms_changed()
+    self.__muc_pending[name] = None
 
   def part_room(self,room):
     """leave the specified room"""
@@ -345,17 +452,17 @@ class XMPP(Protocol):
     name = room.get_name()
 
     # build the part stanza
-    if self.mucs[name]['status']==self.MUC_OK:
+    if self.conn and self.mucs[name]['status']==self.MUC_OK:
       room_jid = name+'/'+self.mucs[name]['nick']
       pres = xmpp.Presence(to=room_jid)
       pres.setAttr('type', 'unavailable')
-      try:
-        self.conn.send(pres)
-      except IOError:
-        self.disconnected(self.ConnectFailure)
+      self.__write(pres)
 
     # update mucs dict and log
+    self.__muc_pending.pop(name,None)
+    self.__roster_clear(name)
     self.mucs[name]['status'] = self.MUC_PARTED
+    self._rooms_changed()
     self.log.debug('Parted room "%s"' % name)
 
   def _get_rooms(self,flag):
@@ -379,17 +486,11 @@ class XMPP(Protocol):
     """return the Users in the given room, or None if we are not in the room"""
 
     name = room.get_name()
+    mine = self.get_nick(room)
 
-    # search through who we've seen for anyone with the room in their JID
-    users = []
-    for jid in self.seen:
-      if ((name==jid.getStripped())
-          and (self.mucs[name]['nick']!=jid.getResource())):
-        users.append(JID(self,jid,typ=Message.GROUP))
-
-    me = JID(self,name+'/'+self.get_nick(room),typ=Message.GROUP)
-    if me not in users:
-      users.append(me)
+    users = [JID(self,name+'/'+nick,typ=Message.GROUP)
+        for nick in self.rosters.get(name,{}) if nick!=mine]
+    users.append(JID(self,name+'/'+mine,typ=Message.GROUP))
 
     return users
 
@@ -405,8 +506,8 @@ class XMPP(Protocol):
       return JID(self,self.jid)
 
     jid = xmpp.JID(room.get_name()+'/'+nick)
-    real = self.real_jids.get(jid,nick)
-    if real==nick:
+    real = self.__real_jid(jid)
+    if real is None:
       return JID(self,jid,typ=Message.GROUP)
 
     return JID(self,real)
@@ -458,16 +559,15 @@ class XMPP(Protocol):
       # Ignore messages from myself
       room = jid.getStripped()
       if ((self.jid==jid) or
-          (room in self.__get_current_mucs()
+          (self.__muc_in(room)
               and jid.getResource()==self.mucs[room]['nick'])):
         return
 
     # Ignore messages from users not seen by this bot
-    real = [j.getStripped() for j in self.real_jids.values()]
-    if (jid not in self.seen) and (jid.getStripped() not in real):
+    if (jid not in self.seen) and (jid.getStripped() not in self.__real_users):
       self.log.info('Ignoring message from unseen guest: %s' % jid)
       self.log.debug("I've seen: %s" %
-        ["%s" % x for x in self.seen.keys()+real])
+        ["%s" % x for x in self.seen.keys()+list(self.__real_users)])
       return
 
     if len(text)>40:
@@ -477,9 +577,9 @@ class XMPP(Protocol):
     self.log.debug('Got %s from %s: "%s"' % (typ,jid,txt))
 
     typ = self.TYPES[typ]
-    real = None
-    if jid in self.real_jids:
-      real = JID(self,self.real_jids[jid])
+    real = self.__real_jid(jid)
+    if real is not None:
+      real = JID(self,real)
     user = JID(self,jid,typ=typ,real=real)
 
     if room:
@@ -499,23 +599,18 @@ class XMPP(Protocol):
                               pres.getShow(),pres.getStatus())
     frm = pres.getFrom()
 
-    # keep track of "real" JIDs in a MUC
+    # finish joining a MUC when the server responds to our join presence
+    muc = jid.getStripped()
+    pending = self.__muc_pending.get(muc)
+    if pending and (pres.getID()==pending[0]
+        or jid.getResource()==self.mucs[muc]['nick']):
+      self.__muc_joined(muc,pres.getError() if typ=='error' else None)
+
+    # keep track of MUC occupants and their "real" JIDs
     # when joining a MUC other member presence might come before confirmation
-    real = None
-    if ((jid.getStripped() in self.__get_current_mucs()) or
-        (jid.getStripped() in [x[0] for x in self.__muc_pending])):
-      x_tags = pres.getTags('x')
-      for x_tag in x_tags:
-        item_tags = x_tag.getTags('item')
-        for item_tag in item_tags:
-          real = item_tag.getAttr('jid')
-          if real is None:
-            continue
-          self.real_jids[jid] = xmpp.protocol.JID(real)
-          self.log.debug('JID: '+str(jid)+' = realJID: '+real)
-          break
-        if real is not None:
-          break
+    in_muc = (self.__muc_in(muc) or muc in self.__muc_pending)
+    if in_muc:
+      self.__roster_update(muc,jid.getResource(),pres)
 
     # update internal status
     if self.jid.bareMatch(jid):
@@ -560,7 +655,7 @@ class XMPP(Protocol):
 
     # Catch kicked from the room
     room = jid.getStripped()
-    if (room in self.__get_current_mucs()
+    if (self.__muc_in(room)
         and jid.getResource()==self.mucs[room]['nick']):
       code = pres.getStatusCode()
       if not code and typ==self.OFFLINE:
@@ -569,6 +664,8 @@ class XMPP(Protocol):
         code = int(code)
         if code in self.MUC_CODES:
           self.mucs[room]['status'] = code
+          self.__roster_clear(room)
+          self._rooms_changed()
           self.last_join = time.time()
           (text,func) = self.MUC_CODES[code]
           func('Forced from room "%s" (%s)' % (room,text))
@@ -620,11 +717,12 @@ class XMPP(Protocol):
     jid_typ = Message.PRIVATE
     real = None
     room = None
-    if jid.getStripped() in self.__get_current_mucs()+self.__get_pending_mucs():
+    if in_muc:
       jid_typ = Message.GROUP
-      room = MUC(self,jid.getStripped())
-      if jid in self.real_jids:
-        real = JID(self,self.real_jids[jid])
+      room = MUC(self,muc)
+      real = self.__real_jid(jid)
+      if real is not None:
+        real = JID(self,real)
     frm = JID(self,jid,typ=jid_typ)
     if real:
       frm.set_real(real)
@@ -633,6 +731,15 @@ class XMPP(Protocol):
     msg = Message(frm,None,typ=typ,status=status,msg=status_msg,room=room)
     self.bot._cb_message(msg)
 
+  def callback_iq(self,conn,iq):
+    """run upon receiving an iq stanza to catch responses to our pings"""
+
+    # any response (even an error) means the server is still there
+    if self.__ping_id and iq.getID()==self.__ping_id:
+      self.__ping_id = None
+      self.log.debug('Ping response after %.3f sec'
+          % (time.time()-self.last_ping))
+
 ################################################################################
 # Helper functions
 ################################################################################
@@ -703,11 +810,8 @@ class XMPP(Protocol):
 
   def __send_status(self):
     """Send status to everyone"""
-    try:
-      self.conn.send(xmpp.dispatcher.Presence(show=self.__show,
+    self.__write(xmpp.dispatcher.Presence(show=self.__show,
         status=self.__status))
-    except IOError:
-      self.disconnected(self.ConnectFailure)
 
   def __idle_proc(self):
     """ping, join pending mucs, and try to rejoin mucs we were forced from"""
@@ -719,37 +823,225 @@ class XMPP(Protocol):
   def __idle_ping(self):
     """send pings to make sure the server is still there"""
 
-    # build a ping stanza and send it if it's been long enough since last ping
+    # callback_iq() clears the id when the response arrives, so if it's still
+    # set after ping_timeout the server isn't there anymore
+    if self.__ping_id:
+      if time.time()-self.last_ping>self.opt('xmpp.ping_timeout'):
+        self.log.debug('No response to ping "%s"' % self.__ping_id)
+        self.disconnected(self.PingTimeout)
+      return
+
+    # receiving anything proves the server is there, so only ping when idle
+    last = max(self.last_ping,self.last_recv)
     if (self.opt('xmpp.ping_freq')
-        and time.time()-self.last_ping>self.opt('xmpp.ping_freq')):
+        and time.time()-last>self.opt('xmpp.ping_freq')):
       self.last_ping = time.time()
       payload = [xmpp.Node('ping',attrs={'xmlns':'urn:xmpp:ping'})]
       ping = xmpp.Protocol('iq',typ='get',payload=payload)
 
-      # raise PingTimeout if pinging fails
-      try:
-        res = self.conn.SendAndWaitForResponse(ping,
-            self.opt('xmpp.ping_timeout'))
-      except IOError:
-        self.disconnected(self.PingTimeout)
-      if res is None:
-        self.disconnected(self.PingTimeout)
+      # don't wait for the response; callback_iq() will catch it
+      self.__ping_id = self.__write(ping)
+
+################################################################################
+# XEP-0198 Stream Management
+################################################################################
+# Every stanza sent after <enable/> is kept in self.__sm_unacked until the
+# server acks it with <a h='count'/>, and every stanza we receive increments
+# self.__sm_in which we send when the server asks with <r/>. If the connection
+# drops we keep all of that (and our MUCs) and send <resume/> instead of
+# binding a new resource. The server then tells us how many of our stanzas it
+# got so we can send the rest, and sends us whatever we missed. If it can't
+# resume we fall back to a new session and rejoin our MUCs like before.
+################################################################################
+
+  def __sm_reset(self):
+    """forget our stream management session"""
+
+    self.__sm_id = None
+    self.__sm_max = None
+    self.__sm_lost = None
+    self.__sm_in = None
+    self.__sm_acked = 0
+    self.__sm_asked = False
+    self.__sm_unacked.clear()
+
+  def __sm_resumable(self):
+    """return True if the server should still have our old session"""
+
+    if not (self.__sm_id and self.__sm_lost):
+      return False
+    return (not self.__sm_max or time.time()-self.__sm_lost<self.__sm_max)
+
+  # @param conn (xmpp.Client) a new connection that is already authenticated
+  def __sm_plugin(self,conn):
+    """count stanzas in both directions on the given connection"""
+
+    for name in ('enabled','resumed','failed'):
+      conn.RegisterHandler(name,self.callback_sm,xmlns=self.NS_SM)
+    conn.RegisterHandler('r',self.callback_sm_request,xmlns=self.NS_SM)
+    conn.RegisterHandler('a',self.callback_sm_ack,xmlns=self.NS_SM)
+
+    # system handlers still run for responses xmpppy is waiting on
+    for name in self.SM_STANZAS:
+      conn.RegisterHandler(name,self.callback_sm_count,makefirst=1,system=1)
+
+    # xmpppy internals (e.g. roster) use Dispatcher.send, so catch both
+    self.__sm_send = conn.Dispatcher.send
+    conn.send = conn.Dispatcher.send = self.__sm_track
+
+  def __sm_track(self,stanza):
+    """send a stanza and remember it until the server acks it"""
+
+    ID = self.__sm_send(stanza)
+    if (self.__sm_id and isinstance(stanza,xmpp.Protocol)
+        and stanza.getName() in self.SM_STANZAS):
+      self.__sm_unacked.append(stanza)
+    return ID
+
+  # @param conn (xmpp.Client) the connection to wait on
+  # @return (xmpp.Protocol) the server's response or None on timeout
+  def __sm_wait(self,conn):
+    """block until the server responds to <enable/> or <resume/>"""
+
+    self.__sm_reply = None
+    timeout = time.time()+self.opt('xmpp.ping_timeout')
+    while self.__sm_reply is None and time.time()<timeout:
+      if not conn.Process(1):
+        break
+    return self.__sm_reply
+
+  def __sm_enable(self,conn):
+    """enable stream management if the server supports it"""
+
+    self.__sm_reset()
+    features = conn.Dispatcher.Stream.features
+    if not (self.opt('xmpp.stream_mgmt') and features
+        and features.getTag('sm',namespace=self.NS_SM)):
+      return
+
+    conn.send("<enable xmlns='%s' resume='true'/>" % self.NS_SM)
+    reply = self.__sm_wait(conn)
+    if not reply or reply.getName()!='enabled':
+      self.log.warning('Server refused to enable stream management')
+      return
+
+    # we still have to answer acks even if we aren't allowed to resume
+    self.__sm_in = 0
+    if reply.getAttr('resume') in ('true','1'):
+      self.__sm_id = str(reply.getAttr('id'))
+      self.__sm_max = int(reply.getAttr('max') or 0)
+    self.log.debug('Enabled stream management (resume id: %s)'
+        % self.__sm_id)
+
+  # @param conn (xmpp.Client) a new connection that is authenticated but
+  #   doesn't have a resource bound yet
+  # @return (bool) True if the server resumed our old session
+  def __sm_resume(self,conn):
+    """try to resume our old session and replay unacked stanzas"""
+
+    conn.send("<resume xmlns='%s' h='%s' previd='%s'/>"
+        % (self.NS_SM,self.__sm_in,self.__sm_id))
+    reply = self.__sm_wait(conn)
+    if not reply or reply.getName()!='resumed':
+      self.log.info('Unable to resume stream after %.1f sec'
+          % (time.time()-self.__sm_lost))
+      return False
+
+    # drop whatever the server got before we lost the connection
+    self.__sm_ack(reply.getAttr('h'))
+    stanzas = list(self.__sm_unacked)
+    self.__sm_unacked.clear()
+    self.log.info('Resumed stream after %.1f sec; resending %i stanzas'
+        % (time.time()-self.__sm_lost,len(stanzas)))
+
+    self.__sm_lost = None
+    for stanza in stanzas:
+      conn.send(stanza)
+    if stanzas:
+      self.__sm_asked = True
+      conn.send("<r xmlns='%s'/>" % self.NS_SM)
+    return True
+
+  # @param h (str) the number of our stanzas the server has handled
+  def __sm_ack(self,h):
+    """forget stanzas the server has acked"""
+
+    h = int(h)
+    count = (h-self.__sm_acked) % 2**32
+    for i in range(min(count,len(self.__sm_unacked))):
+      self.__sm_unacked.popleft()
+    self.__sm_acked = h
+
+  def __sasl(self,conn):
+    """authenticate without binding a resource so we can resume"""
+
+    xmpp.auth.SASL(self.jid.getNode(),self.opt('xmpp.password')).PlugIn(conn)
+    if conn.SASL.startsasl=='not-supported':
+      raise self.AuthFailure
+    conn.SASL.auth()
+    while conn.SASL.startsasl=='in-process' and conn.Process(1):
+      pass
+    if conn.SASL.startsasl!='success':
+      raise self.AuthFailure
+
+    # SASL restarts the stream so we need the new features
+    while not conn.Dispatcher.Stream.features and conn.Process(1):
+      pass
+
+  def __bind(self,conn):
+    """bind a resource after __sasl() if we couldn't resume"""
+
+    xmpp.auth.Bind().PlugIn(conn)
+    while conn.Bind.bound is None and conn.Process(1):
+      pass
+    if not conn.Bind.Bind(self.opt('xmpp.resource')):
+      raise self.AuthFailure
+
+  def callback_sm(self,conn,stanza):
+    """catch the response to <enable/> or <resume/>"""
+
+    self.__sm_reply = stanza
+    raise xmpp.NodeProcessed
+
+  def callback_sm_request(self,conn,stanza):
+    """tell the server how many stanzas we've handled"""
+
+    if self.__sm_in is not None:
+      conn.send("<a xmlns='%s' h='%s'/>" % (self.NS_SM,self.__sm_in))
+    raise xmpp.NodeProcessed
+
+  def callback_sm_ack(self,conn,stanza):
+    """forget stanzas the server has handled"""
+
+    self.__sm_asked = False
+    if self.__sm_id:
+      self.__sm_ack(stanza.getAttr('h'))
+    raise xmpp.NodeProcessed
+
+  def callback_sm_count(self,conn,stanza):
+    """count every stanza we receive"""
+
+    if self.__sm_in is not None:
+      self.__sm_in = (self.__sm_in+1) % 2**32
 
 ################################################################################
 # XEP-0045 Multi User Chat (MUC)
 ################################################################################
 # Joining a MUC (2 asynchronous execution paths)
 #
-# (1) User calls self.join_room() which adds MUC info to self.__muc_pending
+# (1) User calls self.join_room() which adds the MUC to self.__muc_pending
 #     with status MUC_PENDING
 #
 # (1) Approx once per second self.process() is called
 # (2) Which calls self.__idle_proc()
 # (3) Which calls self.__idle_join_muc()
-# (4) Which tries to join every MUC in self.__muc_pending
-# (5) By calling self.__muc_join() which sends a stanza and checks for success
-# (6) On success self.mucs is updated to have MUC_OK
+# (4) Which sends a join stanza for every MUC in self.__muc_pending at once
+#     using self.__muc_join() and remembers the stanza id and time
+# (5) self.callback_presence() gets our own presence or an error from the MUC
+# (6) Which calls self.__muc_joined() to finish the join
+# (7) On success self.mucs is updated to have MUC_OK
 #     On failure self.mucs is updated to have MUC_PARTED and we won't rejoin
+#     If there's no response within join_timeout it counts as a failure
 ################################################################################
 # Getting forced from a MUC
 #
@@ -762,8 +1054,8 @@ class XMPP(Protocol):
 # (1) Approx once per second self.process() is called
 # (2) Which calls self.__idle_proc()
 # (3) Which calls self.__idle_rejoin_muc()
-# (4) Which tries to rejoin every MUC except MUC_PARTED, MUC_PENDING, MUC_OK
-# (5) By calling self.__muc_join() which sends a stanza and checks for success
+# (4) Which sends joins for every MUC except MUC_PARTED, MUC_PENDING, MUC_OK
+# (5) The responses are handled the same as above
 # (6) On success self.mucs is updated to have MUC_OK
 #     On failure self.mucs has the error code or MUC_ERR and we will rejoin
 ################################################################################
@@ -775,34 +1067,25 @@ class XMPP(Protocol):
 ################################################################################
 
   def __idle_join_muc(self):
-    """join pending MUCs"""
-
-    if len(self.__muc_pending):
-      try:
-        # try to join the first MUC in the queue
-        (room,user,pword) = self.__muc_pending[0]
-        self.__muc_join(room,user,pword)
-        self.__muc_join_success(room)
+    """join pending MUCs and time out ones that never responded"""
 
-      # we only rejoin if we were able to rejoin successfully in the past
-      except MUCJoinFailure as e:
-        self.__muc_join_failure(room,e.message)
-        if self.mucs[room]['status'] > self.MUC_OK:
-          self.log.debug('Rejoining room "%s" in %i sec'
-              % (room,self.opt('recon_min')))
-        else:
-          self.mucs[room]['status'] = self.MUC_PARTED
+    # send every join at once; callback_presence() will catch the responses
+    for (room,sent) in self.__muc_pending.items():
+      if sent is None:
+        self.__muc_join(room)
 
-      # we need this to happen after successful joining to catch presences
-      finally:
-        del self.__muc_pending[0]
+    timeout = self.opt('xmpp.join_timeout')
+    for (room,(ID,t)) in self.__muc_pending.items():
+      if time.time()-t>timeout:
+        self.__muc_joined(room,'timeout')
 
-  def __muc_join(self,room,nick,pword):
-    """send XMPP stanzas to join a muc and raise MUCJoinFailure if error"""
+  def __muc_join(self,room):
+    """send XMPP stanzas to join a muc without waiting for a response"""
 
     # build the room join stanza
     NS_MUC = 'http://jabber.org/protocol/muc'
     nick = self.mucs[room]['nick']
+    pword = self.mucs[room]['pass']
     room_jid = room+'/'+nick
 
     # request no history and add password if we need one
@@ -812,25 +1095,39 @@ class XMPP(Protocol):
     if pword is not None:
       pres.setTag('x',namespace=NS_MUC).setTagData('password',pword)
 
-    # try to join and wait for response
+    # send the join and remember when so we can time out
     self.log.debug('Attempting to join room "%s"' % room)
     self.last_muc = room
-    try:
-      result = self.conn.SendAndWaitForResponse(pres)
-    except IOError:
-      self.disconnected(self.ConnectFailure)
-
-    # result is None for timeout
-    if not result:
-      raise MUCJoinFailure('timeout')
-
-    # check for error
-    error = result.getError()
-    if error:
-      raise MUCJoinFailure(error)
+    ID = self.__write(pres)
+    self.__muc_pending[room] = (ID,time.time())
+
+  # @param room (str) the MUC we were trying to join
+  # @param error (str) [None] the reason we failed, or None on success
+  def __muc_joined(self,room,error=None):
+    """finish a pending join and execute callbacks if it was the first try"""
+
+    del self.__muc_pending[room]
+    muc = self.mucs[room]
+    first = (muc['status']==self.MUC_PENDING)
+
+    if not error:
+      muc['status'] = self.MUC_OK
+      self._rooms_changed()
+      if first:
+        self.__muc_join_success(room)
+      else:
+        self.log.info('Rejoined room "%s"' % room)
+      return
 
-    # we joined successfully
-    self.mucs[room]['status'] = self.MUC_OK
+    # we only rejoin if we were able to join successfully in the past
+    self.__roster_clear(room)
+    if first:
+      self.__muc_join_failure(room,error)
+      muc['status'] = self.MUC_PARTED
+      self._rooms_changed()
+    else:
+      self.log.debug('Failed to rejoin room "%s" (%s); retrying in %i sec'
+          % (room,error,self.opt('recon_min')))
 
   def __muc_join_success(self,room):
     """execute callbacks on successfull MUC join"""
@@ -840,7 +1137,8 @@ class XMPP(Protocol):
   def __muc_join_failure(self,room,error):
     """execute callbacks on successfull MUC join"""
 
-    self.bot._cb_join_room_failure(MUC(self,room),self.MUC_JOIN_ERROR[error])
+    error = self.MUC_JOIN_ERROR.get(error,error)
+    self.bot._cb_join_room_failure(MUC(self,room),error)
 
   def __idle_rejoin_muc(self):
     """attempt to rejoin the MUC if needed"""
@@ -852,13 +1150,10 @@ class XMPP(Protocol):
 
     # we'll keep trying until the user tells us to stop via part_room()
     for room in self.mucs:
-      if self.mucs[room]['status']>self.MUC_OK:
-        self.__lastjoin = time.time()
-        muc = self.mucs[room]
-        try:
-          self.__muc_join(room,muc['nick'],muc['pass'])
-        except MUCJoinFailure:
-          pass
+      if (self.mucs[room]['status']>self.MUC_OK
+          and room not in self.__muc_pending):
+        self.last_join = t
+        self.__muc_join(room)
 
   def __get_current_mucs(self):
     """return all mucs that we are currently in"""
@@ -875,10 +1170,11 @@ class XMPP(Protocol):
 
     return [r for r in self.mucs if self.mucs[r]['status']!=self.MUC_OK]
 
-  def __get_pending_mucs(self):
-    """return all mucs whose connection is currently pending"""
+  def __muc_in(self,room):
+    """return True if we are currently in the given muc"""
 
-    return [r for r in self.mucs if self.mucs[r]['status']==self.MUC_PENDING]
+    muc = self.mucs.get(room)
+    return muc is not None and muc['status']==self.MUC_OK
 
   def __get_sender_username(self, mess):
     """Extract the sender's user name from a message"""
@@ -891,3 +1187,64 @@ class XMPP(Protocol):
     else:
       username = ""
     return username
+
+################################################################################
+# MUC rosters
+################################################################################
+
+  # @param room (str) the MUC the presence came from
+  # @param nick (str) the occupant's nick
+  # @param pres (xmpp.Presence) the presence stanza
+  def __roster_update(self,room,nick,pres):
+    """add, update, or remove an occupant from a MUC roster"""
+
+    typ = pres.getType()
+    if typ==self.OFFLINE:
+      self.__roster_del(room,nick)
+      return
+    if typ is not None:
+      return
+
+    # the real JID is only included the first time in some rooms
+    old = self.rosters.get(room,{}).get(nick)
+    real = old and old['real']
+    for x_tag in pres.getTags('x'):
+      for item_tag in x_tag.getTags('item'):
+        if item_tag.getAttr('jid'):
+          real = xmpp.JID(item_tag.getAttr('jid'))
+          break
+
+    if old and old['real'] and old['real']!=real:
+      self.__roster_del(room,nick)
+      old = None
+    if not old and real:
+      self.__real_users[real.getStripped()] += 1
+      self.log.debug('JID: %s/%s = realJID: %s' % (room,nick,real))
+
+    self.rosters.setdefault(room,{})[nick] = {'real':real,
+        'show':pres.getShow(),'status':pres.getStatus()}
+
+  def __roster_del(self,room,nick):
+    """remove an occupant from a MUC roster"""
+
+    old = self.rosters.get(room,{}).pop(nick,None)
+    if old and old['real']:
+      real = old['real'].getStripped()
+      self.__real_users[real] -= 1
+      if self.__real_users[real]<=0:
+        del self.__real_users[real]
+
+  def __roster_clear(self,room):
+    """forget every occupant of a MUC we're no longer in"""
+
+    for nick in self.rosters.get(room,{}).keys():
+      self.__roster_del(room,nick)
+    self.rosters.pop(room,None)
+
+  # @param jid (xmpp.JID) the full JID of a MUC occupant
+  # @return (xmpp.JID) the occupant's real JID or None if we don't know it
+  def __real_jid(self,jid):
+    """return the real JID of a MUC occupant"""
+
+    occupant = self.rosters.get(jid.getStripped(),{}).get(jid.getResource())
+    return occupant and occupant['real']
@@ -38,6 +38,9 @@ def conf(bot):
 
 class MYUSER(User):
 
+  # list every attribute you set in parse(); this saves a __dict__ per object
+  __slots__ = ()
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = (Protocol) name of this User's protocol as a str
   #   self.typ = (int) either Message.PRIVATE or Message.GROUP
@@ -69,6 +72,9 @@ class MYUSER(User):
 
 class MYROOM(Room):
 
+  # list every attribute you set in parse(); this saves a __dict__ per object
+  __slots__ = ()
+
   # called on object init; the following are already created by __init__:
   #   self.protocol = name of this Room's protocol as a str
   #   self.nick = the nick name to use in the room (defaults to None)
@@ -145,11 +151,13 @@ class MYPROTOCOL(Protocol):
 
   # part the specified room
   # @param room (Room) the room to leave
+  # @call self._rooms_changed() after leaving the room
   def part_room(self,room):
     raise NotImplementedError
 
   # helper function for get_rooms() for protocol-specific flags
   # only needs to handle: FLAG_PARTED, FLAG_PENDING, FLAG_IN, FLAG_ALL
+  # results are cached, so call self._rooms_changed() when they might change
   # @param flag (int) one of Room.FLAG_* enums
   # @return (list of Room) rooms matching the flag
   def _get_rooms(self,flag):
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import socket,select,threading,email
+
+class MockSMTPServer(threading.Thread):
+  """a tiny single-client SMTP server that's just enough for smtplib"""
+
+  def __init__(self):
+    super(MockSMTPServer,self).__init__()
+    self.daemon = True
+
+    self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    self.sock.bind(('localhost',0))
+    self.sock.listen(5)
+    self.port = self.sock.getsockname()[1]
+
+    self.event_close = threading.Event()
+    self.lock = threading.Lock()
+    self.client = None
+
+    # things tests can look at or change
+    self.connects = 0
+    self.logins = 0
+    self.commands = []
+    self.messages = []
+    self.refuse = set()
+
+  def stop(self):
+    self.event_close.set()
+    self.join()
+
+  def drop(self):
+    """close the client socket without saying goodbye"""
+
+    with self.lock:
+      if self.client:
+        self.client.close()
+        self.client = None
+
+  def connected(self):
+    return self.client is not None
+
+  def write(self,line):
+    with self.lock:
+      if self.client:
+        self.client.sendall(line+'\r\n')
+
+  def run(self):
+    while not self.event_close.is_set():
+      (r,w,x) = select.select([self.sock],[],[],0.1)
+      if r:
+        (client,addr) = self.sock.accept()
+        with self.lock:
+          self.client = client
+        self.connects += 1
+        self.serve(client)
+    self.drop()
+    self.sock.close()
+
+  def serve(self,client):
+    self.write('220 localhost ESMTP mock')
+    (buf,data) = ('',None)
+    while not self.event_close.is_set() and self.client is client:
+      try:
+        (r,w,x) = select.select([client],[],[],0.1)
+        if not r:
+          continue
+        chunk = client.recv(65536)
+      except (socket.error,ValueError):
+        break
+      if not chunk:
+        break
+
+      buf += chunk
+      while '\r\n' in buf:
+        (line,buf) = buf.split('\r\n',1)
+        if data is not None:
+          if line=='.':
+            self.deliver(data)
+            data = None
+          else:
+            data.append(line[1:] if line.startswith('.') else line)
+        elif self.handle(line):
+          data = []
+    self.drop()
+
+################################################################################
+# Command handling
+################################################################################
+
+  def handle(self,line):
+    """reply to a command and return True if it started DATA"""
+
+    cmd = line.split(' ')[0].upper()
+    arg = line[len(cmd)+1:]
+    self.commands.append(cmd)
+
+    if cmd=='EHLO':
+      self.write('250-localhost')
+      self.write('250 AUTH PLAIN')
+    elif cmd=='HELO':
+      self.write('250 localhost')
+    elif cmd=='AUTH':
+      self.logins += 1
+      self.write('235 authenticated')
+    elif cmd=='MAIL':
+      self.rcpt = []
+      self.write('250 ok')
+    elif cmd=='RCPT':
+      rcpt = arg.split(':',1)[1].strip('<>')
+      if rcpt in self.refuse:
+        self.write('550 no such user')
+      else:
+        self.rcpt.append(rcpt)
+        self.write('250 ok')
+    elif cmd=='DATA':
+      self.write('354 go ahead')
+      return True
+    elif cmd in ('NOOP','RSET'):
+      self.write('250 ok')
+    elif cmd=='QUIT':
+      self.write('221 bye')
+      self.drop()
+    else:
+      self.write('502 not implemented')
+    return False
+
+  def deliver(self,lines):
+    msg = email.message_from_string('\n'.join(lines))
+    self.messages.append((self.rcpt,msg.get_payload(decode=True)))
+    self.write('250 queued')
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import socket,select,threading,time
+from xml.parsers import expat
+from xml.sax.saxutils import quoteattr
+
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+NS_ROSTER = 'jabber:iq:roster'
+NS_PING = 'urn:xmpp:ping'
+NS_MUC_USER = 'http://jabber.org/protocol/muc#user'
+NS_SM = 'urn:xmpp:sm:3'
+
+STANZAS = ('message','presence','iq')
+
+class Node(object):
+
+  def __init__(self,name,attrs):
+    self.name = name
+    self.attrs = attrs
+    self.children = []
+    self.text = ''
+
+  def get(self,name):
+    for child in self.children:
+      if child.name==name:
+        return child
+    return None
+
+  def __repr__(self):
+    return '<%s %s>' % (self.name,self.attrs)
+
+class MockXMPPServer(threading.Thread):
+  """a tiny single-client XMPP server that's just enough for xmpppy"""
+
+  def __init__(self,domain='example.com'):
+    super(MockXMPPServer,self).__init__()
+    self.daemon = True
+
+    self.domain = domain
+    self.sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    self.sock.bind(('localhost',0))
+    self.sock.listen(5)
+    self.port = self.sock.getsockname()[1]
+
+    self.event_close = threading.Event()
+    self.lock = threading.Lock()
+    self.client = None
+    self.connects = 0
+
+    # things tests can look at or change
+    self.stanzas = []
+    self.messages = []
+    self.answer_pings = True
+    self.deny = {}
+    self.ignore = set()
+    self.occupants = {}
+    self.stream_mgmt = True
+    self.resumable = True
+
+    # XEP-0198 session state, which outlives the client socket
+    self.sm_id = None
+    self.sm_on = False
+    self.sm_in = 0
+    self.sm_out = 0
+    self.sm_acks = []
+    self.resumes = 0
+
+  def stop(self):
+    self.event_close.set()
+    self.join()
+
+  def drop(self):
+    """close the client socket without ending the stream"""
+
+    with self.lock:
+      if self.client:
+        self.client.close()
+        self.client = None
+
+  def request_ack(self):
+    self.write("<r xmlns='%s'/>" % NS_SM)
+
+  def write(self,data):
+    with self.lock:
+      if self.sm_on and data.startswith(tuple('<'+s for s in STANZAS)):
+        self.sm_out += 1
+      if self.client:
+        self.client.sendall(data.encode('utf8')
+            if isinstance(data,unicode) else data)
+
+  def run(self):
+    while not self.event_close.is_set():
+      (r,w,x) = select.select([self.sock],[],[],0.1)
+      if r:
+        (client,addr) = self.sock.accept()
+        with self.lock:
+          self.client = client
+        self.connects += 1
+        self.authed = False
+        self.sm_on = False
+        self.serve(client)
+    self.drop()
+    self.sock.close()
+
+  def serve(self,client):
+    self.reset()
+    while not self.event_close.is_set() and self.client is client:
+      try:
+        (r,w,x) = select.select([client],[],[],0.1)
+        if not r:
+          continue
+        data = client.recv(65536)
+      except (socket.error,ValueError):
+        break
+      if not data:
+        break
+      self.received += len(data)
+      try:
+        self.parser.Parse(data)
+      except expat.ExpatError:
+        break
+    self.drop()
+
+################################################################################
+# XML stream parsing
+################################################################################
+
+  def reset(self):
+    """start a new XML stream (after connecting or SASL)"""
+
+    self.parser = expat.ParserCreate()
+    self.parser.StartElementHandler = self.on_start
+    self.parser.EndElementHandler = self.on_end
+    self.parser.CharacterDataHandler = self.on_data
+    self.stack = []
+    self.received = 0
+
+  def on_start(self,name,attrs):
+    node = Node(name,attrs)
+    if self.stack:
+      self.stack[-1].children.append(node)
+    self.stack.append(node)
+    if name=='stream:stream':
+      self.stream_open(node)
+
+  def on_end(self,name):
+    node = self.stack.pop()
+    if len(self.stack)==1:
+      self.stanzas.append(node)
+      self.handle(node)
+
+  def on_data(self,text):
+    if self.stack:
+      self.stack[-1].text += text
+
+################################################################################
+# Stanza handling
+################################################################################
+
+  def stream_open(self,node):
+    self.jid = None
+    self.write("<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+        "xmlns:stream='http://etherx.jabber.org/streams' from='%s' "
+        "id='stream%s' version='1.0'>" % (self.domain,self.connects))
+    self.write('<stream:features>%s</stream:features>' % self.features())
+
+  def features(self):
+    if not self.authed:
+      return ("<mechanisms xmlns='%s'><mechanism>PLAIN</mechanism>"
+          "</mechanisms>" % NS_SASL)
+    sm = ("<sm xmlns='%s'/>" % NS_SM) if self.stream_mgmt else ''
+    return ("<bind xmlns='%s'/><session xmlns='%s'/>%s"
+        % (NS_BIND,NS_SESSION,sm))
+
+  def handle(self,node):
+    if self.sm_on and node.name in STANZAS:
+      self.sm_in += 1
+    func = getattr(self,'handle_'+node.name.replace(':','_'),None)
+    if func:
+      func(node)
+
+  def handle_auth(self,node):
+    self.authed = True
+    self.write("<success xmlns='%s'/>" % NS_SASL)
+    self.reset()
+
+  def handle_enable(self,node):
+    self.sm_on = True
+    (self.sm_in,self.sm_out) = (0,0)
+    self.sm_id = None
+    if node.attrs.get('resume')=='true':
+      self.sm_id = 'sm%s' % self.connects
+    self.write("<enabled xmlns='%s' id='%s' resume='%s' max='60'/>"
+        % (NS_SM,self.sm_id,str(bool(self.sm_id)).lower()))
+
+  def handle_r(self,node):
+    self.write("<a xmlns='%s' h='%s'/>" % (NS_SM,self.sm_in))
+
+  def handle_a(self,node):
+    self.sm_acks.append(int(node.attrs['h']))
+
+  def handle_resume(self,node):
+    if not (self.resumable and self.sm_id
+        and node.attrs.get('previd')==self.sm_id):
+      self.sm_id = None
+      self.write("<failed xmlns='%s'><item-not-found xmlns='%s'/></failed>"
+          % (NS_SM,NS_STANZAS))
+      return
+
+    self.resumes += 1
+    self.sm_on = True
+    self.sm_acks.append(int(node.attrs['h']))
+    self.write("<resumed xmlns='%s' previd='%s' h='%s'/>"
+        % (NS_SM,self.sm_id,self.sm_in))
+
+  def handle_iq(self,node):
+    (typ,ID) = (node.attrs.get('type'),node.attrs.get('id',''))
+    if typ not in ('get','set'):
+      return
+    child = node.children[0] if node.children else Node('',{})
+    ns = child.attrs.get('xmlns')
+
+    if ns==NS_BIND:
+      res = child.get('resource')
+      self.jid = 'sibyl@%s/%s' % (self.domain,res.text if res else 'sibyl')
+      self.result(ID,"<bind xmlns='%s'><jid>%s</jid></bind>"
+          % (NS_BIND,self.jid))
+    elif ns==NS_SESSION:
+      self.result(ID)
+    elif ns==NS_ROSTER:
+      self.result(ID,"<query xmlns='%s'/>" % NS_ROSTER)
+    elif ns==NS_PING:
+      if self.answer_pings:
+        self.result(ID)
+    else:
+      self.write("<iq type='error' id=%s><error type='cancel'>"
+          "<service-unavailable xmlns='%s'/></error></iq>"
+          % (quoteattr(ID),NS_STANZAS))
+
+  def result(self,ID,payload=''):
+    self.write("<iq type='result' id=%s>%s</iq>" % (quoteattr(ID),payload))
+
+  def handle_presence(self,node):
+    to = node.attrs.get('to','')
+    if '/' not in to:
+      return
+
+    (room,nick) = to.split('/',1)
+    ID = node.attrs.get('id','')
+    if room in self.ignore:
+      return
+    if node.attrs.get('type')=='unavailable':
+      self.write("<presence from=%s type='unavailable'>"
+          "<x xmlns='%s'><status code='110'/></x></presence>"
+          % (quoteattr(to),NS_MUC_USER))
+      return
+    if room in self.deny:
+      self.write("<presence from=%s type='error' id=%s><error type='cancel'>"
+          "<%s xmlns='%s'/></error></presence>"
+          % (quoteattr(to),quoteattr(ID),self.deny[room],NS_STANZAS))
+      return
+
+    for occupant in self.occupants.get(room,[]):
+      self.write("<presence from=%s><x xmlns='%s'><item jid=%s/></x>"
+          "</presence>" % (quoteattr(room+'/'+occupant),NS_MUC_USER,
+          quoteattr(occupant+'@'+self.domain)))
+    self.write("<presence from=%s id=%s><x xmlns='%s'><status code='110'/>"
+        "</x></presence>" % (quoteattr(to),quoteattr(ID),NS_MUC_USER))
+
+  def handle_message(self,node):
+    body = node.get('body')
+    self.messages.append((node.attrs.get('to'),body.text if body else None))
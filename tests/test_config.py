@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,tempfile,shutil
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from lib import config
+from lib.config import Config
+
+CONF = """
+protocols = cli
+enable = general
+nick_name = Sibyl
+chat_ctrl = off
+"""
+
+class WatchTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.file = os.path.join(self.dir,'sibyl.conf')
+    self.write(CONF)
+    self.conf = Config(self.file)
+    self.conf.reload()
+    self.conf.clear_log()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self,text):
+    with open(self.file,'w') as f:
+      f.write(text)
+
+  def edit(self,old,new):
+    """change a line in the config file, making sure its stat changes"""
+
+    with open(self.file) as f:
+      text = f.read()
+    self.write(text.replace(old,new)+'\n')
+
+  def count_parses(self):
+    parses = []
+    orig = config.FakeSecHead
+    def counted(fp):
+      parses.append(fp)
+      return orig(fp)
+    config.FakeSecHead = counted
+    self.addCleanup(setattr,config,'FakeSecHead',orig)
+    return parses
+
+  def test_watch_applies_edit(self):
+    self.edit('nick_name = Sibyl','nick_name = Bob')
+    self.assertEqual(self.conf.watch(),['nick_name'])
+    self.assertEqual(self.conf.opts['nick_name'],'Bob')
+
+  def test_watch_removed_opt_uses_default(self):
+    self.edit('chat_ctrl = off','')
+    self.conf.opts['chat_ctrl'] = False
+    self.assertEqual(self.conf.watch(),['chat_ctrl'])
+    self.assertEqual(self.conf.opts['chat_ctrl'],
+        self.conf.OPTS['chat_ctrl'][Config.DEF])
+
+  def test_watch_ignores_static(self):
+    opts = dict(self.conf.opts)
+    self.edit('protocols = cli','protocols = cli,xmpp')
+    self.edit('enable = general','enable = general,library')
+    self.edit('chat_ctrl = off','chat_ctrl = off\nrooms = xmpp:room@example.com')
+    self.assertEqual(self.conf.watch(),[])
+    for opt in ('protocols','enable','rooms'):
+      self.assertEqual(self.conf.opts[opt],opts[opt])
+    self.assertEqual(len(self.conf.log_msgs),3)
+
+    # only warn once per edit
+    self.conf.clear_log()
+    self.assertEqual(self.conf.watch(),[])
+    self.assertEqual(self.conf.log_msgs,[])
+
+  def test_unchanged_not_parsed(self):
+    parses = self.count_parses()
+    self.assertEqual(self.conf.changed_opts(),[])
+    self.assertEqual(self.conf.watch(),[])
+    self.conf.reload('nick_name')
+    self.assertEqual(parses,[])
+
+    self.edit('nick_name = Sibyl','nick_name = Bob')
+    self.assertEqual(self.conf.watch(),['nick_name'])
+    self.assertEqual(len(parses),1)
+
+  def test_save_opt(self):
+    self.assertTrue(self.conf.save_opt('nick_name','Bob'))
+    self.assertEqual(self.conf.opts['nick_name'],'Bob')
+    self.assertEqual(self.conf.watch(),[])
+    with open(self.file) as f:
+      self.assertIn('nick_name = Bob\n',f.read())
+
+  def test_save_opt_write_fails(self):
+    with open(self.file) as f:
+      before = f.read()
+
+    def fail(fd):
+      raise OSError('disk full')
+    orig = os.fsync
+    os.fsync = fail
+    try:
+      self.assertRaises(OSError,self.conf.save_opt,'nick_name','Bob')
+    finally:
+      os.fsync = orig
+
+    with open(self.file) as f:
+      self.assertEqual(f.read(),before)
+    self.assertEqual(os.listdir(self.dir),['sibyl.conf'])
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,tempfile,shutil,threading,random,logging,time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from lib import util
+
+library = util.load_module('library',os.path.abspath(
+    os.path.join(os.path.dirname(__file__),'..','cmds')))
+Watcher = library.Watcher
+library.log.addHandler(logging.NullHandler())
+
+class Bot(object):
+  """just enough of SibylBot for Library and Watcher"""
+
+  def __init__(self,media,data):
+    self.opts = {
+      'library.audio_dirs' : [media],
+      'library.video_dirs' : [],
+      'library.file' : os.path.join(data,'library.pickle'),
+      'library.threads' : 2
+    }
+    self.lib_lock = threading.Lock()
+    self.lib_last_op = None
+    self.lib_last_rebuilt = 0
+    self.lib_last_elapsed = 0
+    self.lib_cache = {}
+    for lib in ('audio','video'):
+      for typ in ('dir','file'):
+        setattr(self,'lib_%s_%s' % (lib,typ),[])
+
+  def opt(self,name):
+    return self.opts[name]
+
+class WatcherTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.media = tempfile.mkdtemp()
+    self.data = tempfile.mkdtemp()
+    for f in ('a/1.mp3','a/x/2.mp3','b/3.mp3'):
+      self.touch(f)
+
+    self.bot = Bot(self.media,self.data)
+    library.Library(self.bot,None,['rebuild']).run()
+    self.watcher = Watcher(self.bot)
+    if self.watcher.fd<0:
+      self.skipTest('inotify not available')
+    self.watcher.watch_all()
+
+  def tearDown(self):
+    if self.watcher.fd>=0:
+      os.close(self.watcher.fd)
+    shutil.rmtree(self.media)
+    shutil.rmtree(self.data)
+
+  def path(self,rel):
+    return unicode(os.path.join(self.media,rel))
+
+  def touch(self,rel):
+    path = os.path.join(self.media,rel)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path,'w').close()
+
+  def event(self,rel,mask):
+    """build the event inotify would give us for the path"""
+
+    (parent,name) = os.path.split(self.path(rel).rstrip(os.path.sep))
+    for (wd,path) in self.watcher.wds.items():
+      if path==parent:
+        return (wd,mask,name.encode('utf8'))
+    self.fail('No watch for "%s"' % parent)
+
+  def assertLibrary(self):
+    """the lists should match the disk and their index should match them"""
+
+    (dirs,files) = util.rlistdir(unicode(self.media))
+    self.assertEqual(sorted(self.bot.lib_audio_dir),sorted(dirs))
+    self.assertEqual(sorted(self.bot.lib_audio_file),sorted(files))
+
+    for typ in ('dir','file'):
+      name = 'lib_audio_%s' % typ
+      lst = getattr(self.bot,name)
+      (_,pos,children) = self.watcher.get_index(name)
+      self.assertEqual(len(pos),len(lst))
+      for (i,p) in enumerate(lst):
+        self.assertEqual(pos[p],i)
+        self.assertIn(p,children[self.watcher.parent(p)])
+      self.assertEqual(sum(len(x) for x in children.values()),len(lst))
+
+  def test_create_file(self):
+    self.touch('a/4.mp3')
+    self.watcher.apply([self.event('a/4.mp3',Watcher.IN_CREATE)])
+    self.assertIn(self.path('a/4.mp3'),self.bot.lib_audio_file)
+    self.assertLibrary()
+
+  def test_delete_file(self):
+    os.remove(self.path('a/x/2.mp3'))
+    self.watcher.apply([self.event('a/x/2.mp3',Watcher.IN_DELETE)])
+    self.assertNotIn(self.path('a/x/2.mp3'),self.bot.lib_audio_file)
+    self.assertLibrary()
+
+  def test_create_dir(self):
+    self.touch('c/y/4.mp3')
+    self.watcher.apply([self.event('c',Watcher.IN_CREATE|Watcher.IN_ISDIR)])
+    self.assertIn(self.path('c/y/4.mp3'),self.bot.lib_audio_file)
+    self.assertIn(self.path('c/y'),self.watcher.wds.values())
+    self.assertLibrary()
+
+  def test_move_dir_out(self):
+    shutil.move(self.path('a'),os.path.join(self.data,'a'))
+    self.watcher.apply([self.event('a',Watcher.IN_MOVED_FROM|Watcher.IN_ISDIR)])
+    self.assertNotIn(self.path('a/x'),self.watcher.wds.values())
+    self.assertLibrary()
+
+  def test_move_dir_in(self):
+    os.makedirs(os.path.join(self.data,'c','y'))
+    open(os.path.join(self.data,'c','y','4.mp3'),'w').close()
+    shutil.move(os.path.join(self.data,'c'),self.path('c'))
+    self.watcher.apply([self.event('c',Watcher.IN_MOVED_TO|Watcher.IN_ISDIR)])
+    self.assertIn(self.path('c/y/4.mp3'),self.bot.lib_audio_file)
+    self.assertLibrary()
+
+  def test_create_then_delete(self):
+    self.watcher.apply([self.event('a/4.mp3',Watcher.IN_CREATE),
+        self.event('a/4.mp3',Watcher.IN_DELETE)])
+    self.assertNotIn(self.path('a/4.mp3'),self.bot.lib_audio_file)
+    self.assertLibrary()
+
+  def test_overflow_rebuilds(self):
+    self.touch('b/4.mp3')
+    self.watcher.apply([(-1,Watcher.IN_Q_OVERFLOW,'')])
+    self.assertIn(self.path('b/4.mp3'),self.bot.lib_audio_file)
+    self.assertLibrary()
+
+  def test_index_stays_consistent(self):
+    rand = random.Random(0)
+    for i in range(50):
+      files = [f for f in self.bot.lib_audio_file if f.endswith('.mp3')]
+      if files and rand.random()<0.4:
+        rel = os.path.relpath(rand.choice(files),self.media)
+        os.remove(self.path(rel))
+        self.watcher.apply([self.event(rel,Watcher.IN_DELETE)])
+      else:
+        rel = os.path.join(rand.choice(['a','a/x','b']),'%s.mp3' % i)
+        self.touch(rel)
+        self.watcher.apply([self.event(rel,Watcher.IN_CREATE)])
+      self.assertLibrary()
+
+class RebuildTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.media = tempfile.mkdtemp()
+    self.data = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.media,'a','b'))
+    open(os.path.join(self.media,'a','b','1.mp3'),'w').close()
+
+    # the cache only trusts directories that haven't changed in a while
+    old = time.time()-60
+    for (cur,ds,fs) in os.walk(self.media):
+      os.utime(cur,(old,old))
+
+    self.bot = Bot(self.media,self.data)
+    self.rebuild()
+
+    # a cached entry that isn't on disk shows whether the cache was used
+    self.fake = unicode(os.path.join(self.media,'a','fake.mp3'))
+    listing = self.bot.lib_cache[self.media]
+    (mtime,dirs,files) = listing[unicode(os.path.join(self.media,'a'))]
+    listing[unicode(os.path.join(self.media,'a'))] = (mtime,dirs,
+        files+['fake.mp3'])
+
+  def tearDown(self):
+    shutil.rmtree(self.media)
+    shutil.rmtree(self.data)
+
+  def rebuild(self,*args):
+    library.Library(self.bot,None,['rebuild']+list(args)).run()
+
+  def test_rebuild_uses_cache(self):
+    open(os.path.join(self.media,'a','b','2.mp3'),'w').close()
+    self.rebuild()
+    self.assertIn(self.fake,self.bot.lib_audio_file)
+    self.assertIn(os.path.join(self.media,'a','b','2.mp3'),
+        self.bot.lib_audio_file)
+
+  def test_rebuild_full_ignores_cache(self):
+    self.rebuild('full')
+    self.assertNotIn(self.fake,self.bot.lib_audio_file)
+    (dirs,files) = util.rlistdir(unicode(self.media))
+    self.assertEqual(self.bot.lib_audio_file,files)
+    self.rebuild()
+    self.assertNotIn(self.fake,self.bot.lib_audio_file)
+
+if __name__=='__main__':
+  unittest.main()
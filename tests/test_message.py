@@ -20,11 +20,32 @@
 #
 ################################################################################
 
-import sys,os,unittest
+import sys,os,unittest,pickle
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 
-from lib.protocol import Message
+from lib.protocol import Message,User
+
+class Proto(object):
+
+  def get_name(self):
+    return 'proto'
+
+class Name(User):
+
+  __slots__ = ('name',)
+
+  def parse(self,name):
+    self.name = name
+
+  def get_name(self):
+    return self.name
+
+  get_base = get_name
+  __str__ = get_name
+
+  def __eq__(self,other):
+    return isinstance(other,Name) and self.name==other.name
 
 class MessageTypesTestCase(unittest.TestCase):
 
@@ -41,3 +62,16 @@ class MessageTypesTestCase(unittest.TestCase):
       value = getattr(Message,typ)
       msg = '%s=%s not in [%s,%s]' % (typ,value,0,length-1)
       self.assertIn(value,range(0,length),msg=msg)
+
+class MessagePickleTestCase(unittest.TestCase):
+
+  def test_pickle(self):
+    user = Name(Proto(),'user')
+    msg = Message(user,'text',to=user,users=[user])
+    new = pickle.loads(pickle.dumps(msg,-1))
+    self.assertFalse(hasattr(msg,'__dict__'))
+    self.assertEqual(new.protocol,'proto')
+    self.assertEqual(new.get_text(),'text')
+    self.assertEqual(new.get_user().name,'user')
+    self.assertEqual(new.get_user().protocol,'proto')
+    self.assertIs(new.get_user(),new.get_to())
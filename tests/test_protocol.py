@@ -20,12 +20,12 @@
 #
 ################################################################################
 
-import sys,os,unittest,logging
+import sys,os,unittest,logging,socket,time,smtplib,Queue
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 
 from lib.config import Config
-from lib.protocol import ConnectFailure,AuthFailure
+from lib.protocol import ConnectFailure,AuthFailure,Message
 import protocols
 
 class Bot(object):
@@ -47,6 +47,22 @@ class Bot(object):
   def opt(self,name):
     return self.conf.opts[name]
 
+class SendBot(object):
+  """just enough of SibylBot for SibylBot.__send_batch()"""
+
+  def __init__(self):
+    self.deferred = []
+    self._SibylBot__pending_send = Queue.Queue()
+
+  def _SibylBot__defer(self,msg):
+    self.deferred.append(msg)
+
+  def _SibylBot__run_hooks(self,hook,*args):
+    pass
+
+  def log_ex(self,e,msg):
+    raise e
+
 class ProtocolTestCase(unittest.TestCase):
 
   def setUp(self):
@@ -110,3 +126,348 @@ class ProtocolTestCase(unittest.TestCase):
       self.assertTrue(rooms==0,
           msg=('[%s] Reports being in rooms before calling join()'
           % p.__class__.__name__))
+
+  def test_rooms_changed(self):
+    for p in self.protocols:
+      p = self.init_protocol(p)
+      rooms = []
+      p._get_rooms = lambda flag: rooms
+      self.assertFalse(p.in_room('room'))
+      rooms.append('room')
+      self.assertFalse(p.in_room('room'),
+          msg=('[%s] Rebuilt room index without _rooms_changed()'
+          % p.__class__.__name__))
+      p._rooms_changed()
+      self.assertTrue(p.in_room('room'),
+          msg=('[%s] Did not rebuild room index after _rooms_changed()'
+          % p.__class__.__name__))
+
+  def test_new_user_interned(self):
+    for p in self.protocols:
+      p = self.init_protocol(p)
+      user = self.silent(lambda: p.new_user('user@example.com'))
+      same = self.silent(lambda: p.new_user('user@example.com'))
+      self.assertIs(user,same,
+          msg=('[%s] Did not reuse User with identical args'
+          % p.__class__.__name__))
+
+  def test_new_user_interned_real(self):
+    for p in self.protocols:
+      p = self.init_protocol(p)
+      real = self.silent(lambda: p.new_user('alice@example.com'))
+      user = self.silent(
+          lambda: p.new_user('room@example.com',Message.GROUP,real))
+      self.assertIs(user.get_real(),real)
+      user = self.silent(lambda: p.new_user('room@example.com',Message.GROUP))
+      self.assertIs(user.get_real(),user,
+          msg=('[%s] Kept the "real" User from an earlier new_user()'
+          % p.__class__.__name__))
+
+class SocketTestCase(unittest.TestCase):
+
+  MSGS = 2000
+
+  def setUp(self):
+    self.bot = Bot()
+    d = protocols.PROTOCOLS['sibyl_socket']
+    opts = d['config'](self.bot)
+    for opt in opts:
+      opt['name'] = 'socket.'+opt['name']
+    self.bot.conf.add_opts(opts,'socket')
+    self.bot.conf.reload()
+    self.bot.conf.opts['socket.port'] = 0
+
+    self.msgs = []
+    self.bot._cb_message = self.msgs.append
+
+    log = logging.getLogger('protocol')
+    log.addHandler(logging.NullHandler())
+    self.proto = d['class'](self.bot,log)
+    self.proto.connect()
+
+  def tearDown(self):
+    self.proto.shutdown()
+
+  def test_throughput(self):
+    port = self.proto.thread.socket.getsockname()[1]
+    sock = socket.create_connection(('localhost',port))
+    frames = ['%s 1 %s' % (len(str(i))+2,i) for i in range(self.MSGS)]
+
+    # simulate the bot's main loop, including its sleep
+    start = time.time()
+    sock.sendall(''.join(frames))
+    while len(self.msgs)<self.MSGS and time.time()-start<10:
+      self.proto.process()
+      time.sleep(0.1)
+    rate = len(self.msgs)/(time.time()-start)
+    sock.close()
+
+    self.assertEqual(len(self.msgs),self.MSGS)
+    self.assertGreater(rate,1000,msg='Only %i msgs/s' % rate)
+
+  def test_max_frame(self):
+    port = self.proto.thread.socket.getsockname()[1]
+    sock = socket.create_connection(('localhost',port))
+    sock.settimeout(5)
+    sock.sendall('%s 1 ' % (self.proto.thread.max_frame+1))
+    self.assertEqual(sock.recv(4096),'')
+    sock.close()
+
+  def test_negative_frame(self):
+    port = self.proto.thread.socket.getsockname()[1]
+    sock = socket.create_connection(('localhost',port))
+    sock.settimeout(5)
+    sock.sendall('-5 1 ')
+    self.assertEqual(sock.recv(4096),'')
+    sock.close()
+
+  def test_request_ids(self):
+    port = self.proto.thread.socket.getsockname()[1]
+    sock = socket.create_connection(('localhost',port))
+    sock.settimeout(5)
+    sock.sendall('9 2 a1 ping9 2 b2 ping')
+
+    start = time.time()
+    while len(self.msgs)<2 and time.time()-start<5:
+      self.proto.process()
+      time.sleep(0.01)
+    self.assertEqual([m.get_text() for m in self.msgs],['ping','ping'])
+
+    usr = self.proto.get_user()
+    self.proto.send_many([Message(usr,'pong',to=m.get_from())
+        for m in reversed(self.msgs)])
+    self.proto.process()
+
+    expected = '9 2 b2 pong9 2 a1 pong4 3 a14 3 b2'
+    data = ''
+    while len(data)<len(expected):
+      data += sock.recv(4096)
+    sock.close()
+    self.assertEqual(data,expected)
+
+  def test_unix(self):
+    path = os.path.abspath('test.sock')
+    self.proto.shutdown()
+    self.bot.conf.opts['socket.password'] = 'secret'
+    self.bot.conf.opts['socket.unix_path'] = path
+    self.proto.connect()
+    self.assertEqual(os.stat(path).st_mode & 0777,0600)
+
+    # local clients don't need the password
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall('4 1 hi')
+    start = time.time()
+    while not self.msgs and time.time()-start<5:
+      self.proto.process()
+      time.sleep(0.01)
+    sock.close()
+    self.assertEqual([m.get_text() for m in self.msgs],['hi'])
+
+    self.proto.shutdown()
+    self.assertFalse(os.path.exists(path))
+
+@unittest.skipUnless('sibyl_xmpp' in protocols.PROTOCOLS,'xmpppy not installed')
+class XMPPTestCase(unittest.TestCase):
+
+  ROOM = 'room@muc.example.com'
+
+  def setUp(self):
+    from mock_xmpp import MockXMPPServer
+    self.server = MockXMPPServer()
+    self.server.occupants[self.ROOM] = ['alice','bob']
+    self.server.start()
+
+    self.bot = Bot()
+    d = protocols.PROTOCOLS['sibyl_xmpp']
+    opts = d['config'](self.bot)
+    for opt in opts:
+      opt['name'] = 'xmpp.'+opt['name']
+    self.bot.conf.add_opts(opts,'xmpp')
+    self.bot.conf.reload()
+    self.bot.conf.opts.update({'xmpp.username':'sibyl@example.com',
+        'xmpp.password':'secret','xmpp.server':'localhost',
+        'xmpp.port':self.server.port,'nick_name':'sibyl'})
+
+    self.joined = []
+    self.bot._cb_message = lambda mess: None
+    self.bot._cb_join_room_success = self.joined.append
+
+    log = logging.getLogger('protocol')
+    log.addHandler(logging.NullHandler())
+    self.proto = d['class'](self.bot,log)
+    self.proto.connect()
+    self.join()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def process(self,until):
+    start = time.time()
+    while not until() and time.time()-start<5:
+      self.proto.process()
+      time.sleep(0.01)
+
+  def join(self):
+    joined = len(self.joined)
+    self.proto.join_room(self.proto.new_room(self.ROOM))
+    self.process(lambda: self.proto.get_rooms() and len(self.proto.rosters.get(
+        self.ROOM,{}))==3)
+    return len(self.joined)-joined
+
+  def send(self,text):
+    to = self.proto.new_user('alice@example.com')
+    self.proto.send(Message(self.proto.get_user(),text,to=to))
+
+  def lose_connection(self,text):
+    self.server.drop()
+    time.sleep(0.1)
+    with self.assertRaises(self.proto.ConnectFailure):
+      self.send(text)
+      self.process(lambda: False)
+
+  def test_stream_resume(self):
+    self.send('acked')
+    self.server.request_ack()
+    self.process(lambda: self.server.sm_acks)
+    self.assertEqual(self.server.sm_acks,[self.server.sm_out])
+
+    # the server never sees this one until we resume
+    self.lose_connection('lost')
+    presences = len([s for s in self.server.stanzas if s.name=='presence'])
+    handled = self.server.sm_out
+    self.proto.connect()
+    self.assertEqual(self.join(),0)
+    self.process(lambda: len(self.server.messages)==2)
+
+    self.assertEqual(self.server.resumes,1)
+    self.assertEqual(self.server.sm_acks[-1],handled)
+    self.assertEqual([text for (to,text) in self.server.messages],
+        ['acked','lost'])
+    self.assertEqual(presences,
+        len([s for s in self.server.stanzas if s.name=='presence']))
+
+  def test_stream_resume_deferred(self):
+    from sibyl.lib.sibylbot import SibylBot
+    send_batch = SibylBot._SibylBot__send_batch.__func__
+    bot = SendBot()
+
+    # keep sending until a write fails, which SibylBot catches and defers
+    self.server.drop()
+    time.sleep(0.1)
+    texts = []
+    while self.proto.conn and len(texts)<5:
+      texts.append('lost%s' % len(texts))
+      to = self.proto.new_user('alice@example.com')
+      send_batch(bot,self.proto,[Message(self.proto.get_user(),texts[-1],
+          to=to)])
+      time.sleep(0.1)
+    if self.proto.conn:
+      with self.assertRaises(self.proto.ConnectFailure):
+        self.process(lambda: False)
+
+    # after a resume SibylBot requeues whatever it deferred
+    self.proto.connect()
+    send_batch(bot,self.proto,bot.deferred)
+    self.process(lambda: len(self.server.messages)==len(texts))
+    self.process(lambda: False)
+
+    self.assertEqual(self.server.resumes,1)
+    self.assertEqual([text for (to,text) in self.server.messages],texts)
+
+  def test_stream_resume_failed(self):
+    self.server.resumable = False
+    self.lose_connection('lost')
+    self.proto.connect()
+
+    self.assertEqual(self.server.resumes,0)
+    self.assertEqual(self.server.connects,2)
+    self.assertEqual(self.join(),1)
+
+class EmailTestCase(unittest.TestCase):
+
+  def setUp(self):
+    from mock_smtp import MockSMTPServer
+    self.server = MockSMTPServer()
+    self.server.start()
+
+    self.bot = Bot()
+    d = protocols.PROTOCOLS['sibyl_email']
+    opts = d['config'](self.bot)
+    for opt in opts:
+      opt['name'] = 'email.'+opt['name']
+    self.bot.conf.add_opts(opts,'email')
+    self.bot.conf.reload()
+    self.bot.conf.opts.update({'email.username':'sibyl@example.com',
+        'email.password':'secret','email.smtp':'localhost'})
+
+    log = logging.getLogger('protocol')
+    log.addHandler(logging.NullHandler())
+    self.proto = d['class'](self.bot,log)
+
+    # the mock server doesn't do STARTTLS
+    self.sender = self.proto.sender
+    self.sender.open = lambda: smtplib.SMTP('localhost',self.server.port)
+    self.proto._connect_smtp()
+
+  def tearDown(self):
+    self.sender.stop(1)
+    self.server.stop()
+
+  def send(self,*users):
+    self.proto.send_many([Message(self.proto.get_user(),'reply to '+user,
+        to=self.proto.new_user(user)) for user in users])
+
+  def wait(self,until):
+    start = time.time()
+    while not until() and time.time()-start<5:
+      time.sleep(0.01)
+    self.assertTrue(until())
+
+  def test_batch(self):
+    users = ['user%s@example.com' % i for i in range(20)]
+    self.send(*users)
+    self.wait(lambda: len(self.server.messages)==20)
+
+    self.assertEqual(self.server.messages,
+        [([user],'reply to '+user) for user in users])
+    self.assertEqual((self.server.connects,self.server.logins),(1,1))
+    self.assertNotIn('NOOP',self.server.commands)
+
+  def test_reconnect(self):
+    self.send('alice@example.com')
+    self.wait(lambda: len(self.server.messages)==1)
+    self.server.drop()
+    self.send('bob@example.com')
+    self.wait(lambda: len(self.server.messages)==2)
+
+    self.assertEqual(self.server.connects,2)
+    self.assertTrue(self.proto.thread.msgs.empty())
+
+  def test_refused(self):
+    self.server.refuse.add('nobody@example.com')
+    self.send('nobody@example.com','alice@example.com')
+    self.wait(lambda: len(self.server.messages)==1)
+
+    self.assertEqual(self.server.messages[0][0],['alice@example.com'])
+    self.assertEqual(self.server.connects,1)
+
+  def test_unicode(self):
+    self.proto.send(Message(self.proto.get_user(),u'caf\xe9 \u2603',
+        to=self.proto.new_user('alice@example.com')))
+    self.send('bob@example.com')
+    self.wait(lambda: len(self.server.messages)==2)
+
+    self.assertEqual(self.server.messages[0][1].decode('utf8'),
+        u'caf\xe9 \u2603')
+    self.assertTrue(self.sender.is_alive())
+
+  def test_idle_timeout(self):
+    self.bot.conf.opts['email.smtp_idle'] = 1
+    self.send('alice@example.com')
+    self.wait(lambda: not self.server.connected())
+    self.assertIn('QUIT',self.server.commands)
+
+    self.send('bob@example.com')
+    self.wait(lambda: len(self.server.messages)==2)
+    self.assertEqual(self.server.connects,2)
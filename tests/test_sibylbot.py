@@ -20,12 +20,15 @@
 #
 ################################################################################
 
-import sys,os,unittest
+import sys,os,unittest,tempfile,shutil
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
 
 from lib.protocol import Message,ConnectFailure
+from lib.sibylbot import SibylBot
+from lib.config import Config
 from mock_bot import Bot
+from mock_log import MockLog
 from mock_protocol import QueueEmpty
 from mock_user import MockUser
 
@@ -184,5 +187,102 @@ class HooksTestCase(unittest.TestCase):
   def test_idle_hook_runs(self):
     self.process('HOOK_IDLE')
 
+PLUGIN = """
+from sibyl.lib.decorators import botinit,botdown,botcmd
+
+VERSION = %s
+
+@botinit
+def init(bot):
+  bot.add_var('reloadplug_count',0)
+  bot.add_var('reloadplug_log',[])
+  %s
+  bot.reloadplug_count += 1
+  bot.reloadplug_log.append('init%%s' %% VERSION)
+
+@botdown
+def down(bot):
+  bot.reloadplug_log.append('down%%s' %% VERSION)
+
+@botcmd
+def reloadplug(bot,mess,args):
+  return version()
+
+def version():
+  return VERSION
+
+%s
+"""
+
+class ReloadBot(SibylBot):
+  """just enough of SibylBot for reload_plugin()"""
+
+  def __init__(self,d):
+    self.log = MockLog()
+    self.conf = Config(os.path.join(d,'sibyl.conf'))
+    self.conf.opts = self.conf.get_default()
+    self.hooks = {x:{} for x in ['chat','init','down','con','discon','recon',
+        'rooms','roomf','msg','priv','group','status','err','idle','send']}
+    self.plugins = []
+    self.ns_opt = {}
+    self.ns_func = {}
+    self.ns_cmd = {}
+    self._SibylBot__plugin_dirs = {'reloadplug':d}
+    self._SibylBot__carry = {}
+    self._SibylBot__idle_last = {}
+    self._SibylBot__idle_count = {}
+    self._SibylBot__state = {}
+    self._SibylBot__persist = []
+
+class ReloadTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.bot = ReloadBot(self.dir)
+    self.write(1)
+    self.assertIsNone(self.bot.reload_plugin('reloadplug'))
+
+  def tearDown(self):
+    sys.modules.pop('reloadplug',None)
+    shutil.rmtree(self.dir)
+
+  def write(self,version,init='',tail=''):
+    for ext in ('py','pyc'):
+      f = os.path.join(self.dir,'reloadplug.'+ext)
+      if os.path.isfile(f):
+        os.remove(f)
+    with open(os.path.join(self.dir,'reloadplug.py'),'w') as f:
+      f.write(PLUGIN % (version,init,tail))
+
+  def cmd(self):
+    return self.bot.hooks['chat']['reloadplug'](self.bot,None,[])
+
+  def test_reload_success(self):
+    self.write(2)
+    self.assertIsNone(self.bot.reload_plugin('reloadplug'))
+    self.assertEqual(self.cmd(),2)
+    self.assertEqual(self.bot.reloadplug_log,['init1','down1','init2'])
+    self.assertEqual(self.bot.reloadplug_count,2)
+    self.assertEqual(self.bot.plugins,['reloadplug'])
+
+  def test_reload_failure_restores(self):
+    old = sys.modules['reloadplug']
+    self.write(2,tail='raise ValueError("broken")')
+    self.assertEqual(self.bot.reload_plugin('reloadplug'),'import failed')
+    self.assertEqual(self.cmd(),1)
+    self.assertIs(sys.modules['reloadplug'],old)
+    self.assertEqual(self.bot.reloadplug_log,['init1','down1','init1'])
+    self.assertEqual(self.bot.reloadplug_count,2)
+    self.assertEqual(self.bot.plugins,['reloadplug'])
+
+  def test_reload_carries_vars(self):
+    self.bot.reloadplug_log.append('mark')
+    self.write(2,init='bot.add_var("reloadplug_new",True)')
+    self.assertIsNone(self.bot.reload_plugin('reloadplug'))
+    self.assertEqual(self.bot.reloadplug_log,['init1','mark','down1','init2'])
+    self.assertTrue(self.bot.reloadplug_new)
+    self.assertEqual(self.bot.ns_opt['reloadplug_new'],'reloadplug')
+    self.assertEqual(self.bot._SibylBot__carry,{})
+
 if __name__=='__main__':
   unittest.main()
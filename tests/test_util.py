@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Sibyl: A modular Python chat bot framework
+# Copyright (c) 2015-2017 Joshua Haas <jahschwa.com>
+#
+# This file is part of Sibyl.
+#
+# Sibyl is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+################################################################################
+
+import sys,os,unittest,tempfile,shutil,threading,time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+
+from lib import util
+
+class RlistdirTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    for f in ('1','a/2','a/3','a/b/c/4','a/b/5','d/6'):
+      self.touch(f)
+    os.makedirs(self.path('e/f'))
+    os.symlink(self.path('a/b'),self.path('d/link'))
+    self.age()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def path(self,rel):
+    return os.path.join(self.dir,rel)
+
+  def touch(self,rel):
+    path = self.path(rel)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path,'w').close()
+
+  def age(self):
+    """push every mtime back so the cache trusts them"""
+
+    old = time.time()-60
+    for (cur,ds,fs) in os.walk(self.dir):
+      os.utime(cur,(old,old))
+
+  def test_same_as_rlistdir(self):
+    for symlinks in (True,False):
+      for threads in (1,4):
+        for path in (self.dir,unicode(self.dir)):
+          result = util.rlistdirs([path],symlinks=symlinks,threads=threads)
+          self.assertEqual(result[path][:2],util.rlistdir(path,symlinks),
+              msg='symlinks=%s threads=%s' % (symlinks,threads))
+
+  def test_several_paths(self):
+    paths = [self.path('a'),self.path('d'),self.path('missing')]
+    result = util.rlistdirs(paths)
+    for path in paths:
+      self.assertEqual(result[path][:2],util.rlistdir(path))
+
+  def test_cached_new_file_deep(self):
+    (dirs,files,cache) = util.rlistdir_cached(self.dir)
+    self.touch('a/b/c/7')
+    (dirs,files,cache) = util.rlistdir_cached(self.dir,cache)
+    self.assertIn(self.path('a/b/c/7'),files)
+    self.assertEqual((dirs,files),util.rlistdir(self.dir))
+
+  def test_cached_reuses_unchanged(self):
+    (dirs,files,cache) = util.rlistdir_cached(self.dir)
+    (mtime,dirnames,filenames) = cache[self.path('a')]
+    cache[self.path('a')] = (mtime,dirnames,filenames+['fake'])
+    (dirs,files,cache) = util.rlistdir_cached(self.dir,cache)
+    self.assertIn(self.path('a/fake'),files)
+
+  def test_errors_returned(self):
+    bad = self.dir+'\0'
+    result = util.rlistdirs([self.dir,bad])
+    self.assertIsInstance(result[bad],TypeError)
+    self.assertEqual(result[self.dir][:2],util.rlistdir(self.dir))
+    self.assertRaises(TypeError,util.rlistdir_cached,bad)
+
+  def test_workers_exit(self):
+    before = threading.active_count()
+    util.rlistdirs([self.dir],threads=4)
+    self.assertEqual(threading.active_count(),before)
+
+if __name__=='__main__':
+  unittest.main()